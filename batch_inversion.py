@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2017 Bernard Giroux, Elie Dumas-Lefebvre, Jerome Simon
+email: Bernard.Giroux@ete.inrs.ca
+
+This file is part of BhTomoPy.
+
+BhTomoPy is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Headless LSQR inversions, without InversionUI.
+#
+# Usage:
+#     python batch_inversion.py database.db params.json [-n nprocesses]
+#
+# The parameter file is a JSON file such as
+#
+#     {
+#         "model": "model 1",
+#         "mogs": ["MOG 1", "MOG 2"],
+#         "name": "sweep",
+#         "params": {"numItStraight": 1, "numItCurved": 3, "tol": 1e-6, "nbreiter": 100},
+#         "sweep": {"alphax": [1, 10, 100], "alphaz": [1, 10, 100], "order": [1, 2], "dv_max": [0.5]}
+#     }
+#
+# "mogs" holds names or indices of MOGs of the model (all MOGs if absent),
+# "params" holds attributes of InvLSQRParams, and "sweep" lists the values
+# of parameters to combine.  One inversion is run for each combination, in
+# a pool of processes, and the results are appended to Model.inv_res.
+# Constraints of the model are used if useCont is 1.  Only traveltime
+# data are inverted (tomoAtt must be 0).
+
+import argparse
+import copy
+import datetime
+import itertools
+import json
+import multiprocessing
+import sys
+
+import numpy as np
+from sqlalchemy.orm.attributes import flag_modified
+
+import database
+from grid import StraightRayCache
+from inversion import invLSQR, InvLSQRParams
+from model import Model
+
+current_module = sys.modules[__name__]
+
+
+def loadParams(filename):
+    """
+    Read a parameter file, returns the dict it holds
+    """
+    with open(filename, 'r') as f:
+        p = json.load(f)
+    if 'model' not in p:
+        raise ValueError('Parameter file should give the name of the model')
+    p.setdefault('mogs', None)
+    p.setdefault('name', 'batch')
+    p.setdefault('params', {})
+    p.setdefault('sweep', {})
+    return p
+
+
+def sweepParams(base, sweep):
+    """
+    Returns a list of InvLSQRParams, one per combination of the values in
+    dict sweep, the other attributes being those of base
+    """
+    valid = vars(InvLSQRParams())
+    for key in sweep:
+        if key not in valid:
+            raise ValueError('Unknown parameter: ' + key)
+    keys = sorted(sweep)
+    out = []
+    for values in itertools.product(*[sweep[k] for k in keys]):
+        params = copy.deepcopy(base)
+        for k, v in zip(keys, values):
+            setattr(params, k, v)
+        out.append(params)
+    return out
+
+
+def makeParams(d):
+    """
+    Returns an InvLSQRParams instance with the attributes in dict d
+    """
+    params = InvLSQRParams()
+    for key, value in d.items():
+        if not hasattr(params, key):
+            raise ValueError('Unknown parameter: ' + key)
+        setattr(params, key, value)
+    return params
+
+
+def getData(model, selectedMogs):
+    """
+    Returns the data and idata arrays of invLSQR for MOGs selectedMogs of model
+    """
+    tt, idata = Model.getModelData(model, selectedMogs, 'tt')
+    g = model.grid
+    data = np.concatenate((g.Tx[idata, :], g.Rx[idata, :], tt, g.TxCosDir[idata, :], g.RxCosDir[idata, :]), axis=1)
+    return data, idata
+
+
+def _workerInit(data, idata, grid, L, cont):
+    # inputs common to all inversions are sent once to each worker
+    global _data, _idata, _grid, _L, _cont
+    _data, _idata, _grid, _L, _cont = data, idata, grid, L, cont
+
+
+def _workerRun(params):
+    return invLSQR(params, _data, _idata, _grid, _L, cont=_cont)
+
+
+def runBatch(dbfile, paramfile, nprocesses=1):
+    """
+    Run the inversions of parameter file paramfile on database dbfile,
+    and save the results in the database
+    """
+    p = loadParams(paramfile)
+
+    database.load(current_module, dbfile)
+    model = current_module.session.query(Model).filter(Model.name == p['model']).first()
+    if model is None:
+        raise ValueError('Model not found in database: ' + p['model'])
+
+    names = [mog.name for mog in model.mogs]
+    if p['mogs'] is None:
+        selectedMogs = list(range(len(names)))
+    else:
+        missing = [m for m in p['mogs'] if not isinstance(m, int) and m not in names]
+        if len(missing) > 0:
+            raise ValueError('MOG(s) {0} not found in model {1}, available MOGs: {2}'.format(
+                ', '.join(missing), model.name, ', '.join(names)))
+        selectedMogs = [m if isinstance(m, int) else names.index(m) for m in p['mogs']]
+
+    base = makeParams(p['params'])
+    base.selectedMogs = selectedMogs
+    allParams = sweepParams(base, p['sweep'])
+    if any(params.tomoAtt == 1 for params in allParams):
+        raise ValueError('Amplitude inversions (tomoAtt = 1) are not supported in batch mode')
+
+    data, idata = getData(model, selectedMogs)
+    # settings of the batch are applied to a copy, the grid of the model is saved below
+    grid = copy.copy(model.grid)
+    grid.rayCache = StraightRayCache.sidecar(database.long_url(current_module))
+    L = grid.getForwardStraightRays(idata)
+    # parallelism comes from the pool, each inversion raytraces in a single process
+    grid.rayCache = None
+    grid.nprocesses = 1
+
+    cont = None
+    if any(params.useCont == 1 for params in allParams):
+        cont = grid.mapConstraints(*model.getConstraints('scont'))
+
+    print('{0} inversions with {1} processes'.format(len(allParams), nprocesses))
+    if nprocesses > 1 and len(allParams) > 1:
+        with multiprocessing.Pool(min(nprocesses, len(allParams)), _workerInit, (data, idata, grid, L, cont)) as pool:
+            tomos = pool.map(_workerRun, allParams, chunksize=1)
+    else:
+        _workerInit(data, idata, grid, L, cont)
+        tomos = [_workerRun(params) for params in allParams]
+
+    date = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    dType = '-att' if base.tomoAtt == 1 else '-vel'
+    keys = sorted(p['sweep'])
+    for params, tomo in zip(allParams, tomos):
+        desc = ' '.join('{0}={1}'.format(k, getattr(params, k)) for k in keys)
+        name = '{0} {1} {2} -LSQR {3}'.format(p['name'], date, dType, desc).strip()
+        model.inv_res.append((name, tomo, params))
+    flag_modified(model, 'inv_res')
+    current_module.session.commit()
+    print('{0} results saved in model {1}'.format(len(tomos), model.name))
+
+    return tomos
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run LSQR inversions without the user interface')
+    parser.add_argument('database', help='database file (*.db)')
+    parser.add_argument('params', help='parameter file (JSON)')
+    parser.add_argument('-n', '--nprocesses', type=int, default=multiprocessing.cpu_count(),
+                        help='number of inversions run in parallel')
+    args = parser.parse_args(argv)
+    runBatch(args.database, args.params, args.nprocesses)
+
+
+if __name__ == '__main__':
+    main()
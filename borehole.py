@@ -80,65 +80,116 @@ class Borehole(Base):
         z: z coordinates of all measurement points
         c: direction of cosines at measurements points which point downwards
         """
+        x, y, z, c, _ = Borehole.projectMany([fdata], [ldepth])
+        return x, y, z, c
+
+    @staticmethod
+    def projectMany(fdatas, ldepths):
+        """
+        Project measurement points on the trajectories of several boreholes at once
+
+        INPUT:
+
+        fdatas: list of trajectories, matrix(n_b, 3) as fdata in project
+        ldepths: list of vectors holding the position of the measurement points along
+        each trajectory (from top to bottom)
+
+        OUTPUT:
 
+        x, y, z, c: as in project, for the points of all boreholes one after the other
+        no_bh: index in fdatas of the borehole of each point
+        """
+        npts = [np.size(l) for l in ldepths]
+        no_bh = np.repeat(np.arange(len(fdatas)), npts)
+        ldepth = np.concatenate([np.asarray(l, dtype=np.float64).reshape(-1) for l in ldepths] + [np.zeros((0, ))])
+
+        # The trajectories are put one after the other, each one starting at an offset larger than the
+        # length of the preceding ones, so that the segment holding every point is found with a single
+        # binary search in the cumulative length along the trajectories.
+        fdata = []
+        depthBH = []
+        offset = np.zeros((len(fdatas), ))
+        length = np.zeros((len(fdatas), ))
+        last = np.zeros((len(fdatas), ), dtype=int)  # index of the first point of the last segment
+        n0 = 0
+        for n, f in enumerate(fdatas):
+            f = np.asarray(f, dtype=np.float64).reshape(-1, 3)
+            if f.shape[0] < 2:
+                raise ValueError('Borehole trajectory should have at least 2 points')
+            d = np.append(0.0, np.cumsum(np.sqrt(np.sum(np.diff(f, n=1, axis=0)**2, axis=1))))
+            if n > 0:
+                offset[n] = offset[n - 1] + length[n - 1] + 1.0
+            length[n] = d[-1]
+            fdata.append(f)
+            depthBH.append(d + offset[n])
+            n0 += f.shape[0]
+            last[n] = n0 - 2
+        fdata = np.concatenate(fdata + [np.zeros((0, 3))])
+        depthBH = np.concatenate(depthBH + [np.zeros((0, ))])
+
+        # the points of interest must lie between the top and the bottom of their borehole
+        if np.any(ldepth < 0.0) or np.any(ldepth > length[no_bh]):
+            raise ValueError('Measurement points are outside of the borehole trajectory')
+
+        ldepth = ldepth + offset[no_bh]
+        # closest trajectory point above each point of interest (points at the bottom are on the last segment)
+        i1 = np.minimum(np.searchsorted(depthBH, ldepth, side='right') - 1, last[no_bh])
+
+        # direction cosines of the segments holding the points of interest
+        l = fdata[i1 + 1, :] - fdata[i1, :]
+        d = np.sqrt(np.sum(l**2, axis=1))
+        l[d > 0.0, :] /= d[d > 0.0, np.newaxis]
+
+        xyz = fdata[i1, :] + (ldepth - depthBH[i1])[:, np.newaxis] * l
+
+        return xyz[:, [0]], xyz[:, [1]], xyz[:, [2]], l, no_bh
+
+
+if __name__ == '__main__':
+
+    import time
+
+    def project_loop(fdata, ldepth):
+        # former implementation, with the length of the segments computed
+        # with the norm and the direction cosines returned in c
         npts = ldepth.size
-        # the x,y and z coordinates are initially a matrix which contains as much 0 as the number of measurement points
-        # we can see the c value as the combination of the three cartesian coordinates in unitary form
         x = np.zeros((npts, 1))
         y = np.zeros((npts, 1))
         z = np.zeros((npts, 1))
         c = np.zeros((npts, 3))
-
         depthBH = np.append(np.array([[0]]), np.cumsum(np.sqrt(np.sum(np.diff(fdata, n=1, axis=0)**2, axis=1))))
-
-        # Knowing that de BH's depth is a matrix which contains the distance between every points of fdata, and that ldepth
-        # contains the points where the data was taken,we need to first make sure that every points taken in charge by ldepth is in the range of the BH's depth.
-        # As a matter of fact, we verify if each points of ldepth is contained in between the volume(i.e. between X and Xmax and the same for Y and Z)
-        # If so, we take the closest point under our point of interest(i.e. i2[0]) and the closest point above our point of interest (i.e. i1[-1])
-        # So you can anticipate that these points will change for every index of the ldepth vector.
-
         for n in range(npts):
             i1, = np.nonzero(ldepth[n] >= depthBH)
-            if i1.size == 0:
-                x = np.zeros((npts, 1))
-                y = np.zeros((npts, 1))
-                z = np.zeros((npts, 1))
-                c = np.zeros((npts, 3))
-                raise ValueError
             i1 = i1[-1]
-
             i2, = np.nonzero(ldepth[n] < depthBH)
-            if i2.size == 0:
-                x = np.zeros((npts, 1))
-                y = np.zeros((npts, 1))
-                z = np.zeros((npts, 1))
-                c = np.zeros((npts, 3))
-                raise ValueError
             i2 = i2[0]
-
-            # Here we calculate the distance between the points which have the same index than the closest points above and under
-            d = np.sqrt(np.sum(fdata[i2, :] - fdata[i1, :])**2)
+            d = np.sqrt(np.sum((fdata[i2, :] - fdata[i1, :])**2))
             l = (fdata[i2, :] - fdata[i1, :]) / d
-            # the l value represents the direction cosine for every dimension
-
             d2 = ldepth[n] - depthBH[i1]
-
             x[n] = fdata[i1, 0] + d2 * l[0]
             y[n] = fdata[i1, 1] + d2 * l[1]
             z[n] = fdata[i1, 2] + d2 * l[2]
-            c[n, :] = 1
-
-            # We represent the ldepth's point of interest coordinates by adding the direction cosine of every dimension to
-            # the closest upper point's coordinates
+            c[n, :] = l
         return x, y, z, c
 
-# if __name__ == '__main__':
-#     fdatatest=np.array([[0,0,0],[1,1,1],[2,2,2],[3,3,3],[4,4,4],[5,5,5]], dtype=np.float64)
-#     ldepthtest = np.array([1, 2, 3, 4, 5], dtype=np.float64)
-#     bh1 = Borehole('BH1',0.0, 0.0, 0.0, 4.0, 4.0, 4.0)
-#     bh1.fdata = fdatatest
-#     x,y,z,c = Borehole.project(fdatatest,ldepthtest)
-#     print(x)
-#     print(y)
-#     print(z)
-#     print(c)
+    # deviated boreholes
+    t = np.linspace(0, 1, 2000)[:, np.newaxis]
+    fdata1 = np.hstack((2.0 * t**2, 0.5 * t, -30.0 * t))
+    fdata2 = np.hstack((10.0 + 1.5 * t, 3.0 * t**2, 5.0 - 25.0 * t))
+    depth1 = np.append(0.0, np.cumsum(np.sqrt(np.sum(np.diff(fdata1, axis=0)**2, axis=1))))
+    depth2 = np.append(0.0, np.cumsum(np.sqrt(np.sum(np.diff(fdata2, axis=0)**2, axis=1))))
+    ldepth1 = np.sort(depth1[-1] * np.random.rand(5000)) * 0.999
+    ldepth2 = np.sort(depth2[-1] * np.random.rand(3000)) * 0.999
+
+    tic = time.perf_counter()
+    ref = project_loop(fdata1, ldepth1)
+    t1 = time.perf_counter() - tic
+    tic = time.perf_counter()
+    out = Borehole.project(fdata1, ldepth1)
+    t2 = time.perf_counter() - tic
+    print('project: {0:g} s -> {1:g} s, max diff {2:g}'.format(t1, t2, max(np.max(np.abs(a - b)) for a, b in zip(ref, out))))
+
+    x, y, z, c, no_bh = Borehole.projectMany([fdata1, fdata2], [ldepth1, ldepth2])
+    ref2 = project_loop(fdata2, ldepth2)
+    print('projectMany, max diff: {0:g}'.format(max(np.max(np.abs(a[no_bh == 1] - b)) for a, b in zip((x, y, z, c), ref2))))
+    print('unit direction cosines: {0}'.format(np.allclose(np.sum(c**2, axis=1), 1.0)))
@@ -235,6 +235,7 @@ class BoreholeUI(QtWidgets.QWidget):
                 acont.x = acont.x.flatten()
                 acont.y = acont.y.flatten()
                 acont.z = acont.z.flatten()
+                acont.depth = cont[:, 0]
                 acont.valeur = cont[:, 1]
 
                 if np.size(cont, axis=1) == 3:
@@ -267,6 +268,7 @@ class BoreholeUI(QtWidgets.QWidget):
                 scont.x = scont.x.flatten()
                 scont.y = scont.y.flatten()
                 scont.z = scont.z.flatten()
+                scont.depth = cont[:, 0]
                 scont.valeur = 1 / cont[:, 1]
 
                 if np.size(cont, axis=1) == 3:
@@ -436,6 +438,7 @@ class Cont(object):
         self.x = np.array([])
         self.y = np.array([])
         self.z = np.array([])
+        self.depth = np.array([])  # position of the constraints along the borehole, to project them again
         self.valeur = np.array([])
         self.variance = np.array([])
 
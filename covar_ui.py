@@ -25,6 +25,7 @@ from model import Model
 from mog import Mog
 import covar
 import database
+from grid import StraightRayCache
 import utils_ui
 from utils_ui import lay, inv_lay
 from sqlalchemy.orm.attributes import flag_modified
@@ -324,6 +325,8 @@ class CovarUI(QtWidgets.QFrame):
 
     def new_grid(self):
         self.temp_grid = deepcopy(self.model.grid)
+        # straight ray matrices are kept next to the database between sessions
+        self.temp_grid.rayCache = StraightRayCache.sidecar(database.long_url(database))
 
     def reset_grid(self):
         if self.model is None or self.model.grid is None:
@@ -39,7 +39,11 @@ namespace ttcr {
         Cell(const size_t n) : slowness(std::vector<T>(n)) { }
         
         int setSlowness(const std::vector<T>& s) {
-            if ( slowness.size() != s.size() ) {
+            return setSlowness(s.data(), s.size());
+        }
+        
+        int setSlowness(const T* s, const size_t ns) {
+            if ( slowness.size() != ns ) {
                 std::cerr << "Error: slowness vectors of incompatible size.";
                 return 1;
             }
@@ -54,11 +58,21 @@ namespace ttcr {
             return 1;
         }
         
+        int setXi(const T* s, const size_t ns) {
+            std::cerr << "Error: xi not defined for Cell.";
+            return 1;
+        }
+        
         int setTiltAngle(const std::vector<T>& s) {
             std::cerr << "Error: TiltAngle not defined for Cell.";
             return 1;
         }
         
+        int setTiltAngle(const T* s, const size_t ns) {
+            std::cerr << "Error: TiltAngle not defined for Cell.";
+            return 1;
+        }
+        
         int setVp0(const std::vector<T>& s) {
             std::cerr << "Error: Vp0 not defined for Cell.";
             return 1;
@@ -114,7 +128,11 @@ namespace ttcr {
         }
         
         int setSlowness(const std::vector<T>& s) {
-            if ( slowness.size() != s.size() ) {
+            return setSlowness(s.data(), s.size());
+        }
+        
+        int setSlowness(const T* s, const size_t ns) {
+            if ( slowness.size() != ns ) {
                 std::cerr << "Error: slowness vectors of incompatible size.";
                 return 1;
             }
@@ -125,7 +143,11 @@ namespace ttcr {
         }
         
         int setXi(const std::vector<T>& s) {
-            if ( xi.size() != s.size() ) {
+            return setXi(s.data(), s.size());
+        }
+        
+        int setXi(const T* s, const size_t ns) {
+            if ( xi.size() != ns ) {
                 std::cerr << "Error: xi vectors of incompatible size.";
                 return 1;
             }
@@ -140,6 +162,11 @@ namespace ttcr {
             return 1;
         }
         
+        int setTiltAngle(const T* s, const size_t ns) {
+            std::cerr << "Error: TiltAngle not defined for CellElliptical.";
+            return 1;
+        }
+        
         int setVp0(const std::vector<T>& s) {
             std::cerr << "Error: Vp0 not defined for CellElliptical.";
             return 1;
@@ -204,7 +231,11 @@ namespace ttcr {
         }
         
         int setSlowness(const std::vector<T>& s) {
-            if ( slowness.size() != s.size() ) {
+            return setSlowness(s.data(), s.size());
+        }
+        
+        int setSlowness(const T* s, const size_t ns) {
+            if ( slowness.size() != ns ) {
                 std::cerr << "Error: slowness vectors of incompatible size.";
                 return 1;
             }
@@ -215,7 +246,11 @@ namespace ttcr {
         }
         
         int setXi(const std::vector<T>& s) {
-            if ( xi.size() != s.size() ) {
+            return setXi(s.data(), s.size());
+        }
+        
+        int setXi(const T* s, const size_t ns) {
+            if ( xi.size() != ns ) {
                 std::cerr << "Error: xi vectors of incompatible size.";
                 return 1;
             }
@@ -226,7 +261,11 @@ namespace ttcr {
         }
         
         int setTiltAngle(const std::vector<T>& s) {
-            if ( tAngle.size() != s.size() ) {
+            return setTiltAngle(s.data(), s.size());
+        }
+        
+        int setTiltAngle(const T* s, const size_t ns) {
+            if ( tAngle.size() != ns ) {
                 std::cerr << "Error: angle vectors of incompatible size.";
                 return 1;
             }
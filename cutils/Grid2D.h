@@ -81,6 +81,9 @@ namespace ttcr {
         virtual int setSlowness(const std::vector<T1>& s) { return 0; }
         virtual int setXi(const std::vector<T1>& x) { return 1; }
         virtual int setTiltAngle(const std::vector<T1>& x) { return 1; }
+        virtual int setSlowness(const T1* s, const size_t ns) { return 0; }
+        virtual int setXi(const T1* x, const size_t nx) { return 1; }
+        virtual int setTiltAngle(const T1* x, const size_t nx) { return 1; }
         
         
         virtual size_t getNumberOfNodes() const { return 0; }
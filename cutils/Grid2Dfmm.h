@@ -0,0 +1,225 @@
+//
+//  Grid2Dfmm.h
+//  ttcr
+//
+//  Fast marching traveltime computation on regular 2D grids of isotropic cells
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef Grid2Dfmm_h
+#define Grid2Dfmm_h
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <functional>
+#include <iostream>
+#include <limits>
+#include <queue>
+#include <vector>
+
+#include "ttcr_t.h"
+
+namespace ttcr {
+
+    /*
+     Traveltimes are computed at the cell corners (ncx+1 x ncz+1 nodes,
+     z varying fastest), slowness being constant within cells.  A node is
+     updated independently from each cell it belongs to, with the first
+     order upwind solution of the eikonal equation using the two other
+     nodes of the cell lying on the cell edges, or along the edges alone.
+
+     Nodes close to the source are initialized with the traveltime along
+     the straight segment from the source to reduce the error due to the
+     curvature of the wavefront.  Traveltimes at receivers are obtained
+     by bilinear interpolation.
+     */
+    class Grid2Dfmm {
+    public:
+        Grid2Dfmm(const size_t nx, const size_t nz, const double ddx, const double ddz,
+                  const double minx, const double minz, const size_t ninit=2) :
+        ncx(nx), ncz(nz), dx(ddx), dz(ddz), xmin(minx), zmin(minz), nInit(ninit) {}
+
+        size_t getNumberOfNodes() const { return (ncx+1)*(ncz+1); }
+
+        /*
+         Compute traveltimes tt at grid nodes for source Tx, state is a
+         work array; both are resized if needed
+         */
+        void solve(const double* slowness, const sxz<double>& Tx, const double t0,
+                   std::vector<double>& tt, std::vector<uint8_t>& state) const {
+
+            enum : uint8_t { FAR, TRIAL, KNOWN };
+            const size_t nn = getNumberOfNodes();
+            tt.assign( nn, std::numeric_limits<double>::max() );
+            state.assign( nn, FAR );
+
+            typedef std::pair<double, size_t> qelem;
+            std::priority_queue<qelem, std::vector<qelem>, std::greater<qelem>> queue;
+
+            size_t ic = cellIndexX(Tx.x);
+            size_t kc = cellIndexZ(Tx.z);
+            size_t i0 = ic > nInit ? ic-nInit : 0;
+            size_t i1 = std::min(ic+nInit+1, ncx);
+            size_t k0 = kc > nInit ? kc-nInit : 0;
+            size_t k1 = std::min(kc+nInit+1, ncz);
+            for ( size_t i=i0; i<=i1; ++i ) {
+                for ( size_t k=k0; k<=k1; ++k ) {
+                    size_t n = i*(ncz+1) + k;
+                    tt[n] = t0 + straightTime(slowness, Tx, sxz<double>(xmin+i*dx, zmin+k*dz));
+                    state[n] = TRIAL;
+                    queue.push( qelem(tt[n], n) );
+                }
+            }
+
+            while ( !queue.empty() ) {
+                qelem top = queue.top();
+                queue.pop();
+                size_t n = top.second;
+                if ( state[n] == KNOWN || top.first > tt[n] ) continue;
+                state[n] = KNOWN;
+
+                size_t i = n / (ncz+1);
+                size_t k = n % (ncz+1);
+                const size_t nb[4][2] = {{i-1, k}, {i+1, k}, {i, k-1}, {i, k+1}};
+                for ( size_t m=0; m<4; ++m ) {
+                    // unsigned wrap-around makes out of grid neighbours larger than ncx or ncz
+                    if ( nb[m][0] > ncx || nb[m][1] > ncz ) continue;
+                    size_t v = nb[m][0]*(ncz+1) + nb[m][1];
+                    if ( state[v] == KNOWN ) continue;
+                    double t = update(slowness, tt, state, nb[m][0], nb[m][1]);
+                    if ( t < tt[v] ) {
+                        tt[v] = t;
+                        state[v] = TRIAL;
+                        queue.push( qelem(t, v) );
+                    }
+                }
+            }
+        }
+
+        /*
+         Traveltime at pt from the field computed by solve
+         */
+        double interpolate(const double* slowness, const sxz<double>& Tx, const double t0,
+                           const std::vector<double>& tt, const sxz<double>& pt) const {
+            size_t ic = cellIndexX(pt.x);
+            size_t kc = cellIndexZ(pt.z);
+            size_t is = cellIndexX(Tx.x);
+            size_t ks = cellIndexZ(Tx.z);
+            if ( (ic > is ? ic-is : is-ic) <= nInit && (kc > ks ? kc-ks : ks-kc) <= nInit ) {
+                // receiver in the region initialized with straight rays
+                return t0 + straightTime(slowness, Tx, pt);
+            }
+            double u = (pt.x - (xmin+ic*dx)) / dx;
+            double w = (pt.z - (zmin+kc*dz)) / dz;
+            size_t n = ic*(ncz+1) + kc;
+            return (1.0-u)*(1.0-w)*tt[n] + (1.0-u)*w*tt[n+1] +
+                u*(1.0-w)*tt[n+ncz+1] + u*w*tt[n+ncz+2];
+        }
+
+    private:
+        const size_t ncx, ncz;
+        const double dx, dz;
+        const double xmin, zmin;
+        const size_t nInit;  // half width of the region initialized around the source, in cells
+
+        size_t cellIndexX(const double x) const {
+            double f = (x-xmin)/dx;
+            return f <= 0.0 ? 0 : std::min(static_cast<size_t>(f), ncx-1);
+        }
+        size_t cellIndexZ(const double z) const {
+            double f = (z-zmin)/dz;
+            return f <= 0.0 ? 0 : std::min(static_cast<size_t>(f), ncz-1);
+        }
+
+        // new value at node (i,k) from the known nodes of its cells
+        double update(const double* slowness, const std::vector<double>& tt,
+                      const std::vector<uint8_t>& state, const size_t i, const size_t k) const {
+            const uint8_t KNOWN = 2;
+            const double inf = std::numeric_limits<double>::max();
+            const double idx2 = 1.0/(dx*dx);
+            const double idz2 = 1.0/(dz*dz);
+            double tmin = inf;
+            for ( int di=-1; di<=0; ++di ) {
+                if ( (di<0 && i==0) || (di==0 && i==ncx) ) continue;
+                size_t ci = i+di;
+                size_t ia = di<0 ? i-1 : i+1;  // neighbour along x in cell
+                for ( int dk=-1; dk<=0; ++dk ) {
+                    if ( (dk<0 && k==0) || (dk==0 && k==ncz) ) continue;
+                    size_t ck = k+dk;
+                    size_t kb = dk<0 ? k-1 : k+1;  // neighbour along z in cell
+                    double s = slowness[ci*ncz + ck];
+
+                    size_t na = ia*(ncz+1) + k;
+                    size_t nb = i*(ncz+1) + kb;
+                    bool knownA = state[na] == KNOWN;
+                    bool knownB = state[nb] == KNOWN;
+                    if ( knownA ) tmin = std::min(tmin, tt[na] + s*dx);
+                    if ( knownB ) tmin = std::min(tmin, tt[nb] + s*dz);
+                    if ( knownA && knownB ) {
+                        double tA = tt[na];
+                        double tB = tt[nb];
+                        double a = idx2 + idz2;
+                        double b = -2.0*(tA*idx2 + tB*idz2);
+                        double c = tA*tA*idx2 + tB*tB*idz2 - s*s;
+                        double disc = b*b - 4.0*a*c;
+                        if ( disc >= 0.0 ) {
+                            double t = (-b + std::sqrt(disc)) / (2.0*a);
+                            if ( t >= tA && t >= tB ) tmin = std::min(tmin, t);
+                        }
+                    }
+                }
+            }
+            return tmin;
+        }
+
+        // traveltime along the straight segment from p1 to p2
+        double straightTime(const double* slowness, const sxz<double>& p1, const sxz<double>& p2) const {
+            double ddx = p2.x - p1.x;
+            double ddz = p2.z - p1.z;
+            double length = std::sqrt( ddx*ddx + ddz*ddz );
+            if ( length == 0.0 ) return 0.0;
+
+            std::vector<double> u = {0.0, 1.0};
+            if ( ddx != 0.0 ) {
+                for ( size_t i=0; i<=ncx; ++i ) {
+                    double ui = (xmin+i*dx - p1.x) / ddx;
+                    if ( ui > 0.0 && ui < 1.0 ) u.push_back( ui );
+                }
+            }
+            if ( ddz != 0.0 ) {
+                for ( size_t k=0; k<=ncz; ++k ) {
+                    double uk = (zmin+k*dz - p1.z) / ddz;
+                    if ( uk > 0.0 && uk < 1.0 ) u.push_back( uk );
+                }
+            }
+            std::sort( u.begin(), u.end() );
+
+            double t = 0.0;
+            for ( size_t n=1; n<u.size(); ++n ) {
+                double um = 0.5*(u[n] + u[n-1]);
+                size_t c = cellIndexX(p1.x + um*ddx)*ncz + cellIndexZ(p1.z + um*ddz);
+                t += slowness[c] * (u[n] - u[n-1]) * length;
+            }
+            return t;
+        }
+    };
+
+}
+
+#endif /* Grid2Dfmm_h */
@@ -49,6 +49,18 @@ namespace ttcr {
             return cells.setTiltAngle( t );
         }
         
+        virtual int setSlowness(const T1* s, const size_t ns) {
+            return cells.setSlowness( s, ns );
+        }
+        
+        int setXi(const T1* x, const size_t nx) {
+            return cells.setXi( x, nx );
+        }
+        
+        int setTiltAngle(const T1* t, const size_t nt) {
+            return cells.setTiltAngle( t, nt );
+        }
+        
         size_t getNumberOfNodes() const { return nodes.size(); }
         size_t getNumberOfCells() const { return ncx*ncz; }
         
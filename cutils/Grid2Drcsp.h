@@ -995,13 +995,16 @@ namespace ttcr {
                                              const std::vector<Node2Dcsp<T1,T2>>& nodes,
                                              const size_t threadNo) const {
         
-        for ( size_t nn=0; nn<nodes.size(); ++nn ) {
-            if ( nodes[nn] == Rx ) {
-                return nodes[nn].getTT(threadNo);
+        // a node at Rx lies on the boundary of the cell holding Rx, only
+        // the nodes of this cell are searched
+        T2 cellNo = this->getCellNo( Rx );
+        for ( size_t k=0; k< this->neighbors[cellNo].size(); ++k ) {
+            const Node2Dcsp<T1,T2>& node = nodes[ this->neighbors[cellNo][k] ];
+            if ( node == Rx ) {
+                return node.getTT(threadNo);
             }
         }
         
-        T2 cellNo = this->getCellNo( Rx );
         T2 neibNo = this->neighbors[cellNo][0];
         T1 dt = this->cells.computeDt(nodes[neibNo], Rx, cellNo);
         
@@ -1023,15 +1026,16 @@ namespace ttcr {
                                              T2& nodeParentRx, T2& cellParentRx,
                                              const size_t threadNo) const {
         
-        for ( size_t nn=0; nn<nodes.size(); ++nn ) {
-            if ( nodes[nn] == Rx ) {
-                nodeParentRx = nodes[nn].getNodeParent(threadNo);
-                cellParentRx = nodes[nn].getCellParent(threadNo);
-                return nodes[nn].getTT(threadNo);
+        T2 cellNo = this->getCellNo( Rx );
+        for ( size_t k=0; k< this->neighbors[cellNo].size(); ++k ) {
+            const Node2Dcsp<T1,T2>& node = nodes[ this->neighbors[cellNo][k] ];
+            if ( node == Rx ) {
+                nodeParentRx = node.getNodeParent(threadNo);
+                cellParentRx = node.getCellParent(threadNo);
+                return node.getTT(threadNo);
             }
         }
         
-        T2 cellNo = this->getCellNo( Rx );
         T2 neibNo = this->neighbors[cellNo][0];
         T1 dt = this->cells.computeDt(nodes[neibNo], Rx, cellNo);
         
@@ -22,21 +22,56 @@
  *
  */
 
-#include <thread>
+#include <map>
 
+#include "Grid2Dfmm.h"
 #include "Grid2Dttcr.h"
+#include "ttcr_py.h"
 
 using namespace std;
 
 
 namespace ttcr {
 
+    namespace {
+
+        /*
+         Looking for redundants Tx pts, iTx holds the indices of the Rx
+         corresponding to each unique Tx
+         */
+        void groupSources(const vector<sxz<double>>& Tx, const double* tTx,
+                          vector<vector<sxz<double>>>& vTx,
+                          vector<vector<double>>& t0,
+                          vector<vector<size_t>>& iTx) {
+            map<pair<double,double>, size_t> found;
+            for ( size_t ntx=0; ntx<Tx.size(); ++ntx ) {
+                auto ins = found.insert( make_pair(make_pair(Tx[ntx].x, Tx[ntx].z), vTx.size()) );
+                if ( ins.second ) {
+                    vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
+                    t0.push_back( vector<double>(1, tTx[ntx]) );
+                    iTx.push_back( vector<size_t>(1, ntx) );
+                } else {
+                    iTx[ ins.first->second ].push_back( ntx );
+                }
+            }
+        }
+
+        void selectRx(const vector<sxz<double>>& Rx, const vector<size_t>& ind,
+                      vector<sxz<double>>& vRx) {
+            vRx.resize( ind.size() );
+            for ( size_t ni=0; ni<ind.size(); ++ni ) {
+                vRx[ni] = Rx[ ind[ni] ];
+            }
+        }
+    }
+
+
     Grid2Dttcr::Grid2Dttcr(std::string& _type,
                            uint32_t nx, uint32_t nz,
                            double dx, double dz,
                            double xmin, double zmin,
                            uint32_t nsnx, uint32_t nsnz,
-                           size_t nthreads) : type(_type){
+                           size_t nthreads) : type(_type), singlePrecision(false) {
 
         if ( type.compare("iso")==0 ) {
             grid_instance = new gridiso(nx, nz,
@@ -62,126 +97,59 @@ namespace ttcr {
         }
     }
 
-    void Grid2Dttcr::setSlowness(const std::vector<double>& slowness) {
-        if ( grid_instance->setSlowness(slowness) == 1 ) {
+    void Grid2Dttcr::setSlowness(const double* slowness, const size_t n) {
+        if ( grid_instance->setSlowness(slowness, n) == 1 ) {
             throw out_of_range("Slowness values must be defined for each grid cell.");
         }
     }
 
-    void Grid2Dttcr::setXi(const std::vector<double>& xi) {
-        if ( grid_instance->setXi(xi) == 1 ) {
+    void Grid2Dttcr::setXi(const double* xi, const size_t n) {
+        if ( grid_instance->setXi(xi, n) == 1 ) {
             throw out_of_range("Xi values must be defined for each grid cell.");
         }
     }
 
-    void Grid2Dttcr::setTheta(const std::vector<double>& theta) {
-        if ( grid_instance->setTiltAngle(theta) == 1 ) {
+    void Grid2Dttcr::setTheta(const double* theta, const size_t n) {
+        if ( grid_instance->setTiltAngle(theta, n) == 1 ) {
             throw out_of_range("Theta values must be defined for each grid cell.");
         }
     }
 
+    template<typename F>
+    void Grid2Dttcr::runSources(const size_t nsrc, F raytraceSource) const {
+        py::runSources(grid_instance->getNthreads(), nsrc, threadTimes, threadSources, raytraceSource);
+    }
+
     int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
-                             const std::vector<double>& tTx,
+                             const double* tTx,
                              const std::vector<sxz<double>>& Rx,
                              double* traveltimes,
                              PyObject* rays,
                              PyObject* L) const {
 
-        // rays must be a pointer to a tuple object of size nRx
-
-        /*
-         Looking for redundants Tx pts
-         */
+        // rays must be a pointer to a tuple object of size 2
 
         size_t nTx = Tx.size();
-        size_t nRx = Rx.size();
         vector<vector<sxz<double>>> vTx;
         vector<vector<double>> t0;
         vector<vector<size_t>> iTx;
-        vTx.push_back( vector<sxz<double> >(1, Tx[0]) );
-        t0.push_back( vector<double>(1, tTx[0]) );
-        iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
-        for ( size_t ntx=1; ntx<nTx; ++ntx ) {
-            bool found = false;
-
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-                if ( vTx[nv][0]==Tx[ntx] ) {
-                    found = true;
-                    iTx[nv].push_back( ntx ) ;
-                    break;
-                }
-            }
-            if ( !found ) {
-                vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
-                t0.push_back( vector<double>(1, tTx[ntx]) );
-                iTx.push_back( vector<size_t>(1, ntx) );
-            }
-        }
+        groupSources(Tx, tTx, vTx, t0, iTx);
 
         /*
          Looping over all non redundant Tx
          */
 
-        vector<sxz<double>> vRx;
         vector<vector<double>> tt( vTx.size() );
         vector<vector<vector<sxz<double>>>> r_data( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
         vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
 
-        if ( grid_instance->getNthreads() == 1 || grid_instance->getNthreads()<= vTx.size() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-
-                vRx.resize( 0 );
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
+        runSources(vTx.size(), [&](const size_t nv, const size_t threadNo) {
+            vector<sxz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], threadNo) == 1 ) {
+                throw runtime_error("Problem while raytracing.");
             }
-        } else {
-            size_t num_threads = grid_instance->getNthreads();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
-
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
-
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &r_data,&l_data,blk_start,blk_end,i]{
-
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
-
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
-                    }
-                });
-
-                blk_start = blk_end;
-            }
-
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], r_data[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
-            }
-
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
-        }
+        });
 
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
@@ -190,218 +158,102 @@ namespace ttcr {
         }
 
         // rays
-        import_array();  // to use PyArray_SimpleNewFromData
-
+        vector<const vector<sxz<double>>*> r_rows(nTx);
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                size_t npts = r_data[nv][ni].size();
-                npy_intp dims[] = {static_cast<npy_intp>(npts), 2};
-                double* ray_p = new double[2*npts];
-                PyObject* ray = PyArray_SimpleNewFromData(2, dims, NPY_DOUBLE, ray_p);
-                PyArray_ENABLEFLAGS((PyArrayObject*)ray, NPY_ARRAY_OWNDATA);
-
-                for ( size_t np=0; np<npts; ++np ) {
-                    ray_p[2*np] = r_data[nv][ni][np].x;
-                    ray_p[2*np+1] = r_data[nv][ni][np].z;
-                }
-
-                PyTuple_SetItem(rays, iTx[nv][ni], ray);
+                r_rows[ iTx[nv][ni] ] = &(r_data[nv][ni]);
             }
         }
+        if ( py::buildRays(r_rows, 2, rays) != 0 ) {
+            return 1;
+        }
 
         // L
         // first element of tuple contains data, size is nnz
         // second element contains column indices for rows of the matrix, size is nnz
         // third element contains pointers for indices, size is nrow+1 (nTx+1)
 
+        vector<const vector<siv2<double>>*> L_rows(nTx);
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
+                L_rows[ iTx[nv][ni] ] = &(l_data[nv][ni]);
             }
         }
 
-        size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
-            nnz += L_data[n].size();
-        }
-        size_t ncell = grid_instance->getNumberOfCells();
-
-        if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
-                    }
-                }
-            }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
-
-        } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
-                }
-            }
-            indptr_p[nTx] = k;
-
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
-        }
-
-        return 0;
+        return py::buildL(L_rows, grid_instance->getNumberOfCells(), type.compare("iso")!=0, L, singlePrecision);
     }
 
     int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
-                             const std::vector<double>& tTx,
+                             const double* tTx,
                              const std::vector<sxz<double>>& Rx,
                              double* traveltimes,
                              PyObject* L) const {
 
-        /*
-         Looking for redundants Tx pts
-         */
-
         size_t nTx = Tx.size();
-        size_t nRx = Rx.size();
         vector<vector<sxz<double>>> vTx;
         vector<vector<double>> t0;
         vector<vector<size_t>> iTx;
-        vTx.push_back( vector<sxz<double> >(1, Tx[0]) );
-        t0.push_back( vector<double>(1, tTx[0]) );
-        iTx.push_back( vector<size_t>(1, 0) );  // indices of Rx corresponding to current Tx
-        for ( size_t ntx=1; ntx<nTx; ++ntx ) {
-            bool found = false;
-
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-                if ( vTx[nv][0]==Tx[ntx] ) {
-                    found = true;
-                    iTx[nv].push_back( ntx ) ;
-                    break;
-                }
-            }
-            if ( !found ) {
-                vTx.push_back( vector<sxz<double>>(1, Tx[ntx]) );
-                t0.push_back( vector<double>(1, tTx[ntx]) );
-                iTx.push_back( vector<size_t>(1, ntx) );
-            }
-        }
+        groupSources(Tx, tTx, vTx, t0, iTx);
 
         /*
          Looping over all non redundant Tx
          */
 
-        vector<sxz<double>> vRx;
         vector<vector<double>> tt( vTx.size() );
-        vector<vector<siv2<double>>> L_data(nTx);
         vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
 
-        if ( grid_instance->getNthreads() == 1 || vTx.size()<=grid_instance->getNthreads() ) {
-            for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+        runSources(vTx.size(), [&](const size_t nv, const size_t threadNo) {
+            vector<sxz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], threadNo) == 1 ) {
+                throw runtime_error("Problem while raytracing.");
+            }
+        });
 
-                vRx.resize( 0 );
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
 
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv]) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
+        // L
+        // first element of tuple contains data, size is nnz
+        // second element contains column indices for rows of the matrix, size is nnz
+        // third element contains pointers for indices, size is nrow+1 (nTx+1)
+
+        vector<const vector<siv2<double>>*> L_rows(nTx);
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                L_rows[ iTx[nv][ni] ] = &(l_data[nv][ni]);
             }
-        } else {
-            size_t num_threads = grid_instance->getNthreads() < vTx.size() ? grid_instance->getNthreads() : vTx.size();
-            size_t blk_size = vTx.size()/num_threads;
-            if ( blk_size == 0 ) blk_size++;
+        }
 
-            vector<thread> threads(num_threads-1);
-            size_t blk_start = 0;
-            for ( size_t i=0; i<num_threads-1; ++i ) {
+        return py::buildL(L_rows, grid_instance->getNumberOfCells(), type.compare("iso")!=0, L, singlePrecision);
+    }
 
-                size_t blk_end = blk_start + blk_size;
-                grid *grid_ref = grid_instance;
-                threads[i]=thread( [&grid_ref,&vTx,&tt,&t0,&Rx,&iTx,&nRx,
-                                    &l_data,blk_start,blk_end,i]{
+    int Grid2Dttcr::raytrace(const std::vector<sxz<double>>& Tx,
+                             const double* tTx,
+                             const std::vector<sxz<double>>& Rx,
+                             double* traveltimes) const {
 
-                    for ( size_t nv=blk_start; nv<blk_end; ++nv ) {
+        vector<vector<sxz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupSources(Tx, tTx, vTx, t0, iTx);
 
-                        vector<sxz<double>> vRx;
-                        for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                            vRx.push_back( Rx[ iTx[nv][ni] ] );
-                        }
-                        if ( grid_ref->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], i+1) == 1 ) {
-                            throw runtime_error("Problem while raytracing.");
-                        }
-                    }
-                });
+        /*
+         Looping over all non redundant Tx
+         */
 
-                blk_start = blk_end;
-            }
+        vector<vector<double>> tt( vTx.size() );
 
-            for ( size_t nv=blk_start; nv<vTx.size(); ++nv ) {
-                vector<sxz<double>> vRx;
-                for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                    vRx.push_back( Rx[ iTx[nv][ni] ] );
-                }
-                if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], l_data[nv], 0) == 1 ) {
-                    throw runtime_error("Problem while raytracing.");
-                }
+        runSources(vTx.size(), [&](const size_t nv, const size_t threadNo) {
+            vector<sxz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            if ( grid_instance->raytrace(vTx[nv], t0[nv], vRx, tt[nv], threadNo) == 1 ) {
+                throw runtime_error("Problem while raytracing.");
             }
-
-            std::for_each(threads.begin(),threads.end(),
-                          std::mem_fn(&std::thread::join));
-        }
+        });
 
         for ( size_t nv=0; nv<vTx.size(); ++nv ) {
             for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
@@ -409,99 +261,43 @@ namespace ttcr {
             }
         }
 
-        import_array();  // to use PyArray_SimpleNewFromData
+        return 0;
+    }
 
-        // L
-        // first element of tuple contains data, size is nnz
-        // second element contains column indices for rows of the matrix, size is nnz
-        // third element contains pointers for indices, size is nrow+1 (nTx+1)
+    int Grid2Dttcr::raytraceFMM(const double* slowness,
+                                const size_t n,
+                                const std::vector<sxz<double>>& Tx,
+                                const double* tTx,
+                                const std::vector<sxz<double>>& Rx,
+                                double* traveltimes) const {
 
-        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
-            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
-                L_data[ iTx[nv][ni] ] = l_data[nv][ni];
-            }
+        if ( type.compare("iso")!=0 ) {
+            throw invalid_argument("Fast marching is only available for isotropic media.");
         }
-
-        size_t nnz = 0;
-        for ( size_t n=0; n<L_data.size(); ++n ) {
-            nnz += L_data[n].size();
+        if ( n != grid_instance->getNumberOfCells() ) {
+            throw out_of_range("Slowness values must be defined for each grid cell.");
         }
-        size_t ncell = grid_instance->getNumberOfCells();
 
-        if ( type.compare("iso")==0 ) {
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }
-                    }
-                }
-            }
-            indptr_p[nTx] = k;
+        Grid2Dfmm fmm(grid_instance->getNcx(), grid_instance->getNcz(),
+                      grid_instance->getDx(), grid_instance->getDz(),
+                      grid_instance->getXmin(), grid_instance->getZmin());
 
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
+        vector<vector<sxz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupSources(Tx, tTx, vTx, t0, iTx);
 
-        } else {
-            nnz *= 2;
-
-            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-            double* data_p = new double[nnz];
-            PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-
-            int64_t* indices_p = new int64_t[nnz];
-            PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-
-            dims[0] = nTx+1;
-            int64_t* indptr_p = new int64_t[nTx+1];
-            PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-            PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-
-            size_t k = 0;
-            for ( size_t i=0; i<nTx; ++i ) {
-                indptr_p[i] = k;
-                for ( size_t j=0; j<2*ncell; ++j ) {
-                    for ( size_t n=0; n<L_data[i].size(); ++n ) {
-                        if ( L_data[i][n].i == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v;
-                            k++;
-                        }	else if ( L_data[i][n].i+ncell == j ) {
-                            indices_p[k] = j;
-                            data_p[k] = L_data[i][n].v2;
-                            k++;
-                        }
-                    }
-                }
-            }
-            indptr_p[nTx] = k;
+        // one traveltime field per thread
+        vector<vector<double>> tt( grid_instance->getNthreads() );
+        vector<vector<uint8_t>> state( grid_instance->getNthreads() );
 
-            PyTuple_SetItem(L, 0, data);
-            PyTuple_SetItem(L, 1, indices);
-            PyTuple_SetItem(L, 2, indptr);
-        }
+        runSources(vTx.size(), [&](const size_t nv, const size_t threadNo) {
+            fmm.solve(slowness, vTx[nv][0], t0[nv][0], tt[threadNo], state[threadNo]);
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = fmm.interpolate(slowness, vTx[nv][0], t0[nv][0],
+                                                             tt[threadNo], Rx[ iTx[nv][ni] ]);
+            }
+        });
 
         return 0;
     }
@@ -518,17 +314,16 @@ namespace ttcr {
         const double  small=1.e-10;
 
         size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
-        double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
 
-        double* data_p = (double*)malloc( nLmax*sizeof(double) );
-        int64_t* indices_p = (int64_t*)malloc( nLmax*sizeof(int64_t) );
-        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+        vector<double> data_p;
+        vector<int64_t> indices_p;
+        vector<size_t> indptr_p(nTx+1);
+        data_p.reserve( nTx * (n_grx+n_grz) / 2 );
+        indices_p.reserve( nTx * (n_grx+n_grz) / 2 );
 
-        size_t k = 0;
         size_t ix, iz;
         for ( size_t n=0; n<nTx; ++n ) {
-            indptr_p[n] = k;
+            indptr_p[n] = data_p.size();
 
             double xs = Tx[2*n];
             double zs = Tx[2*n+1];
@@ -558,21 +353,8 @@ namespace ttcr {
 
                     double dlx = ( grx[ix+1]<xr ? grx[ix+1] : xr ) - x;
 
-                    indices_p[k] = iCell;
-                    data_p[k] = dlx;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
+                    indices_p.push_back( iCell );
+                    data_p.push_back( dlx );
 
                     ix++;
                     x = grx[ix];
@@ -594,21 +376,8 @@ namespace ttcr {
 
                     double dlz = ( grz[iz+1]<zr ? grz[iz+1] : zr ) - z;
 
-                    indices_p[k] = iCell;
-                    data_p[k] = dlz;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
+                    indices_p.push_back( iCell );
+                    data_p.push_back( dlz );
 
                     iz++;
                     z = grz[iz];
@@ -638,21 +407,8 @@ namespace ttcr {
                             double dlz = ze - z;
                             double dl = sqrt( dlx*dlx + dlz*dlz );
 
-                            indices_p[k] = iCell;
-                            data_p[k] = dl;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 1 */
-                                if (oldnzmax == nLmax) nLmax++;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
+                            indices_p.push_back( iCell );
+                            data_p.push_back( dl );
 
                             x = xe;
                             z = ze;
@@ -669,21 +425,8 @@ namespace ttcr {
                             double dlz = ze - z;
                             double dl = sqrt( dlx*dlx + dlz*dlz );
 
-                            indices_p[k] = iCell;
-                            data_p[k] = dl;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 1 */
-                                if (oldnzmax == nLmax) nLmax++;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
+                            indices_p.push_back( iCell );
+                            data_p.push_back( dl );
 
                             x = xe;
                             z = ze;
@@ -696,28 +439,9 @@ namespace ttcr {
                 }
             }
         }
+        indptr_p[nTx] = data_p.size();
 
-        indptr_p[nTx] = k;
-        size_t nnz = k;
-
-        data_p = (double*)realloc( data_p, nnz*sizeof(double) );
-        indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
-
-        import_array();  // to use PyArray_SimpleNewFromData
-
-        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-        dims[0] = nTx+1;
-        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-        PyTuple_SetItem(L, 0, data);
-        PyTuple_SetItem(L, 1, indices);
-        PyTuple_SetItem(L, 2, indptr);
-
-        return 0;
+        return py::buildL(data_p, indices_p, indptr_p, nCells, L);
     }
 
 
@@ -733,17 +457,16 @@ namespace ttcr {
         const double  small=1.e-10;
 
         size_t nCells = (n_grx-1)*(n_grz-1);
-        size_t nLmax = nTx * n_grx * n_grz/2;
-        double percent_sp = (nLmax*1.0)/(nTx*nCells*1.0);
 
-        double* data_p = (double*)malloc( nLmax*sizeof(double) );
-        int64_t* indices_p = (int64_t*)malloc( nLmax*sizeof(int64_t) );
-        int64_t* indptr_p = (int64_t*)malloc( (nTx+1)*sizeof(int64_t) );
+        vector<double> data_p;
+        vector<int64_t> indices_p;
+        vector<size_t> indptr_p(nTx+1);
+        data_p.reserve( nTx * (n_grx+n_grz) );
+        indices_p.reserve( nTx * (n_grx+n_grz) );
 
-        size_t k = 0;
         size_t ix, iz;
         for ( size_t n=0; n<nTx; ++n ) {
-            indptr_p[n] = k;
+            indptr_p[n] = data_p.size();
 
             double xs = Tx[2*n];
             double zs = Tx[2*n+1];
@@ -773,21 +496,8 @@ namespace ttcr {
 
                     double dlx = ( grx[ix+1]<xr ? grx[ix+1] : xr ) - x;
 
-                    indices_p[k] = iCell;
-                    data_p[k] = dlx;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
+                    indices_p.push_back( iCell );
+                    data_p.push_back( dlx );
 
                     ix++;
                     x = grx[ix];
@@ -809,21 +519,8 @@ namespace ttcr {
 
                     double dlz = ( grz[iz+1]<zr ? grz[iz+1] : zr ) - z;
 
-                    indices_p[k] = iCell+nCells;
-                    data_p[k] = dlz;
-                    k++;
-
-                    if (k>=nLmax){
-                        size_t oldnzmax = nLmax;
-                        percent_sp += 0.1;
-                        nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                        /* make sure nzmax increases at least by 1 */
-                        if (oldnzmax == nLmax) nLmax++;
-
-                        data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                        indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                    }
+                    indices_p.push_back( iCell+nCells );
+                    data_p.push_back( dlz );
 
                     iz++;
                     z = grz[iz];
@@ -838,6 +535,11 @@ namespace ttcr {
                 for ( ix=0; ix<n_grx-1; ++ix ) if ( x < grx[ix+1] ) break;
                 for ( iz=0; iz<n_grz-1; ++iz ) if ( z < grz[iz+1] ) break;
 
+                // lengths along z are stored after lengths along x to keep
+                // column indices sorted within the row
+                vector<int64_t> iz_cells;
+                vector<double> iz_data;
+
                 while ( x < xr ) {
 
                     double zi = m*grx[ix+1] + b;
@@ -852,24 +554,10 @@ namespace ttcr {
                             double dlx = xe - x;
                             double dlz = ze - z;
 
-                            indices_p[k] = iCell;
-                            data_p[k] = dlx;
-                            k++;
-                            indices_p[k] = iCell+nCells;
-                            data_p[k] = dlz;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 2 */
-                                if (oldnzmax == nLmax) nLmax+=2;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
+                            indices_p.push_back( iCell );
+                            data_p.push_back( dlx );
+                            iz_cells.push_back( iCell+nCells );
+                            iz_data.push_back( dlz );
 
                             x = xe;
                             z = ze;
@@ -885,24 +573,10 @@ namespace ttcr {
                             double dlx = xe - x;
                             double dlz = ze - z;
 
-                            indices_p[k] = iCell;
-                            data_p[k] = dlx;
-                            k++;
-                            indices_p[k] = iCell+nCells;
-                            data_p[k] = dlz;
-                            k++;
-
-                            if (k>=nLmax){
-                                size_t oldnzmax = nLmax;
-                                percent_sp += 0.1;
-                                nLmax = (size_t)ceil((double)nTx*(double)nCells*percent_sp);
-
-                                /* make sure nzmax increases at least by 2 */
-                                if (oldnzmax == nLmax) nLmax+=2;
-
-                                data_p = (double*)realloc( data_p, nLmax*sizeof(double) );
-                                indices_p = (int64_t*)realloc( indices_p, nLmax*sizeof(int64_t) );
-                            }
+                            indices_p.push_back( iCell );
+                            data_p.push_back( dlx );
+                            iz_cells.push_back( iCell+nCells );
+                            iz_data.push_back( dlz );
 
                             x = xe;
                             z = ze;
@@ -913,28 +587,12 @@ namespace ttcr {
                     ix++;
                     x = grx[ix];
                 }
+                indices_p.insert( indices_p.end(), iz_cells.begin(), iz_cells.end() );
+                data_p.insert( data_p.end(), iz_data.begin(), iz_data.end() );
             }
         }
-        indptr_p[nTx] = k;
-        size_t nnz = k;
-
-        data_p = (double*)realloc( data_p, nnz*sizeof(double) );
-        indices_p = (int64_t*)realloc( indices_p, nnz*sizeof(int64_t) );
-
-        import_array();  // to use PyArray_SimpleNewFromData
-
-        npy_intp dims[] = {static_cast<npy_intp>(nnz)};
-        PyObject* data = PyArray_SimpleNewFromData(1, dims, NPY_DOUBLE, data_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)data, NPY_ARRAY_OWNDATA);
-        PyObject* indices = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indices_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indices, NPY_ARRAY_OWNDATA);
-        dims[0] = nTx+1;
-        PyObject* indptr = PyArray_SimpleNewFromData(1, dims, NPY_INT64, indptr_p);
-        PyArray_ENABLEFLAGS((PyArrayObject*)indptr, NPY_ARRAY_OWNDATA);
-        PyTuple_SetItem(L, 0, data);
-        PyTuple_SetItem(L, 1, indices);
-        PyTuple_SetItem(L, 2, indptr);
+        indptr_p[nTx] = data_p.size();
 
-        return 0;
+        return py::buildL(data_p, indices_p, indptr_p, 2*nCells, L);
     }
 }
@@ -52,24 +52,40 @@ namespace ttcr {
             delete grid_instance;
         }
         std::string getType() const { return type; }
+
+        // if true, L is returned with float32 data
+        void setSinglePrecision(const bool s) { singlePrecision = s; }
         
-        void setSlowness(const std::vector<double>& slowness);
-        void setXi(const std::vector<double>& xi);
-        void setTheta(const std::vector<double>& theta);
+        void setSlowness(const double* slowness, const size_t n);
+        void setXi(const double* xi, const size_t n);
+        void setTheta(const double* theta, const size_t n);
         
         int raytrace(const std::vector<sxz<double>>& Tx,
-                     const std::vector<double>& tTx,
+                     const double* tTx,
                      const std::vector<sxz<double>>& Rx,
                      double* traveltimes,
                      PyObject* rays,
                      PyObject* L) const;
         
         int raytrace(const std::vector<sxz<double>>& Tx,
-                     const std::vector<double>& tTx,
+                     const double* tTx,
                      const std::vector<sxz<double>>& Rx,
                      double* traveltimes,
                      PyObject* L) const;
         
+        int raytrace(const std::vector<sxz<double>>& Tx,
+                     const double* tTx,
+                     const std::vector<sxz<double>>& Rx,
+                     double* traveltimes) const;
+        
+        // traveltimes computed with the fast marching method (isotropic media only)
+        int raytraceFMM(const double* slowness,
+                        const size_t n,
+                        const std::vector<sxz<double>>& Tx,
+                        const double* tTx,
+                        const std::vector<sxz<double>>& Rx,
+                        double* traveltimes) const;
+        
         static int Lsr2d(const double* Tx,
                           const double* Rx,
                           const size_t nTx,
@@ -88,10 +104,21 @@ namespace ttcr {
 						   const size_t n_grz,
 						   PyObject* L);
 
+        
+        // wall time and number of sources processed by each thread during
+        // the last call to raytrace
+        const std::vector<double>& getThreadTimes() const { return threadTimes; }
+        const std::vector<size_t>& getThreadSources() const { return threadSources; }
 		
     private:
         const std::string type;
         grid *grid_instance;
+        bool singlePrecision;
+        mutable std::vector<double> threadTimes;
+        mutable std::vector<size_t> threadSources;
+        
+        template<typename F>
+        void runSources(const size_t nsrc, F raytraceSource) const;
 		
         Grid2Dttcr() {}
     };
@@ -0,0 +1,700 @@
+//
+//  Grid3Dttcr.cpp
+//  ttcr
+//
+//  Shortest-path raytracing on regular 3D grids of isotropic cells
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#include <cmath>
+#include <functional>
+#include <map>
+#include <queue>
+#include <stdexcept>
+#include <tuple>
+
+#include "Grid3Dttcr.h"
+#include "ttcr_py.h"
+
+using namespace std;
+
+
+namespace ttcr {
+
+    namespace {
+
+        const double tol = 1.e-8;  // relative to cell size
+
+        /*
+         Looking for redundants Tx pts, iTx holds the indices of the Rx
+         corresponding to each unique Tx
+         */
+        void groupSources(const vector<sxyz<double>>& Tx, const double* tTx,
+                          vector<vector<sxyz<double>>>& vTx,
+                          vector<vector<double>>& t0,
+                          vector<vector<size_t>>& iTx) {
+            map<tuple<double,double,double>, size_t> found;
+            for ( size_t ntx=0; ntx<Tx.size(); ++ntx ) {
+                auto ins = found.insert( make_pair(make_tuple(Tx[ntx].x, Tx[ntx].y, Tx[ntx].z), vTx.size()) );
+                if ( ins.second ) {
+                    vTx.push_back( vector<sxyz<double>>(1, Tx[ntx]) );
+                    t0.push_back( vector<double>(1, tTx[ntx]) );
+                    iTx.push_back( vector<size_t>(1, ntx) );
+                } else {
+                    iTx[ ins.first->second ].push_back( ntx );
+                }
+            }
+        }
+
+        void selectRx(const vector<sxyz<double>>& Rx, const vector<size_t>& ind,
+                      vector<sxyz<double>>& vRx) {
+            vRx.resize( ind.size() );
+            for ( size_t ni=0; ni<ind.size(); ++ni ) {
+                vRx[ni] = Rx[ ind[ni] ];
+            }
+        }
+
+        /*
+         Range of cells [i0, i1] whose closed interval contains coordinate x,
+         returns false if x is outside the grid
+         */
+        bool cellRange(const double x, const double xmin, const double d,
+                       const uint32_t nc, uint32_t& i0, uint32_t& i1) {
+            double f = (x-xmin)/d;
+            if ( f < -tol || f > nc+tol ) return false;
+            double f0 = floor(f-tol);
+            double f1 = floor(f+tol);
+            i0 = f0 < 0.0 ? 0 : ( f0 > nc-1 ? nc-1 : static_cast<uint32_t>(f0) );
+            i1 = f1 < 0.0 ? 0 : ( f1 > nc-1 ? nc-1 : static_cast<uint32_t>(f1) );
+            return true;
+        }
+
+        // sort a row of (cell, length) pairs by cell index and merge duplicates
+        void compactRow(vector<siv2<double>>& row) {
+            sort(row.begin(), row.end(), [](const siv2<double>& a, const siv2<double>& b) { return a.i < b.i; });
+            size_t k = 0;
+            for ( size_t n=0; n<row.size(); ++n ) {
+                if ( k>0 && row[k-1].i == row[n].i ) {
+                    row[k-1] += row[n];
+                } else {
+                    row[k++] = row[n];
+                }
+            }
+            row.resize( k );
+        }
+    }
+
+
+    Grid3Dttcr::Grid3Dttcr(uint32_t nx, uint32_t ny, uint32_t nz,
+                           double _dx, double _dy, double _dz,
+                           double _xmin, double _ymin, double _zmin,
+                           uint32_t _nsnx, uint32_t _nsny, uint32_t _nsnz,
+                           size_t nthreads) :
+    ncx(nx), ncy(ny), ncz(nz), dx(_dx), dy(_dy), dz(_dz),
+    xmin(_xmin), ymin(_ymin), zmin(_zmin), nsnx(_nsnx), nsny(_nsny), nsnz(_nsnz),
+    nThreads(nthreads > 0 ? nthreads : 1), singlePrecision(false) {
+
+        if ( ncx == 0 || ncy == 0 || ncz == 0 ) {
+            throw invalid_argument("Grid should have at least one cell along each dimension.");
+        }
+
+        size_t nx1 = static_cast<size_t>(ncx)+1;
+        size_t ny1 = static_cast<size_t>(ncy)+1;
+        size_t nz1 = static_cast<size_t>(ncz)+1;
+        offX = nx1*ny1*nz1;
+        offY = offX + ncx*ny1*nz1*nsnx;
+        offZ = offY + nx1*ncy*nz1*nsny;
+        offFX = offZ + nx1*ny1*ncz*nsnz;
+        offFY = offFX + nx1*ncy*ncz*nsny*nsnz;
+        offFZ = offFY + ncx*ny1*ncz*nsnx*nsnz;
+        nNodes = offFZ + ncx*ncy*nz1*nsnx*nsny;
+        // the largest values of parent are reserved for sources
+        if ( nNodes >= numeric_limits<uint32_t>::max()/2 ) {
+            throw length_error("Too many nodes, decrease the number of secondary nodes.");
+        }
+
+        for ( uint32_t di=0; di<2; ++di ) {
+            for ( uint32_t dj=0; dj<2; ++dj ) {
+                for ( uint32_t dk=0; dk<2; ++dk ) {
+                    cellNodes.push_back( {PRIMARY, di, dj, dk, 0, di*dx, dj*dy, dk*dz} );
+                }
+            }
+        }
+        for ( uint32_t da=0; da<2; ++da ) {
+            for ( uint32_t db=0; db<2; ++db ) {
+                for ( uint32_t s=0; s<nsnx; ++s ) {
+                    cellNodes.push_back( {XEDGE, 0, da, db, s, dx*(s+1.0)/(nsnx+1.0), da*dy, db*dz} );
+                }
+                for ( uint32_t s=0; s<nsny; ++s ) {
+                    cellNodes.push_back( {YEDGE, da, 0, db, s, da*dx, dy*(s+1.0)/(nsny+1.0), db*dz} );
+                }
+                for ( uint32_t s=0; s<nsnz; ++s ) {
+                    cellNodes.push_back( {ZEDGE, da, db, 0, s, da*dx, db*dy, dz*(s+1.0)/(nsnz+1.0)} );
+                }
+            }
+        }
+        for ( uint32_t da=0; da<2; ++da ) {
+            for ( uint32_t a=0; a<nsny; ++a ) {
+                for ( uint32_t b=0; b<nsnz; ++b ) {
+                    cellNodes.push_back( {XFACE, da, 0, 0, a*nsnz+b,
+                        da*dx, dy*(a+1.0)/(nsny+1.0), dz*(b+1.0)/(nsnz+1.0)} );
+                }
+            }
+            for ( uint32_t a=0; a<nsnx; ++a ) {
+                for ( uint32_t b=0; b<nsnz; ++b ) {
+                    cellNodes.push_back( {YFACE, 0, da, 0, a*nsnz+b,
+                        dx*(a+1.0)/(nsnx+1.0), da*dy, dz*(b+1.0)/(nsnz+1.0)} );
+                }
+            }
+            for ( uint32_t a=0; a<nsnx; ++a ) {
+                for ( uint32_t b=0; b<nsny; ++b ) {
+                    cellNodes.push_back( {ZFACE, 0, 0, da, a*nsny+b,
+                        dx*(a+1.0)/(nsnx+1.0), dy*(b+1.0)/(nsny+1.0), da*dz} );
+                }
+            }
+        }
+    }
+
+    void Grid3Dttcr::setSlowness(const double* s, const size_t n) {
+        if ( n != getNumberOfCells() ) {
+            throw out_of_range("Slowness values must be defined for each grid cell.");
+        }
+        slowness.assign( s, s+n );
+    }
+
+    size_t Grid3Dttcr::nodeIndex(const NodeType type, const size_t i, const size_t j,
+                                 const size_t k, const size_t s) const {
+        switch ( type ) {
+            case PRIMARY:
+                return (i*(ncy+1) + j)*(ncz+1) + k;
+            case XEDGE:
+                return offX + ((i*(ncy+1) + j)*(ncz+1) + k)*nsnx + s;
+            case YEDGE:
+                return offY + ((i*ncy + j)*(ncz+1) + k)*nsny + s;
+            case ZEDGE:
+                return offZ + ((i*(ncy+1) + j)*ncz + k)*nsnz + s;
+            case XFACE:
+                return offFX + ((i*ncy + j)*ncz + k)*nsny*nsnz + s;
+            case YFACE:
+                return offFY + ((i*(ncy+1) + j)*ncz + k)*nsnx*nsnz + s;
+            default:
+                return offFZ + ((i*ncy + j)*(ncz+1) + k)*nsnx*nsny + s;
+        }
+    }
+
+    Grid3Dttcr::NodeType Grid3Dttcr::decodeNode(const size_t n, size_t& i, size_t& j,
+                                                size_t& k, size_t& s) const {
+        // inverse of nodeIndex: (i, j, k) is the corner, edge or face index
+        NodeType type;
+        size_t e, ny, nz, ns;
+        if ( n < offX ) {
+            type = PRIMARY; e = n; ny = ncy+1; nz = ncz+1; ns = 1;
+        } else if ( n < offY ) {
+            type = XEDGE; e = n-offX; ny = ncy+1; nz = ncz+1; ns = nsnx;
+        } else if ( n < offZ ) {
+            type = YEDGE; e = n-offY; ny = ncy; nz = ncz+1; ns = nsny;
+        } else if ( n < offFX ) {
+            type = ZEDGE; e = n-offZ; ny = ncy+1; nz = ncz; ns = nsnz;
+        } else if ( n < offFY ) {
+            type = XFACE; e = n-offFX; ny = ncy; nz = ncz; ns = static_cast<size_t>(nsny)*nsnz;
+        } else if ( n < offFZ ) {
+            type = YFACE; e = n-offFY; ny = ncy+1; nz = ncz; ns = static_cast<size_t>(nsnx)*nsnz;
+        } else {
+            type = ZFACE; e = n-offFZ; ny = ncy; nz = ncz+1; ns = static_cast<size_t>(nsnx)*nsny;
+        }
+        s = e % ns;
+        e /= ns;
+        k = e % nz;
+        j = (e / nz) % ny;
+        i = e / (nz*ny);
+        return type;
+    }
+
+    sxyz<double> Grid3Dttcr::nodeCoord(const size_t n) const {
+        size_t i, j, k, s;
+        double x, y, z;
+        NodeType type = decodeNode(n, i, j, k, s);
+        x = i;
+        y = j;
+        z = k;
+        switch ( type ) {
+            case PRIMARY:
+                break;
+            case XEDGE:
+                x += (s+1.0)/(nsnx+1.0);
+                break;
+            case YEDGE:
+                y += (s+1.0)/(nsny+1.0);
+                break;
+            case ZEDGE:
+                z += (s+1.0)/(nsnz+1.0);
+                break;
+            case XFACE:
+                y += (s/nsnz+1.0)/(nsny+1.0);
+                z += (s%nsnz+1.0)/(nsnz+1.0);
+                break;
+            case YFACE:
+                x += (s/nsnz+1.0)/(nsnx+1.0);
+                z += (s%nsnz+1.0)/(nsnz+1.0);
+                break;
+            default:
+                x += (s/nsny+1.0)/(nsnx+1.0);
+                y += (s%nsny+1.0)/(nsny+1.0);
+                break;
+        }
+        return sxyz<double>(xmin+x*dx, ymin+y*dy, zmin+z*dz);
+    }
+
+    void Grid3Dttcr::nodeCells(const size_t n, vector<size_t>& cells) const {
+        // cells sharing node n, found from the range of cells along each
+        // dimension (a node on an x edge belongs to a single cell along x,
+        // a node on a face normal to x to a single cell along y and z, etc.)
+        size_t i, j, k, s;
+        NodeType type = decodeNode(n, i, j, k, s);
+        bool alongX = type == XEDGE || type == YFACE || type == ZFACE;
+        bool alongY = type == YEDGE || type == XFACE || type == ZFACE;
+        bool alongZ = type == ZEDGE || type == XFACE || type == YFACE;
+        size_t i0 = ( alongX || i == 0 ) ? i : i-1;
+        size_t i1 = ( alongX || i == ncx ) ? ( i < ncx ? i : ncx-1 ) : i;
+        size_t j0 = ( alongY || j == 0 ) ? j : j-1;
+        size_t j1 = ( alongY || j == ncy ) ? ( j < ncy ? j : ncy-1 ) : j;
+        size_t k0 = ( alongZ || k == 0 ) ? k : k-1;
+        size_t k1 = ( alongZ || k == ncz ) ? ( k < ncz ? k : ncz-1 ) : k;
+        if ( i0 >= ncx ) i0 = ncx-1;
+        if ( j0 >= ncy ) j0 = ncy-1;
+        if ( k0 >= ncz ) k0 = ncz-1;
+
+        cells.resize( 0 );
+        for ( size_t ii=i0; ii<=i1; ++ii ) {
+            for ( size_t jj=j0; jj<=j1; ++jj ) {
+                for ( size_t kk=k0; kk<=k1; ++kk ) {
+                    cells.push_back( (ii*ncy + jj)*ncz + kk );
+                }
+            }
+        }
+    }
+
+    int Grid3Dttcr::pointCells(const sxyz<double>& pt, vector<size_t>& cells) const {
+        uint32_t i0, i1, j0, j1, k0, k1;
+        cells.resize( 0 );
+        if ( !cellRange(pt.x, xmin, dx, ncx, i0, i1) ||
+             !cellRange(pt.y, ymin, dy, ncy, j0, j1) ||
+             !cellRange(pt.z, zmin, dz, ncz, k0, k1) ) {
+            return 1;
+        }
+        for ( uint32_t i=i0; i<=i1; ++i ) {
+            for ( uint32_t j=j0; j<=j1; ++j ) {
+                for ( uint32_t k=k0; k<=k1; ++k ) {
+                    cells.push_back( cellIndex(i, j, k) );
+                }
+            }
+        }
+        return 0;
+    }
+
+    size_t Grid3Dttcr::segmentCell(const sxyz<double>& p1, const sxyz<double>& p2) const {
+        // the cells containing the midpoint of a segment are the cells
+        // containing both ends; the slowest one was not used for traveltimes
+        vector<size_t> cells;
+        sxyz<double> mid(0.5*(p1.x+p2.x), 0.5*(p1.y+p2.y), 0.5*(p1.z+p2.z));
+        pointCells(mid, cells);
+        size_t cell = cells[0];
+        for ( size_t n=1; n<cells.size(); ++n ) {
+            if ( slowness[cells[n]] < slowness[cell] ) cell = cells[n];
+        }
+        return cell;
+    }
+
+    void Grid3Dttcr::raytraceSource(const vector<sxyz<double>>& Tx,
+                                    const vector<double>& t0,
+                                    const vector<sxyz<double>>& Rx,
+                                    vector<double>& tt,
+                                    vector<vector<sxyz<double>>>* r_data,
+                                    vector<vector<siv2<double>>>* l_data,
+                                    Workspace& ws) const {
+
+        enum : uint8_t { FREE, DONE, TARGET };
+        const double inf = numeric_limits<double>::max();
+        const uint32_t srcTag = static_cast<uint32_t>(nNodes);  // parent of nodes next to Tx
+
+        if ( ws.tt.size() != nNodes ) {
+            ws.tt.resize( nNodes );
+            ws.parent.resize( nNodes );
+            ws.state.resize( nNodes );
+        }
+        std::fill( ws.tt.begin(), ws.tt.end(), inf );
+        std::fill( ws.state.begin(), ws.state.end(), FREE );
+
+        vector<size_t> cells;
+
+        // nodes of the cells holding the receivers must be reached before stopping
+        size_t nTargets = 0;
+        for ( size_t nr=0; nr<Rx.size(); ++nr ) {
+            if ( pointCells(Rx[nr], cells) == 1 ) {
+                throw runtime_error("Rx outside grid.");
+            }
+            for ( size_t c : cells ) {
+                size_t i = c / (static_cast<size_t>(ncy)*ncz);
+                size_t j = (c / ncz) % ncy;
+                size_t k = c % ncz;
+                for ( const LocalNode& ln : cellNodes ) {
+                    size_t v = nodeIndex(ln.type, i+ln.di, j+ln.dj, k+ln.dk, ln.s);
+                    if ( ws.state[v] == FREE ) {
+                        ws.state[v] = TARGET;
+                        nTargets++;
+                    }
+                }
+            }
+        }
+
+        typedef pair<double, uint32_t> qelem;
+        priority_queue<qelem, vector<qelem>, greater<qelem>> queue;
+
+        for ( size_t ntx=0; ntx<Tx.size(); ++ntx ) {
+            if ( pointCells(Tx[ntx], cells) == 1 ) {
+                throw runtime_error("Tx outside grid.");
+            }
+            for ( size_t c : cells ) {
+                size_t i = c / (static_cast<size_t>(ncy)*ncz);
+                size_t j = (c / ncz) % ncy;
+                size_t k = c % ncz;
+                sxyz<double> orig(xmin+i*dx, ymin+j*dy, zmin+k*dz);
+                for ( const LocalNode& ln : cellNodes ) {
+                    size_t v = nodeIndex(ln.type, i+ln.di, j+ln.dj, k+ln.dk, ln.s);
+                    sxyz<double> pv(orig.x+ln.x, orig.y+ln.y, orig.z+ln.z);
+                    double t = t0[ntx] + slowness[c] * Tx[ntx].getDistance(pv);
+                    if ( t < ws.tt[v] ) {
+                        ws.tt[v] = t;
+                        ws.parent[v] = srcTag + static_cast<uint32_t>(ntx);
+                        queue.push( qelem(t, static_cast<uint32_t>(v)) );
+                    }
+                }
+            }
+        }
+
+        // Dijkstra, stopped when all target nodes are done
+        while ( !queue.empty() && nTargets > 0 ) {
+            qelem top = queue.top();
+            queue.pop();
+            size_t u = top.second;
+            if ( ws.state[u] == DONE || top.first > ws.tt[u] ) continue;
+            if ( ws.state[u] == TARGET ) nTargets--;
+            ws.state[u] = DONE;
+
+            sxyz<double> pu = nodeCoord(u);
+            nodeCells(u, cells);
+            for ( size_t c : cells ) {
+                size_t i = c / (static_cast<size_t>(ncy)*ncz);
+                size_t j = (c / ncz) % ncy;
+                size_t k = c % ncz;
+                sxyz<double> orig(xmin+i*dx, ymin+j*dy, zmin+k*dz);
+                for ( const LocalNode& ln : cellNodes ) {
+                    size_t v = nodeIndex(ln.type, i+ln.di, j+ln.dj, k+ln.dk, ln.s);
+                    if ( ws.state[v] == DONE ) continue;
+                    sxyz<double> pv(orig.x+ln.x, orig.y+ln.y, orig.z+ln.z);
+                    double t = ws.tt[u] + slowness[c] * pu.getDistance(pv);
+                    if ( t < ws.tt[v] ) {
+                        ws.tt[v] = t;
+                        ws.parent[v] = static_cast<uint32_t>(u);
+                        queue.push( qelem(t, static_cast<uint32_t>(v)) );
+                    }
+                }
+            }
+        }
+
+        // traveltimes at receivers, from the nodes of the cells holding them,
+        // or directly from Tx if it lies in the same cell
+        tt.resize( Rx.size() );
+        if ( r_data != nullptr ) r_data->resize( Rx.size() );
+        if ( l_data != nullptr ) l_data->resize( Rx.size() );
+
+        for ( size_t nr=0; nr<Rx.size(); ++nr ) {
+            pointCells(Rx[nr], cells);
+            double tbest = inf;
+            size_t pbest = 0;
+            for ( size_t c : cells ) {
+                size_t i = c / (static_cast<size_t>(ncy)*ncz);
+                size_t j = (c / ncz) % ncy;
+                size_t k = c % ncz;
+                sxyz<double> orig(xmin+i*dx, ymin+j*dy, zmin+k*dz);
+                for ( const LocalNode& ln : cellNodes ) {
+                    size_t v = nodeIndex(ln.type, i+ln.di, j+ln.dj, k+ln.dk, ln.s);
+                    sxyz<double> pv(orig.x+ln.x, orig.y+ln.y, orig.z+ln.z);
+                    double t = ws.tt[v] + slowness[c] * Rx[nr].getDistance(pv);
+                    if ( t < tbest ) {
+                        tbest = t;
+                        pbest = v;
+                    }
+                }
+                sxyz<double> pmax(orig.x+dx, orig.y+dy, orig.z+dz);
+                for ( size_t ntx=0; ntx<Tx.size(); ++ntx ) {
+                    if ( Tx[ntx].x >= orig.x-tol*dx && Tx[ntx].x <= pmax.x+tol*dx &&
+                         Tx[ntx].y >= orig.y-tol*dy && Tx[ntx].y <= pmax.y+tol*dy &&
+                         Tx[ntx].z >= orig.z-tol*dz && Tx[ntx].z <= pmax.z+tol*dz ) {
+                        double t = t0[ntx] + slowness[c] * Rx[nr].getDistance(Tx[ntx]);
+                        if ( t < tbest ) {
+                            tbest = t;
+                            pbest = srcTag + ntx;
+                        }
+                    }
+                }
+            }
+            tt[nr] = tbest;
+
+            if ( r_data == nullptr && l_data == nullptr ) continue;
+
+            // raypath, from Rx back to Tx
+            vector<sxyz<double>> r_tmp(1, Rx[nr]);
+            size_t p = pbest;
+            while ( p < srcTag ) {
+                r_tmp.push_back( nodeCoord(p) );
+                p = ws.parent[p];
+            }
+            r_tmp.push_back( Tx[p-srcTag] );
+
+            if ( l_data != nullptr ) {
+                vector<siv2<double>>& row = (*l_data)[nr];
+                row.resize( 0 );
+                for ( size_t n=1; n<r_tmp.size(); ++n ) {
+                    double dl = r_tmp[n].getDistance( r_tmp[n-1] );
+                    if ( dl > 0.0 ) {
+                        row.push_back( {segmentCell(r_tmp[n], r_tmp[n-1]), dl, 0.0} );
+                    }
+                }
+                compactRow( row );
+            }
+            if ( r_data != nullptr ) {
+                (*r_data)[nr].assign( r_tmp.rbegin(), r_tmp.rend() );
+            }
+        }
+    }
+
+    int Grid3Dttcr::raytrace(const vector<sxyz<double>>& Tx,
+                             const double* tTx,
+                             const vector<sxyz<double>>& Rx,
+                             double* traveltimes,
+                             PyObject* rays,
+                             PyObject* L) const {
+
+        // rays must be a pointer to a tuple object of size 2
+
+        if ( slowness.size() != getNumberOfCells() ) {
+            throw runtime_error("Slowness model not defined.");
+        }
+
+        size_t nTx = Tx.size();
+        vector<vector<sxyz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupSources(Tx, tTx, vTx, t0, iTx);
+
+        vector<vector<double>> tt( vTx.size() );
+        vector<vector<vector<sxyz<double>>>> r_data( vTx.size() );
+        vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
+        vector<Workspace> ws( nThreads );
+
+        py::runSources(nThreads, vTx.size(), threadTimes, threadSources,
+                       [&](const size_t nv, const size_t threadNo) {
+            vector<sxyz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            raytraceSource(vTx[nv], t0[nv], vRx, tt[nv], &(r_data[nv]), &(l_data[nv]), ws[threadNo]);
+        });
+        ws.clear();
+
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
+
+        // rays
+        vector<const vector<sxyz<double>>*> r_rows(nTx);
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                r_rows[ iTx[nv][ni] ] = &(r_data[nv][ni]);
+            }
+        }
+        if ( py::buildRays(r_rows, 3, rays) != 0 ) {
+            return 1;
+        }
+
+        vector<const vector<siv2<double>>*> L_rows(nTx);
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                L_rows[ iTx[nv][ni] ] = &(l_data[nv][ni]);
+            }
+        }
+
+        return py::buildL(L_rows, getNumberOfCells(), false, L, singlePrecision);
+    }
+
+    int Grid3Dttcr::raytrace(const vector<sxyz<double>>& Tx,
+                             const double* tTx,
+                             const vector<sxyz<double>>& Rx,
+                             double* traveltimes,
+                             PyObject* L) const {
+
+        if ( slowness.size() != getNumberOfCells() ) {
+            throw runtime_error("Slowness model not defined.");
+        }
+
+        size_t nTx = Tx.size();
+        vector<vector<sxyz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupSources(Tx, tTx, vTx, t0, iTx);
+
+        vector<vector<double>> tt( vTx.size() );
+        vector<vector<vector<siv2<double>>>> l_data( vTx.size() );
+        vector<Workspace> ws( nThreads );
+
+        py::runSources(nThreads, vTx.size(), threadTimes, threadSources,
+                       [&](const size_t nv, const size_t threadNo) {
+            vector<sxyz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            raytraceSource(vTx[nv], t0[nv], vRx, tt[nv], nullptr, &(l_data[nv]), ws[threadNo]);
+        });
+        ws.clear();
+
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
+
+        vector<const vector<siv2<double>>*> L_rows(nTx);
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                L_rows[ iTx[nv][ni] ] = &(l_data[nv][ni]);
+            }
+        }
+
+        return py::buildL(L_rows, getNumberOfCells(), false, L, singlePrecision);
+    }
+
+    int Grid3Dttcr::raytrace(const vector<sxyz<double>>& Tx,
+                             const double* tTx,
+                             const vector<sxyz<double>>& Rx,
+                             double* traveltimes) const {
+
+        if ( slowness.size() != getNumberOfCells() ) {
+            throw runtime_error("Slowness model not defined.");
+        }
+
+        vector<vector<sxyz<double>>> vTx;
+        vector<vector<double>> t0;
+        vector<vector<size_t>> iTx;
+        groupSources(Tx, tTx, vTx, t0, iTx);
+
+        vector<vector<double>> tt( vTx.size() );
+        vector<Workspace> ws( nThreads );
+
+        py::runSources(nThreads, vTx.size(), threadTimes, threadSources,
+                       [&](const size_t nv, const size_t threadNo) {
+            vector<sxyz<double>> vRx;
+            selectRx(Rx, iTx[nv], vRx);
+            raytraceSource(vTx[nv], t0[nv], vRx, tt[nv], nullptr, nullptr, ws[threadNo]);
+        });
+
+        for ( size_t nv=0; nv<vTx.size(); ++nv ) {
+            for ( size_t ni=0; ni<iTx[nv].size(); ++ni ) {
+                traveltimes[ iTx[nv][ni] ] = tt[nv][ni];
+            }
+        }
+
+        return 0;
+    }
+
+    int Grid3Dttcr::Lsr3d(const double* Tx,
+                          const double* Rx,
+                          const size_t nTx,
+                          const double* grx,
+                          const size_t n_grx,
+                          const double* gry,
+                          const size_t n_gry,
+                          const double* grz,
+                          const size_t n_grz,
+                          PyObject* L) {
+
+        /*
+         The ray is parameterized as Tx + u*(Rx-Tx), 0<=u<=1.  The values of u
+         at which the ray crosses the grid planes split it in segments, each
+         one lying in the cell holding its midpoint.
+         */
+
+        const double eps = 1.e-10;
+        size_t ncx = n_grx-1;
+        size_t ncy = n_gry-1;
+        size_t ncz = n_grz-1;
+        size_t nCells = ncx*ncy*ncz;
+
+        vector<double> data_p;
+        vector<int64_t> indices_p;
+        vector<size_t> indptr_p(nTx+1);
+        data_p.reserve( nTx * (n_grx+n_gry+n_grz) / 2 );
+        indices_p.reserve( nTx * (n_grx+n_gry+n_grz) / 2 );
+
+        // index of cell holding coordinate x in sorted nodes gr
+        auto locate = [](const double x, const double* gr, const size_t nc) {
+            size_t i = upper_bound(gr, gr+nc+1, x) - gr;
+            return i == 0 ? 0 : ( i > nc ? nc-1 : i-1 );
+        };
+
+        vector<double> u;
+        vector<siv2<double>> row;
+        for ( size_t n=0; n<nTx; ++n ) {
+            indptr_p[n] = data_p.size();
+
+            double d[3] = {Rx[3*n]-Tx[3*n], Rx[3*n+1]-Tx[3*n+1], Rx[3*n+2]-Tx[3*n+2]};
+            double length = sqrt( d[0]*d[0] + d[1]*d[1] + d[2]*d[2] );
+            if ( length == 0.0 ) continue;
+
+            u.assign( {0.0, 1.0} );
+            const double* gr[3] = {grx, gry, grz};
+            const size_t ng[3] = {n_grx, n_gry, n_grz};
+            for ( size_t nd=0; nd<3; ++nd ) {
+                if ( fabs(d[nd]) < eps ) continue;
+                for ( size_t i=0; i<ng[nd]; ++i ) {
+                    double ui = (gr[nd][i] - Tx[3*n+nd]) / d[nd];
+                    if ( ui > 0.0 && ui < 1.0 ) u.push_back( ui );
+                }
+            }
+            sort( u.begin(), u.end() );
+
+            row.resize( 0 );
+            for ( size_t i=1; i<u.size(); ++i ) {
+                double du = u[i] - u[i-1];
+                if ( du*length < eps ) continue;
+                double um = 0.5*(u[i] + u[i-1]);
+                size_t ix = locate(Tx[3*n]+um*d[0], grx, ncx);
+                size_t iy = locate(Tx[3*n+1]+um*d[1], gry, ncy);
+                size_t iz = locate(Tx[3*n+2]+um*d[2], grz, ncz);
+                row.push_back( {(ix*ncy + iy)*ncz + iz, du*length, 0.0} );
+            }
+            compactRow( row );
+
+            for ( size_t i=0; i<row.size(); ++i ) {
+                indices_p.push_back( static_cast<int64_t>(row[i].i) );
+                data_p.push_back( row[i].v );
+            }
+        }
+        indptr_p[nTx] = data_p.size();
+
+        return py::buildL(data_p, indices_p, indptr_p, nCells, L);
+    }
+}
@@ -0,0 +1,157 @@
+//
+//  Grid3Dttcr.h
+//  ttcr
+//
+//  Shortest-path raytracing on regular 3D grids of isotropic cells
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef Grid3Dttcr_h
+#define Grid3Dttcr_h
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include "Python.h"
+#include "numpy/ndarrayobject.h"
+
+#include <cstdint>
+#include <vector>
+
+#include "ttcr_t.h"
+
+
+namespace ttcr {
+
+    /*
+     Secondary nodes are placed on the edges of the cells, in addition to
+     the primary nodes at the cell corners, and on the faces of the cells at
+     the intersections of the lines joining the secondary nodes of opposite
+     edges (nsny x nsnz nodes on faces normal to x, etc.).  Without face
+     nodes, rays crossing a face obliquely must zigzag through its edges,
+     giving traveltimes too large by about 2% whatever the number of
+     secondary nodes.  Connectivity is implicit:
+     node coordinates and the cells sharing a node are computed from the node
+     index, so that memory usage is dominated by the traveltime, parent and
+     state arrays of each thread (13 bytes per node and per thread) and by
+     the priority queue.
+     */
+    class Grid3Dttcr {
+    public:
+        Grid3Dttcr(uint32_t nx, uint32_t ny, uint32_t nz,
+                   double dx, double dy, double dz,
+                   double xmin, double ymin, double zmin,
+                   uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                   size_t nthreads);
+
+        size_t getNumberOfCells() const { return static_cast<size_t>(ncx)*ncy*ncz; }
+        size_t getNumberOfNodes() const { return nNodes; }
+        size_t getNthreads() const { return nThreads; }
+
+        // if true, L is returned with float32 data
+        void setSinglePrecision(const bool s) { singlePrecision = s; }
+
+        void setSlowness(const double* slowness, const size_t n);
+
+        int raytrace(const std::vector<sxyz<double>>& Tx,
+                     const double* tTx,
+                     const std::vector<sxyz<double>>& Rx,
+                     double* traveltimes,
+                     PyObject* rays,
+                     PyObject* L) const;
+
+        int raytrace(const std::vector<sxyz<double>>& Tx,
+                     const double* tTx,
+                     const std::vector<sxyz<double>>& Rx,
+                     double* traveltimes,
+                     PyObject* L) const;
+
+        int raytrace(const std::vector<sxyz<double>>& Tx,
+                     const double* tTx,
+                     const std::vector<sxyz<double>>& Rx,
+                     double* traveltimes) const;
+
+        static int Lsr3d(const double* Tx,
+                         const double* Rx,
+                         const size_t nTx,
+                         const double* grx,
+                         const size_t n_grx,
+                         const double* gry,
+                         const size_t n_gry,
+                         const double* grz,
+                         const size_t n_grz,
+                         PyObject* L);
+
+        // wall time and number of sources processed by each thread during
+        // the last call to raytrace
+        const std::vector<double>& getThreadTimes() const { return threadTimes; }
+        const std::vector<size_t>& getThreadSources() const { return threadSources; }
+
+    private:
+        enum NodeType : uint8_t { PRIMARY, XEDGE, YEDGE, ZEDGE, XFACE, YFACE, ZFACE };
+
+        // node of a cell, relative to the cell origin
+        struct LocalNode {
+            NodeType type;
+            uint32_t di, dj, dk;   // offset of the corner (edge or face) in the cell
+            uint32_t s;            // secondary node number on the edge or face
+            double x, y, z;        // offset of the node from the cell origin
+        };
+
+        // per-thread arrays, allocated for the duration of a call to raytrace
+        struct Workspace {
+            std::vector<double> tt;
+            std::vector<uint32_t> parent;
+            std::vector<uint8_t> state;
+        };
+
+        const uint32_t ncx, ncy, ncz;
+        const double dx, dy, dz;
+        const double xmin, ymin, zmin;
+        const uint32_t nsnx, nsny, nsnz;
+        const size_t nThreads;
+        bool singlePrecision;
+        size_t offX, offY, offZ, offFX, offFY, offFZ, nNodes;
+        std::vector<LocalNode> cellNodes;
+        std::vector<double> slowness;
+        mutable std::vector<double> threadTimes;
+        mutable std::vector<size_t> threadSources;
+
+        size_t cellIndex(const uint32_t i, const uint32_t j, const uint32_t k) const {
+            return (static_cast<size_t>(i)*ncy + j)*ncz + k;
+        }
+        size_t nodeIndex(const NodeType type, const size_t i, const size_t j,
+                         const size_t k, const size_t s) const;
+        NodeType decodeNode(const size_t n, size_t& i, size_t& j, size_t& k, size_t& s) const;
+        sxyz<double> nodeCoord(const size_t n) const;
+        void nodeCells(const size_t n, std::vector<size_t>& cells) const;
+        int pointCells(const sxyz<double>& pt, std::vector<size_t>& cells) const;
+        size_t segmentCell(const sxyz<double>& p1, const sxyz<double>& p2) const;
+
+        void raytraceSource(const std::vector<sxyz<double>>& Tx,
+                            const std::vector<double>& t0,
+                            const std::vector<sxyz<double>>& Rx,
+                            std::vector<double>& tt,
+                            std::vector<std::vector<sxyz<double>>>* r_data,
+                            std::vector<std::vector<siv2<double>>>* l_data,
+                            Workspace& ws) const;
+
+        Grid3Dttcr() = delete;
+    };
+
+}
+
+#endif /* Grid3Dttcr_h */
@@ -19,6 +19,7 @@
 """
 
 
+cimport cython
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from libc.stdint cimport uint32_t
@@ -28,7 +29,6 @@ cimport numpy as np
 
 from scipy.sparse import csr_matrix
 
-from utils import nargout
 
 cdef extern from "ttcr_t.h" namespace "ttcr":
     cdef cppclass sxz[T]:
@@ -39,11 +39,16 @@ cdef extern from "Grid2Dttcr.h" namespace "ttcr":
     cdef cppclass Grid2Dttcr:
         Grid2Dttcr(string&, uint32_t, uint32_t, double, double, double, double, uint32_t, uint32_t, size_t) except +
         string getType()
-        void setSlowness(const vector[double]&) except +
-        void setXi(const vector[double]&) except +
-        void setTheta(const vector[double]&) except +
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object,object)
-        int raytrace(vector[sxz[double]]&,vector[double]&,vector[sxz[double]]&,double*,object)
+        void setSlowness(const double*, size_t) except +
+        void setXi(const double*, size_t) except +
+        void setTheta(const double*, size_t) except +
+        int raytrace(vector[sxz[double]]&,const double*,vector[sxz[double]]&,double*,object,object) except +
+        int raytrace(vector[sxz[double]]&,const double*,vector[sxz[double]]&,double*,object) except +
+        int raytrace(vector[sxz[double]]&,const double*,vector[sxz[double]]&,double*) except +
+        int raytraceFMM(const double*,size_t,vector[sxz[double]]&,const double*,vector[sxz[double]]&,double*) except +
+        void setSinglePrecision(bint)
+        const vector[double]& getThreadTimes()
+        const vector[size_t]& getThreadSources()
         @staticmethod
         int Lsr2d(double*,double*,size_t,double*,size_t,double*,size_t,object)
         @staticmethod
@@ -51,6 +56,46 @@ cdef extern from "Grid2Dttcr.h" namespace "ttcr":
 
 
 
+def _as_vector(v, name, size_t n=0):
+    """
+    Return v as a C-contiguous float64 vector, copying only if needed
+
+    NumPy arrays that are already contiguous and of type float64 are
+    returned as is, so that their buffer can be handed to the raytracer
+    without any copy.
+    """
+    a = np.ascontiguousarray(v, dtype=np.float64)
+    if a.ndim != 1:
+        if a.ndim == 2 and 1 in (a.shape[0], a.shape[1]):
+            a = a.reshape(-1)
+        else:
+            raise ValueError(name + ' should be a vector')
+    if n != 0 and a.shape[0] != n:
+        raise ValueError('Length of ' + name + ' should be ' + str(n))
+    return a
+
+
+def _as_coord(v, name):
+    """
+    Return v as a float64 ndata x 3 array, C- or F-ordered, copying only if needed
+    """
+    a = np.asarray(v, dtype=np.float64)
+    if a.ndim != 2 or a.shape[1] != 3:
+        raise ValueError(name + ' should be ndata x 3')
+    if not a.flags.c_contiguous and not a.flags.f_contiguous:
+        a = np.ascontiguousarray(a)
+    return a
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _fill_sxz(const double[:, :] pts, vector[sxz[double]]& out):
+    cdef Py_ssize_t n
+    out.reserve(pts.shape[0])
+    for n in range(pts.shape[0]):
+        out.push_back(sxz[double](pts[n, 0], pts[n, 2]))
+
+
 cdef class Grid2Dcpp:
     cdef Grid2Dttcr* grid
     def __cinit__(self, gridType, uint32_t nx, uint32_t nz, double dx, double dz,
@@ -64,9 +109,32 @@ cdef class Grid2Dcpp:
     def getType(self):
         return self.grid.getType()
 
-    def raytrace(self, slowness, xi, theta, Tx, Rx, t0):
-
-        nout = nargout()
+    def setSinglePrecision(self, single):
+        """
+        Return L with float32 data if single is True (raytracing is done
+        in double precision in all cases)
+        """
+        self.grid.setSinglePrecision(single)
+
+    def getThreadTiming(self):
+        """
+        Return the wall time (s) and the number of sources processed by
+        each thread during the last call to raytrace
+        """
+        times = np.array(self.grid.getThreadTimes(), dtype=np.double)
+        nsrc = np.array(self.grid.getThreadSources(), dtype=np.int64)
+        return times, nsrc
+
+    def raytrace(self, slowness, xi, theta, Tx, Rx, t0, return_L=True, return_rays=False):
+        """
+        Compute traveltimes, and optionally L and the raypaths
+
+        Returns tt, followed by L if return_L is True and by the rays if
+        return_rays is True.  When neither is requested, raypaths are not
+        reconstructed at all.  Rays are returned as a tuple (coords, offsets),
+        coords being a float32 array holding the points of all rays and
+        the points of ray n being coords[offsets[n]:offsets[n+1]].
+        """
         # check if types are consistent with input data
         if len(xi) != 0:
             if len(theta) != 0:
@@ -79,68 +147,96 @@ cdef class Grid2Dcpp:
             if self.grid.getType() != b'iso':
                 raise TypeError('Grid should handle raytracing in isotropic media')
 
-        # assing model data
-        cdef vector[double] slown# = slowness.tolist()
-        for tmp in slowness:
-            slown.push_back(tmp)
-        self.grid.setSlowness(slown)
-        cdef vector[double] x
+        # validate input once, float64 contiguous arrays are used without copy
+        cdef const double[::1] slown = _as_vector(slowness, 'slowness')
+        cdef const double[::1] x
+        cdef const double[::1] t
+        Tx = _as_coord(Tx, 'Tx')
+        Rx = _as_coord(Rx, 'Rx')
+        if Tx.shape[0] != Rx.shape[0]:
+            raise ValueError('Tx and Rx should be of equal size')
+        cdef const double[::1] ct0 = _as_vector(t0, 't0', Tx.shape[0])
+
+        # assign model data, buffers are passed directly to the C++ grid
+        self.grid.setSlowness(&slown[0], slown.shape[0])
         if len(xi) != 0:
-            for tmp in xi:
-                x.push_back(tmp)
-            self.grid.setXi(x)
-        cdef vector[double] t
+            x = _as_vector(xi, 'xi', slown.shape[0])
+            self.grid.setXi(&x[0], x.shape[0])
         if len(theta) != 0:
-            for tmp in theta:
-                t.push_back(tmp)
-            self.grid.setTheta(t)
+            t = _as_vector(theta, 'theta', slown.shape[0])
+            self.grid.setTheta(&t[0], t.shape[0])
 
         # create C++ input variables
         cdef vector[sxz[double]] cTx
-        for t in Tx:
-            cTx.push_back(sxz[double](t[0], t[2]))
+        _fill_sxz(Tx, cTx)
 
         cdef vector[sxz[double]] cRx
-        for r in Rx:
-            cRx.push_back(sxz[double](r[0], r[2]))
-
-        cdef vector[double] ct0# = t0.tolist()
-        for tmp in t0:
-            ct0.push_back(tmp)
+        _fill_sxz(Rx, cRx)
 
         # instantiate output variables
         cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)  # tt should be the right size
 
-        if nout==2:
-            Ldata = ([0.0], [0.0], [0.0])
+        if not return_L and not return_rays:
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt)) != 0:
+                raise RuntimeError()
+
+            return tt
 
-            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
+        Ldata = ([0.0], [0.0], [0.0])
+        if return_rays:
+            # flat float32 coordinates and int64 offsets, filled by the C++ grid
+            rays = ([0.0], [0.0])
+
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
+                raise RuntimeError()
+        else:
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
                 raise RuntimeError()
 
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
+        if not return_L:
+            return tt,rays
 
-            L = csr_matrix(Ldata, shape=(M,N))
+        M = Rx.shape[0]
+        N = len(slowness)
+        if self.grid.getType() != b'iso':
+            N = 2*N
+
+        L = csr_matrix(Ldata, shape=(M,N))
 
+        if return_rays:
+            return tt,L,rays
+        else:
             return tt,L
-            
-        elif nout==3:
-            rays = tuple([ [0.0] for i in range(Rx.shape[0]) ])
-            Ldata = ([0.0], [0.0], [0.0])
 
-            if self.grid.raytrace(cTx, ct0, cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
-                raise RuntimeError()
+    def raytraceFMM(self, slowness, Tx, Rx, t0):
+        """
+        Compute traveltimes with the fast marching method (isotropic media)
 
-            M = Rx.shape[0]
-            N = len(slowness)
-            if self.grid.getType() != b'iso':
-                N = 2*N
+        A traveltime field is computed at grid nodes for each source and
+        interpolated at the receivers, L and the raypaths are not available.
+        """
+        if self.grid.getType() != b'iso':
+            raise TypeError('Grid should handle raytracing in isotropic media')
 
-            L = csr_matrix(Ldata, shape=(M,N))
+        cdef const double[::1] slown = _as_vector(slowness, 'slowness')
+        Tx = _as_coord(Tx, 'Tx')
+        Rx = _as_coord(Rx, 'Rx')
+        if Tx.shape[0] != Rx.shape[0]:
+            raise ValueError('Tx and Rx should be of equal size')
+        cdef const double[::1] ct0 = _as_vector(t0, 't0', Tx.shape[0])
 
-            return tt,L,rays
+        cdef vector[sxz[double]] cTx
+        _fill_sxz(Tx, cTx)
+
+        cdef vector[sxz[double]] cRx
+        _fill_sxz(Rx, cRx)
+
+        cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)
+
+        if self.grid.raytraceFMM(&slown[0], slown.shape[0], cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt)) != 0:
+            raise RuntimeError()
+
+        return tt
 
 
     @staticmethod
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Copyright 2017 Bernard Giroux
+    email: bernard.giroux@ete.inrs.ca
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+cimport cython
+from libcpp.vector cimport vector
+from libc.stdint cimport uint32_t
+
+import numpy as np
+cimport numpy as np
+
+from scipy.sparse import csr_matrix
+
+from cutils.cgrid2d import _as_vector, _as_coord
+
+
+cdef extern from "ttcr_t.h" namespace "ttcr":
+    cdef cppclass sxyz[T]:
+        sxyz(T, T, T) except +
+
+
+cdef extern from "Grid3Dttcr.h" namespace "ttcr":
+    cdef cppclass Grid3Dttcr:
+        Grid3Dttcr(uint32_t, uint32_t, uint32_t, double, double, double, double, double, double,
+                   uint32_t, uint32_t, uint32_t, size_t) except +
+        size_t getNumberOfCells()
+        size_t getNumberOfNodes()
+        void setSlowness(const double*, size_t) except +
+        int raytrace(vector[sxyz[double]]&,const double*,vector[sxyz[double]]&,double*,object,object) except +
+        int raytrace(vector[sxyz[double]]&,const double*,vector[sxyz[double]]&,double*,object) except +
+        int raytrace(vector[sxyz[double]]&,const double*,vector[sxyz[double]]&,double*) except +
+        void setSinglePrecision(bint)
+        const vector[double]& getThreadTimes()
+        const vector[size_t]& getThreadSources()
+        @staticmethod
+        int Lsr3d(double*,double*,size_t,double*,size_t,double*,size_t,double*,size_t,object)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _fill_sxyz(const double[:, :] pts, vector[sxyz[double]]& out):
+    cdef Py_ssize_t n
+    out.reserve(pts.shape[0])
+    for n in range(pts.shape[0]):
+        out.push_back(sxyz[double](pts[n, 0], pts[n, 1], pts[n, 2]))
+
+
+cdef class Grid3Dcpp:
+    """
+    Shortest path raytracing in isotropic 3D grids
+
+    Secondary nodes are placed on cell edges, nsnx, nsny and nsnz being the
+    number of secondary nodes on edges parallel to X, Y and Z, and on cell
+    faces (nsny x nsnz nodes on faces normal to X, etc.).
+    """
+    cdef Grid3Dttcr* grid
+    def __cinit__(self, uint32_t nx, uint32_t ny, uint32_t nz, double dx, double dy, double dz,
+                  double xmin, double ymin, double zmin, uint32_t nsnx, uint32_t nsny, uint32_t nsnz,
+                  size_t nthreads):
+        self.grid = new Grid3Dttcr(nx, ny, nz, dx, dy, dz, xmin, ymin, zmin, nsnx, nsny, nsnz, nthreads)
+
+    def __dealloc__(self):
+        del self.grid
+
+    def getNumberOfNodes(self):
+        return self.grid.getNumberOfNodes()
+
+    def setSinglePrecision(self, single):
+        """
+        Return L with float32 data if single is True (raytracing is done
+        in double precision in all cases)
+        """
+        self.grid.setSinglePrecision(single)
+
+    def getThreadTiming(self):
+        """
+        Return the wall time (s) and the number of sources processed by
+        each thread during the last call to raytrace
+        """
+        times = np.array(self.grid.getThreadTimes(), dtype=np.double)
+        nsrc = np.array(self.grid.getThreadSources(), dtype=np.int64)
+        return times, nsrc
+
+    def raytrace(self, slowness, Tx, Rx, t0, return_L=True, return_rays=False):
+        """
+        Compute traveltimes, and optionally L and the raypaths
+
+        Returns tt, followed by L if return_L is True and by the rays if
+        return_rays is True.  When neither is requested, raypaths are not
+        reconstructed at all.  Rays are returned as a tuple (coords, offsets),
+        coords being a float32 array holding the points of all rays and
+        the points of ray n being coords[offsets[n]:offsets[n+1]].
+        """
+        cdef const double[::1] slown = _as_vector(slowness, 'slowness', self.grid.getNumberOfCells())
+        Tx = _as_coord(Tx, 'Tx')
+        Rx = _as_coord(Rx, 'Rx')
+        if Tx.shape[0] != Rx.shape[0]:
+            raise ValueError('Tx and Rx should be of equal size')
+        cdef const double[::1] ct0 = _as_vector(t0, 't0', Tx.shape[0])
+
+        self.grid.setSlowness(&slown[0], slown.shape[0])
+
+        cdef vector[sxyz[double]] cTx
+        _fill_sxyz(Tx, cTx)
+
+        cdef vector[sxyz[double]] cRx
+        _fill_sxyz(Rx, cRx)
+
+        cdef np.ndarray tt = np.empty([Rx.shape[0],], dtype=np.double)
+
+        if not return_L and not return_rays:
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt)) != 0:
+                raise RuntimeError()
+
+            return tt
+
+        Ldata = ([0.0], [0.0], [0.0])
+        if return_rays:
+            # flat float32 coordinates and int64 offsets, filled by the C++ grid
+            rays = ([0.0], [0.0])
+
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt), rays, Ldata) != 0:
+                raise RuntimeError()
+        else:
+            if self.grid.raytrace(cTx, &ct0[0], cRx, <double*> np.PyArray_DATA(tt), Ldata) != 0:
+                raise RuntimeError()
+
+        if not return_L:
+            return tt,rays
+
+        L = csr_matrix(Ldata, shape=(Rx.shape[0], slown.shape[0]))
+
+        if return_rays:
+            return tt,L,rays
+        else:
+            return tt,L
+
+    @staticmethod
+    def Lsr3d(Tx, Rx, grx, gry, grz):
+        """
+        Ray projection matrix for straight rays, Tx and Rx are ndata x 3
+        """
+        Tx = np.ascontiguousarray(Tx, dtype=np.float64)
+        Rx = np.ascontiguousarray(Rx, dtype=np.float64)
+        grx = np.ascontiguousarray(grx, dtype=np.float64)
+        gry = np.ascontiguousarray(gry, dtype=np.float64)
+        grz = np.ascontiguousarray(grz, dtype=np.float64)
+        if Tx.ndim != 2 or Tx.shape[1] != 3 or Tx.shape != Rx.shape:
+            raise ValueError('Tx and Rx should be ndata x 3')
+
+        cdef size_t nTx = Tx.shape[0]
+        cdef size_t n_grx = grx.shape[0]
+        cdef size_t n_gry = gry.shape[0]
+        cdef size_t n_grz = grz.shape[0]
+
+        Ldata = ([0.0], [0.0], [0.0])
+
+        Grid3Dttcr.Lsr3d(<double*> np.PyArray_DATA(Tx), <double*> np.PyArray_DATA(Rx), nTx,
+                         <double*> np.PyArray_DATA(grx), n_grx, <double*> np.PyArray_DATA(gry), n_gry,
+                         <double*> np.PyArray_DATA(grz), n_grz, Ldata)
+
+        M = nTx
+        N = (n_grx-1)*(n_gry-1)*(n_grz-1)
+        L = csr_matrix(Ldata, shape=(M,N))
+
+        return L
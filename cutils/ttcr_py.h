@@ -0,0 +1,271 @@
+//
+//  ttcr_py.h
+//  ttcr
+//
+//  Helpers shared by the raytracers wrapped for Python
+//
+
+/*
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ *
+ */
+
+#ifndef ttcr_py_h
+#define ttcr_py_h
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include "Python.h"
+#include "numpy/ndarrayobject.h"
+
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <exception>
+#include <functional>
+#include <limits>
+#include <thread>
+#include <vector>
+
+#include "ttcr_t.h"
+
+namespace ttcr {
+
+    namespace py {
+
+        /*
+         Fill CSR arrays from rows of (cell, length) pairs sorted by cell index.
+         For anisotropic media, the lengths along z are stored in columns
+         ncell to 2*ncell-1.
+         */
+        template<typename T, typename IDX>
+        void fillCSR(const std::vector<const std::vector<siv2<double>>*>& rows,
+                     const size_t ncell, const bool aniso,
+                     T* data, IDX* indices, IDX* indptr) {
+            size_t k = 0;
+            for ( size_t i=0; i<rows.size(); ++i ) {
+                indptr[i] = static_cast<IDX>(k);
+                const std::vector<siv2<double>>& row = *rows[i];
+                for ( size_t n=0; n<row.size(); ++n, ++k ) {
+                    indices[k] = static_cast<IDX>(row[n].i);
+                    data[k] = static_cast<T>(row[n].v);
+                }
+                if ( aniso ) {
+                    for ( size_t n=0; n<row.size(); ++n, ++k ) {
+                        indices[k] = static_cast<IDX>(row[n].i + ncell);
+                        data[k] = static_cast<T>(row[n].v2);
+                    }
+                }
+            }
+            indptr[rows.size()] = static_cast<IDX>(k);
+        }
+
+        template<typename T>
+        void fillCSR(const std::vector<const std::vector<siv2<double>>*>& rows,
+                     const size_t ncell, const bool aniso, const int itype,
+                     PyObject* data, PyObject* indices, PyObject* indptr) {
+            T* data_p = static_cast<T*>(PyArray_DATA((PyArrayObject*)data));
+            if ( itype == NPY_INT32 ) {
+                fillCSR(rows, ncell, aniso, data_p,
+                        static_cast<int32_t*>(PyArray_DATA((PyArrayObject*)indices)),
+                        static_cast<int32_t*>(PyArray_DATA((PyArrayObject*)indptr)));
+            } else {
+                fillCSR(rows, ncell, aniso, data_p,
+                        static_cast<int64_t*>(PyArray_DATA((PyArrayObject*)indices)),
+                        static_cast<int64_t*>(PyArray_DATA((PyArrayObject*)indptr)));
+            }
+        }
+
+        template<typename IDX>
+        void copyCSR(const std::vector<int64_t>& ind, const std::vector<size_t>& ptr,
+                     IDX* indices, IDX* indptr) {
+            for ( size_t n=0; n<ind.size(); ++n ) indices[n] = static_cast<IDX>(ind[n]);
+            for ( size_t n=0; n<ptr.size(); ++n ) indptr[n] = static_cast<IDX>(ptr[n]);
+        }
+
+        // int32 indices are used whenever they can hold both nnz and the number of columns
+        inline int indexType(const size_t nnz, const size_t ncol) {
+            const size_t i32max = static_cast<size_t>(std::numeric_limits<int32_t>::max());
+            return ( nnz <= i32max && ncol <= i32max ) ? NPY_INT32 : NPY_INT64;
+        }
+
+        /*
+         Store CSR arrays in tuple L, arrays are allocated by NumPy
+         */
+        inline void setCSR(PyObject* L, PyObject* data, PyObject* indices, PyObject* indptr) {
+            PyTuple_SetItem(L, 0, data);
+            PyTuple_SetItem(L, 1, indices);
+            PyTuple_SetItem(L, 2, indptr);
+        }
+
+        /*
+         Build L from rows of (cell, length) pairs, data are stored in
+         float32 if single is true
+         */
+        inline int buildL(const std::vector<const std::vector<siv2<double>>*>& rows,
+                          const size_t ncell, const bool aniso, PyObject* L,
+                          const bool single=false) {
+
+            import_array1(1);  // to use PyArray_SimpleNew
+
+            size_t nnz = 0;
+            for ( size_t n=0; n<rows.size(); ++n ) {
+                nnz += rows[n]->size();
+            }
+            if ( aniso ) nnz *= 2;
+            int itype = indexType(nnz, aniso ? 2*ncell : ncell);
+
+            npy_intp dims[] = {static_cast<npy_intp>(nnz)};
+            PyObject* data = PyArray_SimpleNew(1, dims, single ? NPY_FLOAT32 : NPY_DOUBLE);
+            PyObject* indices = PyArray_SimpleNew(1, dims, itype);
+            dims[0] = rows.size()+1;
+            PyObject* indptr = PyArray_SimpleNew(1, dims, itype);
+
+            if ( single ) {
+                fillCSR<float>(rows, ncell, aniso, itype, data, indices, indptr);
+            } else {
+                fillCSR<double>(rows, ncell, aniso, itype, data, indices, indptr);
+            }
+            setCSR(L, data, indices, indptr);
+            return 0;
+        }
+
+        inline int buildL(const std::vector<double>& dat, const std::vector<int64_t>& ind,
+                          const std::vector<size_t>& ptr, const size_t ncol, PyObject* L) {
+
+            import_array1(1);  // to use PyArray_SimpleNew
+
+            int itype = indexType(dat.size(), ncol);
+
+            npy_intp dims[] = {static_cast<npy_intp>(dat.size())};
+            PyObject* data = PyArray_SimpleNew(1, dims, NPY_DOUBLE);
+            PyObject* indices = PyArray_SimpleNew(1, dims, itype);
+            dims[0] = ptr.size();
+            PyObject* indptr = PyArray_SimpleNew(1, dims, itype);
+
+            std::copy(dat.begin(), dat.end(), static_cast<double*>(PyArray_DATA((PyArrayObject*)data)));
+            if ( itype == NPY_INT32 ) {
+                copyCSR(ind, ptr,
+                        static_cast<int32_t*>(PyArray_DATA((PyArrayObject*)indices)),
+                        static_cast<int32_t*>(PyArray_DATA((PyArrayObject*)indptr)));
+            } else {
+                copyCSR(ind, ptr,
+                        static_cast<int64_t*>(PyArray_DATA((PyArrayObject*)indices)),
+                        static_cast<int64_t*>(PyArray_DATA((PyArrayObject*)indptr)));
+            }
+            setCSR(L, data, indices, indptr);
+            return 0;
+        }
+
+        inline size_t storePoint(const sxz<double>& p, float* out) {
+            out[0] = static_cast<float>(p.x);
+            out[1] = static_cast<float>(p.z);
+            return 2;
+        }
+
+        inline size_t storePoint(const sxyz<double>& p, float* out) {
+            out[0] = static_cast<float>(p.x);
+            out[1] = static_cast<float>(p.y);
+            out[2] = static_cast<float>(p.z);
+            return 3;
+        }
+
+        /*
+         Store raypaths in tuple rays as a flat float32 array of coordinates
+         (npts x ndim) followed by an int64 array of offsets (nrays+1), the
+         points of ray n being at rows offsets[n] to offsets[n+1]-1
+         */
+        template<typename PT>
+        int buildRays(const std::vector<const std::vector<PT>*>& rows,
+                      const int ndim, PyObject* rays) {
+
+            import_array1(1);  // to use PyArray_SimpleNew
+
+            npy_intp dims[] = {static_cast<npy_intp>(rows.size()+1), ndim};
+            PyObject* offsets = PyArray_SimpleNew(1, dims, NPY_INT64);
+            int64_t* offsets_p = static_cast<int64_t*>(PyArray_DATA((PyArrayObject*)offsets));
+            offsets_p[0] = 0;
+            for ( size_t n=0; n<rows.size(); ++n ) {
+                offsets_p[n+1] = offsets_p[n] + static_cast<int64_t>(rows[n]->size());
+            }
+
+            dims[0] = static_cast<npy_intp>(offsets_p[rows.size()]);
+            PyObject* coords = PyArray_SimpleNew(2, dims, NPY_FLOAT32);
+            float* coords_p = static_cast<float*>(PyArray_DATA((PyArrayObject*)coords));
+            for ( size_t n=0; n<rows.size(); ++n ) {
+                const std::vector<PT>& row = *rows[n];
+                for ( size_t np=0; np<row.size(); ++np ) {
+                    coords_p += storePoint(row[np], coords_p);
+                }
+            }
+
+            PyTuple_SetItem(rays, 0, coords);
+            PyTuple_SetItem(rays, 1, offsets);
+            return 0;
+        }
+
+        /*
+         Process nsrc sources with up to nthreads threads.
+
+         Sources are handed out one at a time from a shared counter, so that
+         threads that get sources that are fast to process (e.g. close to the
+         grid edge) keep working until all sources are done.  The calling
+         thread is thread 0.  raytraceSource is called as
+         raytraceSource(sourceNo, threadNo), exceptions are rethrown in the
+         calling thread.
+         */
+        template<typename F>
+        void runSources(const size_t nthreads, const size_t nsrc,
+                        std::vector<double>& threadTimes,
+                        std::vector<size_t>& threadSources,
+                        F raytraceSource) {
+
+            size_t num_threads = nthreads < nsrc ? nthreads : nsrc;
+            if ( num_threads == 0 ) num_threads = 1;
+
+            threadTimes.assign( num_threads, 0.0 );
+            threadSources.assign( num_threads, 0 );
+            std::vector<std::exception_ptr> errors( num_threads );
+            std::atomic<size_t> next( 0 );
+
+            auto worker = [&](const size_t threadNo) {
+                auto start = std::chrono::steady_clock::now();
+                try {
+                    for ( size_t nv=next++; nv<nsrc; nv=next++ ) {
+                        raytraceSource( nv, threadNo );
+                        threadSources[threadNo]++;
+                    }
+                } catch ( ... ) {
+                    errors[threadNo] = std::current_exception();
+                    next = nsrc;  // other threads stop after their current source
+                }
+                threadTimes[threadNo] = std::chrono::duration<double>(std::chrono::steady_clock::now()-start).count();
+            };
+
+            std::vector<std::thread> threads;
+            for ( size_t i=1; i<num_threads; ++i ) {
+                threads.push_back( std::thread(worker, i) );
+            }
+            worker( 0 );
+
+            std::for_each(threads.begin(),threads.end(),
+                          std::mem_fn(&std::thread::join));
+
+            for ( size_t i=0; i<num_threads; ++i ) {
+                if ( errors[i] ) std::rethrow_exception( errors[i] );
+            }
+        }
+    }
+}
+
+#endif /* ttcr_py_h */
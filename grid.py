@@ -23,14 +23,24 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import functools
+import hashlib
 import math
+import multiprocessing
+import os
+import time
+import zlib
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 from scipy.sparse import csr_matrix
+import scipy.fft
+import scipy.sparse
 import h5py
 
 from cutils import cgrid2d
+from cutils import cgrid3d
 
-from utils import nargout
 import covar
 
 
@@ -56,6 +66,9 @@ class Grid(object):
         self.Tx_Z_water = np.nan
         self.Rx_Z_water = np.nan
         self.in_vect = np.array([])
+        self.lastPlan = None  # SourcePlan of the last call to raytraceMerged
+        self.rayCache = None  # StraightRayCache used by getForwardStraightRays, if any
+        self.precision = 'float64'  # 'float32' to store traveltimes and L in single precision
 
     def getNumberOfCells(self):
         """
@@ -79,6 +92,27 @@ class Grid(object):
     def dx(self):
         return self.grx[1] - self.grx[0]
 
+    def getDtype(self):
+        """
+        Returns the numpy type used to store traveltimes and L
+
+        Raytracing is done in double precision in all cases, traveltimes
+        and the data of L are stored in single precision if attribute
+        precision is 'float32'
+        """
+        if self.precision == 'float32':
+            return np.float32
+        elif self.precision == 'float64':
+            return np.float64
+        raise ValueError('precision should be float32 or float64')
+
+    def _toPrecision(self, out):
+        # cast traveltimes and L in output out of the raytracer, rays are always float32
+        dtype = self.getDtype()
+        if not isinstance(out, tuple):
+            return out.astype(dtype, copy=False)
+        return tuple(o.astype(dtype, copy=False) if not isinstance(o, Rays) else o for o in out)
+
     @property
     def dy(self):
         if len(self.gry) == 0:
@@ -90,6 +124,273 @@ class Grid(object):
     def dz(self):
         return self.grz[1] - self.grz[0]
 
+    def raytraceUpdate(self, slowness, Tx, Rx, L, s_prev, tol, t0=(), version=None):
+        """
+        Update traveltimes and ray projection matrix after a change of slowness
+
+        Only the sources having at least one ray crossing a cell where
+        slowness changed by more than tol (relative change) are raytraced
+        again, their rows are replaced in L.  Traveltimes of the other rays
+        are computed along their previous path, i.e. L * slowness.
+        Isotropic media only.
+
+        Changes are measured with respect to the model each row of L was
+        traced in, so that rows kept over many updates are traced again
+        when small changes add up.  After a call, rows ind were traced in
+        slowness, i.e. the caller appends slowness to s_prev and sets
+        version[ind] to its index.
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3)
+            Rx: coordinates of receivers      (ndata x 3)
+            L: ray projection matrix computed with s_prev (ndata x ncell)
+            s_prev: slowness vector used to compute L, or list of slowness
+                vectors if version is given
+            tol: relative change of slowness above which a cell is considered modified
+            t0 (optional): initial time at sources points (ndata x 1)
+            version (optional): index in s_prev of the slowness vector used
+                to compute each row of L (ndata x 1)
+        Output:
+            tt: vector of traveltimes, ndata by 1
+            L: updated ray projection matrix, ndata by ncell
+            ind: boolean vector, True for data that were raytraced again
+        """
+        if L.shape != (Tx.shape[0], len(slowness)):
+            raise ValueError('L should be ndata x ncell')
+
+        L = csr_matrix(L)
+        if version is None:
+            s_prev = [s_prev]
+            version = np.zeros((L.shape[0], ), dtype=np.int64)
+        crossing = np.zeros((L.shape[0], ), dtype=bool)
+        for v, s_v in enumerate(s_prev):
+            rows = np.nonzero(version == v)[0]
+            if rows.size > 0:
+                changed = np.abs(slowness - s_v) > tol * np.abs(s_v)
+                crossing[rows] = L[rows, :][:, changed].getnnz(axis=1) > 0
+
+        # all data of a source crossing modified cells are raytraced again,
+        # since raytracing is done for all receivers of a source at once
+        _, isrc = np.unique(Tx, axis=0, return_inverse=True)
+        isrc = isrc.reshape(-1)
+        ind = np.isin(isrc, isrc[crossing])
+
+        tt = (L * slowness).astype(self.getDtype(), copy=False)
+        if np.any(ind):
+            if len(t0) != 0:
+                t0 = np.asarray(t0)[ind]
+            tt_new, L_new = self.raytrace(slowness, Tx[ind, :], Rx[ind, :], t0)
+            tt[ind] = tt_new
+            iold = np.nonzero(~ind)[0]
+            inew = np.nonzero(ind)[0]
+            L = scipy.sparse.vstack((L[iold, :], L_new), format='csr')
+            L = L[np.argsort(np.concatenate((iold, inew))), :]
+
+        return tt, L, ind
+
+    def raytraceMerged(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), return_L=True,
+                       return_rays=False, reciprocity=True, tol=1.e-6):
+        """
+        Raytrace after merging identical sources and data
+
+        Sources (and receivers) closer than tol are merged, duplicated Tx-Rx
+        pairs (e.g. from different MOGs) are raytraced once, and if
+        reciprocity is True, Tx and Rx are swapped when receivers have fewer
+        distinct positions than sources.  Results are returned for all
+        rows of Tx and Rx, in the same order.  The plan is kept in
+        attribute lastPlan, lastPlan.reduction being the ratio of the
+        number of sources raytraced by raytrace to the number of sources
+        actually raytraced.
+
+        Input and output: see raytrace
+        """
+        dims = (0, 1, 2) if self.gry.size > 1 else (0, 2)
+        plan = SourcePlan(Tx, Rx, t0, reciprocity, tol, dims)
+        self.lastPlan = plan
+        out = self.raytrace(slowness, plan.Tx, plan.Rx, plan.t0, xi, theta, return_L, return_rays)
+        return plan.scatter(out, return_L, return_rays)
+
+    def tuneSecondaryNodes(self, slowness, Tx=None, Rx=None, tol=1.e-3, candidates=None,
+                           nref=None, nsrc=8, criterion='max', apply=True, seed=0):
+        """
+        Find the smallest number of secondary nodes meeting a traveltime tolerance
+
+        Traveltimes of a random sample of nsrc sources of the survey are
+        computed for each number of secondary nodes in candidates, and
+        compared with traveltimes computed with nref secondary nodes.  The
+        number retained is the smallest one (i.e. the fastest) for which
+        the relative error is below tol, or the most accurate candidate
+        if none meets tol.  The same number is used along all axes.
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3), attribute Tx if None
+            Rx: coordinates of receivers      (ndata x 3), attribute Rx if None
+            tol: tolerance on the relative traveltime error
+            candidates: numbers of secondary nodes to test, by default
+                (2, 3, 4, 5, 6, 8, 10, 12, 15) in 2D and (1, 2, 3, 4) in 3D
+            nref: number of secondary nodes of the reference, twice the
+                largest candidate by default
+            nsrc: number of sources in the sample (all sources if 0)
+            criterion: 'max' or 'mean', statistic of the relative error compared with tol
+            apply: if True, nsnx, nsnz (and nsny in 3D) are set to the selected value
+            seed: seed of the random generator used to draw the sample
+        Output:
+            nsn: selected number of secondary nodes
+            table: array with one row per candidate holding the number of
+                secondary nodes, the raytracing time (s), and the mean and
+                max relative errors
+        """
+        if getattr(self, 'method', 'spm') != 'spm':
+            raise ValueError('Secondary nodes are only used by the shortest path method')
+        if criterion not in ('max', 'mean'):
+            raise ValueError('criterion should be max or mean')
+        if Tx is None:
+            Tx = self.Tx
+        if Rx is None:
+            Rx = self.Rx
+        is3D = self.gry.size > 1
+        if candidates is None:
+            candidates = (1, 2, 3, 4) if is3D else (2, 3, 4, 5, 6, 8, 10, 12, 15)
+        candidates = sorted(candidates)
+        if nref is None:
+            nref = 2 * candidates[-1]
+
+        # all data of the sampled sources are kept, the cost of raytracing
+        # being driven by the number of sources
+        _, isrc = np.unique(Tx, axis=0, return_inverse=True)
+        isrc = isrc.reshape(-1)
+        nsrcTot = isrc.max() + 1
+        if 0 < nsrc < nsrcTot:
+            rng = np.random.default_rng(seed)
+            ind = np.isin(isrc, rng.choice(nsrcTot, nsrc, replace=False))
+            Tx = Tx[ind, :]
+            Rx = Rx[ind, :]
+
+        nsn_prev = (self.nsnx, self.nsny, self.nsnz) if is3D else (self.nsnx, self.nsnz)
+
+        def setNodes(nsn):
+            self.nsnx = self.nsnz = nsn
+            if is3D:
+                self.nsny = nsn
+            self.cgrid = None
+
+        try:
+            setNodes(nref)
+            tt_ref = self.raytrace(slowness, Tx, Rx, return_L=False).astype(np.float64)
+            nz = tt_ref > 0.0
+
+            table = np.zeros((len(candidates), 4))
+            for n, nsn in enumerate(candidates):
+                setNodes(nsn)
+                tic = time.perf_counter()
+                tt = self.raytrace(slowness, Tx, Rx, return_L=False)
+                table[n, 1] = time.perf_counter() - tic
+                err = np.abs(tt[nz] - tt_ref[nz]) / tt_ref[nz]
+                table[n, 0] = nsn
+                table[n, 2] = err.mean()
+                table[n, 3] = err.max()
+        finally:
+            if is3D:
+                self.nsnx, self.nsny, self.nsnz = nsn_prev
+            else:
+                self.nsnx, self.nsnz = nsn_prev
+            self.cgrid = None
+
+        col = 3 if criterion == 'max' else 2
+        ok = np.nonzero(table[:, col] <= tol)[0]
+        if ok.size > 0:
+            nsn = candidates[ok[0]]
+        else:
+            nsn = candidates[int(np.argmin(table[:, col]))]
+        if apply:
+            setNodes(nsn)
+        return nsn, table
+
+    def toGridFrame(self, xyz):
+        """
+        Returns coordinates xyz (n x 3) in the coordinate system of the grid
+        """
+        return np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+
+    def mapConstraints(self, xyz, value, variance=None):
+        """
+        Map point constraints (e.g. Borehole.scont) onto grid cells
+
+        The cell holding each point is found directly from the point
+        coordinates, the grid being regular.  Points outside the grid are
+        discarded, and the values of points falling in the same cell are
+        averaged, the variance of the mean being assigned to the cell.
+
+        Input:
+            xyz: coordinates of the points (n x 3), in the global coordinate
+                system (see toGridFrame)
+            value: constrained values at the points (n, )
+            variance: variances of the values (n, ), zero if None
+        Output:
+            CellConstraints instance
+        """
+        xyz = self.toGridFrame(xyz)
+        value = np.asarray(value, dtype=np.float64).reshape(-1)
+        if variance is None or np.size(variance) == 0:
+            variance = np.zeros(value.shape)
+        variance = np.asarray(variance, dtype=np.float64).reshape(-1)
+        if xyz.shape[0] != value.size or value.size != variance.size:
+            raise ValueError('xyz, value and variance should have the same number of points')
+
+        if self.gry.size > 1:
+            gr = (self.grx, self.gry, self.grz)
+            cols = (0, 1, 2)
+        else:
+            gr = (self.grx, self.grz)
+            cols = (0, 2)
+        ncell = self.getNcell()
+        inside = np.ones(value.shape, dtype=bool)
+        ind = []
+        for g, c, n in zip(gr, cols, ncell):
+            i = np.floor((xyz[:, c] - g[0]) / (g[1] - g[0])).astype(np.int64)
+            # points on the last grid line belong to the last cell
+            i[xyz[:, c] == g[-1]] = n - 1
+            inside &= (i >= 0) & (i < n)
+            ind.append(i)
+        # Z varies fastest, then Y, then X
+        cells = np.ravel_multi_index([i[inside] for i in ind], ncell)
+
+        cells, inv, count = np.unique(cells, return_inverse=True, return_counts=True)
+        inv = inv.reshape(-1)
+        return CellConstraints(cells,
+                               np.bincount(inv, weights=value[inside]) / count,
+                               np.bincount(inv, weights=variance[inside]) / count**2,
+                               count)
+
+    def derivative(self, order, normalize=False):
+        """
+        Compute spatial derivative operators for grid _cells_
+
+        For 1st order:
+            forward operator is (u_{i+1} - u_i)/dx
+            centered operator is (u_{i+1} - u_{i-1})/(2dx)
+            backward operator is (u_i - u_{i-1})/dx
+
+        For 2nd order:
+            forward operator is (u_i - 2u_{i+1} + u_{i+2})/dx^2
+            centered operator is (u_{i-1} - 2u_i + u_{i+1})/dx^2
+            backward operator is (u_{i-2} - 2u_{i-1} + u_i)/dx^2
+
+        Forward operators are used at the first cell(s) and backward
+        operators at the last cell(s).  For 2D grids, Dy has no rows.
+
+        Operators are cached for each grid geometry, order and
+        normalization, and should therefore not be modified in place.
+        """
+        if normalize:
+            d = (self.dx, self.dy, self.dz)
+        else:
+            d = (1, 1, 1)
+        d = tuple(float(v) for v in d)
+        return _derivativeOperators(self.getNcell(), d, order)
+
     @staticmethod
     def lsplane(X, *, nout):
         """
@@ -197,13 +498,9 @@ class Grid(object):
         Output:
             p_data : projected coordinates (nx3)
         """
-        p_data = data.copy()
-        for n in np.arange(data.shape[0]):
-            r = x0 - data[n, :]
-            p = np.dot(a, r)
-            p_data[n, :] = data[n, :] + p * a
-
-        return p_data
+        a = np.asarray(a, dtype=np.float64)
+        p = np.einsum('ij,j->i', x0 - data, a)
+        return data + np.outer(p, a)
 
     @staticmethod
     def proj_planes(data, planes):
@@ -220,17 +517,14 @@ class Grid(object):
             p_data : projected coordinates (nx3)
             no_plane : index of plane on which data is projected (n,)
         """
-        p_data = data.copy()
-        no_plane = np.zeros((data.shape[0],), dtype=int)
-        p = np.zeros((len(planes),))
-        for n in np.arange(data.shape[0]):
-            for nn in np.arange(len(planes)):
-                r = planes[nn].x0 - data[n, :]
-                p[nn] = np.dot(planes[nn].a, r)
+        x0 = np.array([plane.x0 for plane in planes], dtype=np.float64).reshape(-1, 3)
+        a = np.array([plane.a for plane in planes], dtype=np.float64).reshape(-1, 3)
+
+        # signed distance of each point (rows) to each plane (columns)
+        p = np.einsum('ijk,jk->ij', x0[np.newaxis, :, :] - data[:, np.newaxis, :], a)
 
-            no = np.argmin(np.abs(p))  # find plane closest to current point
-            p_data[n, :] = data[n, :] + p[no] * planes[no].a  # project on closest plane
-            no_plane[n] = no
+        no_plane = np.argmin(np.abs(p), axis=1)  # find plane closest to each point
+        p_data = data + p[np.arange(data.shape[0]), no_plane, np.newaxis] * a[no_plane, :]  # project on closest plane
 
         return p_data, no_plane
 
@@ -247,19 +541,438 @@ class Grid(object):
         # rotation w/r to azimuth
         if np.abs(az) > (math.pi / 720.0):  # if azimuth larger that 1/4 of a degree
             rot = np.array([[np.cos(az), -np.sin(az)], [np.sin(az), np.cos(az)]])
-            for n in np.arange(m_data.shape[0]):
-                m_data[n, :2] = np.dot(m_data[n, :2], rot.T)
-                # np.dot(m_data[n,:2], rot.T) is equal to np.dot(rot, m_data[n,:2].T).T
+            m_data[:, :2] = np.dot(m_data[:, :2], rot.T)
+            # np.dot(m_data[:,:2], rot.T) is equal to np.dot(rot, m_data[:,:2].T).T
 
         # rotation w/r to dip
         if np.abs(dip) > (math.pi / 720.0):  # if azimuth larger that 1/4 of a degree
             rot = np.array([[np.cos(dip), -np.sin(dip)], [np.sin(dip), np.cos(dip)]])
-            for n in np.arange(m_data.shape[0]):
-                m_data[n, 1:] = np.dot(m_data[n, 1:], rot.T)
+            m_data[:, 1:] = np.dot(m_data[:, 1:], rot.T)
 
         return m_data
 
 
+class Rays(object):
+    """
+    Raypaths stored in a flat buffer
+
+    The points of all rays are stored one after the other (npts x 2 for 2D
+    grids, npts x 3 for 3D grids), the points of ray n being rows
+    offsets[n] to offsets[n+1] of coords.  Coordinates are kept as uint16
+    steps from the lower corner of the bounding box of the points (q,
+    origin and step), i.e. within step / 2 = extent / 131070 of the
+    coordinates given, and are decoded to float32 by coords and when
+    indexing.  Indexing with an integer returns the points of a ray, as
+    with the tuple of arrays formerly used, and indexing with a slice or an
+    array of indices returns a new Rays instance.  When pickled,
+    consecutive points are stored as zlib compressed differences.
+    """
+    nlevels = 65535
+
+    def __init__(self, coords=None, offsets=None, ndim=2):
+        if coords is None:
+            coords = np.zeros((0, ndim), dtype=np.float32)
+        if offsets is None:
+            offsets = np.zeros((1, ), dtype=np.int32)
+        coords = np.asarray(coords, dtype=np.float64)
+        if coords.shape[0] > 0:
+            self.origin = coords.min(axis=0)
+            self.step = (coords.max(axis=0) - self.origin) / Rays.nlevels
+            self.step[self.step == 0] = 1.0
+        else:
+            self.origin = np.zeros((coords.shape[1], ))
+            self.step = np.ones((coords.shape[1], ))
+        self.q = np.round((coords - self.origin) / self.step).astype(np.uint16)
+        self.offsets = Rays._offsets(offsets)
+
+    @staticmethod
+    def _offsets(offsets):
+        # int32 unless there are more points than it can index
+        offsets = np.asarray(offsets)
+        if offsets[-1] < 2**31:
+            return offsets.astype(np.int32)
+        return offsets.astype(np.int64)
+
+    @staticmethod
+    def _fromQuantized(q, offsets, origin, step):
+        rays = Rays.__new__(Rays)
+        rays.q = q
+        rays.offsets = Rays._offsets(offsets)
+        rays.origin = origin
+        rays.step = step
+        return rays
+
+    def _decode(self, q):
+        return (q * self.step + self.origin).astype(np.float32)
+
+    @property
+    def coords(self):
+        """
+        Coordinates of the points of all rays (float32)
+        """
+        return self._decode(self.q)
+
+    @property
+    def nbytes(self):
+        return self.q.nbytes + self.offsets.nbytes
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, (int, np.integer)):
+            n = range(len(self))[n]  # negative indices and bounds checking
+            return self._decode(self.q[self.offsets[n]:self.offsets[n + 1], :])
+        return self.take(np.arange(len(self))[n])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self._decode(self.q[self.offsets[n]:self.offsets[n + 1], :])
+
+    def __getstate__(self):
+        # differences of consecutive points are small and compress well,
+        # uint16 arithmetic wraps around and cumsum restores q exactly
+        d = self.q.copy()
+        d[1:] -= self.q[:-1]
+        return {'shape': self.q.shape, 'dq': zlib.compress(d.tobytes()),
+                'npts': zlib.compress(self.npts().astype(np.int32).tobytes()),
+                'origin': self.origin, 'step': self.step}
+
+    def __setstate__(self, state):
+        d = np.frombuffer(zlib.decompress(state['dq']), dtype=np.uint16).reshape(state['shape'])
+        npts = np.frombuffer(zlib.decompress(state['npts']), dtype=np.int32)
+        offsets = np.zeros((npts.size + 1, ), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        self.q = np.cumsum(d, axis=0, dtype=np.uint16)
+        self.offsets = Rays._offsets(offsets)
+        self.origin = state['origin']
+        self.step = state['step']
+
+    def npts(self):
+        """
+        Returns the number of points of each ray
+        """
+        return np.diff(self.offsets)
+
+    def take(self, ind):
+        """
+        Returns a Rays instance holding rays ind
+        """
+        ind = np.asarray(ind)
+        if ind.dtype == bool:
+            ind = np.nonzero(ind)[0]
+        npts = self.npts()[ind]
+        offsets = np.zeros((ind.size + 1, ), dtype=np.int64)
+        np.cumsum(npts, out=offsets[1:])
+        # index in q of each point of the selected rays
+        ipts = np.repeat(self.offsets[ind] - offsets[:-1], npts) + np.arange(offsets[-1])
+        return Rays._fromQuantized(self.q[ipts, :], offsets, self.origin, self.step)
+
+    @staticmethod
+    def concatenate(rays):
+        """
+        Returns a Rays instance holding all rays of the Rays instances in list rays
+        """
+        offsets = np.concatenate([[0]] + [r.npts() for r in rays]).cumsum()
+        if all(np.array_equal(r.origin, rays[0].origin) and np.array_equal(r.step, rays[0].step) for r in rays):
+            return Rays._fromQuantized(np.concatenate([r.q for r in rays]), offsets, rays[0].origin, rays[0].step)
+        return Rays(np.concatenate([r.coords for r in rays]), offsets)
+
+    def segments(self, ind=None, dims=(0, -1)):
+        """
+        Returns a list of arrays holding coordinates dims of the points of
+        the rays, to build a matplotlib LineCollection (all rays are
+        returned if ind is None)
+        """
+        r = self if ind is None else self.take(np.arange(len(self))[ind])
+        c = r.coords[:, dims]
+        return [c[r.offsets[n]:r.offsets[n + 1], :] for n in range(len(r))]
+
+    def plotData(self, ind=None, dims=(0, -1)):
+        """
+        Returns coordinates dims of the rays, separated with NaN, so that
+        all rays can be drawn with a single call to plot
+        """
+        r = self if ind is None else self.take(np.arange(len(self))[ind])
+        npts = r.npts()
+        out = np.full((r.q.shape[0] + len(r), len(dims)), np.nan, dtype=np.float32)
+        out[np.arange(r.q.shape[0]) + np.repeat(np.arange(len(r)), npts), :] = r.coords[:, dims]
+        return tuple(out.T)
+
+    def reverse(self):
+        """
+        Returns a Rays instance holding the rays traversed in the opposite direction
+        """
+        npts = self.npts()
+        # point p of ray n goes to offsets[n+1]-1-p
+        ipts = np.repeat(self.offsets[:-1] + self.offsets[1:] - 1, npts) - np.arange(self.q.shape[0])
+        return Rays._fromQuantized(self.q[ipts, :], self.offsets.copy(), self.origin, self.step)
+
+    def save(self, filename):
+        """
+        Save rays in compressed npz format
+        """
+        np.savez_compressed(filename, q=self.q, offsets=self.offsets, origin=self.origin, step=self.step)
+
+    @staticmethod
+    def load(filename):
+        """
+        Load rays saved with Rays.save
+        """
+        with np.load(filename) as f:
+            return Rays._fromQuantized(f['q'], f['offsets'], f['origin'], f['step'])
+
+
+class SourcePlan(object):
+    """
+    Raytracing plan with merged sources
+
+    Positions closer than tol along coordinates dims are considered
+    identical, the first position found being used for raytracing.  Each
+    distinct source-receiver pair is raytraced once.  If reciprocity is
+    True and t0 is constant, sources and receivers are swapped when
+    receivers have fewer distinct positions; raypaths are then reversed
+    when scattered back.  Merged positions differ by less than tol along
+    each coordinate, i.e. traveltimes change by less than
+    max(slowness) * tol * sqrt(len(dims)), except for positions on cell
+    boundaries, where traveltimes of the shortest path method are not
+    continuous (the cells used to start the rays change).  They may also
+    change with the swap, by much more than that, as the shortest path
+    method is not exactly reciprocal (differences are within the
+    accuracy of the method, see Grid.tuneSecondaryNodes).
+
+    Attributes:
+        Tx, Rx, t0: data to raytrace
+        swap: True if Tx and Rx were swapped
+        ind: row of Tx, Rx and t0 holding each original data
+        nsrcIn: number of distinct sources of the original data
+        nsrc: number of sources to raytrace
+        reduction: nsrcIn / nsrc
+    """
+    def __init__(self, Tx, Rx, t0=(), reciprocity=True, tol=1.e-6, dims=(0, 2)):
+        Tx = np.asarray(Tx, dtype=np.float64)
+        Rx = np.asarray(Rx, dtype=np.float64)
+        if len(t0) == 0:
+            t0 = np.zeros((Tx.shape[0], ))
+        t0 = np.asarray(t0, dtype=np.float64)
+        dims = list(dims)
+
+        # distinct positions, on a grid of step tol
+        _, iTx, uTx = np.unique(np.round(Tx[:, dims] / tol), axis=0, return_index=True, return_inverse=True)
+        _, iRx, uRx = np.unique(np.round(Rx[:, dims] / tol), axis=0, return_index=True, return_inverse=True)
+        uTx = uTx.reshape(-1)
+        uRx = uRx.reshape(-1)
+
+        self.nsrcIn = np.unique(Tx[:, dims], axis=0).shape[0] if Tx.shape[0] > 0 else 0
+        self.swap = bool(reciprocity and iRx.size < iTx.size and np.all(t0 == t0[0]))
+        if self.swap:
+            src, isrc, rcv, ircv = Rx, iRx[uRx], Tx, iTx[uTx]
+            self.nsrc = iRx.size
+        else:
+            src, isrc, rcv, ircv = Tx, iTx[uTx], Rx, iRx[uRx]
+            self.nsrc = iTx.size
+
+        # distinct source-receiver pairs
+        _, ipair, ind = np.unique(np.vstack((isrc, ircv)).T, axis=0, return_index=True, return_inverse=True)
+        self.ind = ind.reshape(-1)
+        self.Tx = src[isrc[ipair], :]
+        self.Rx = rcv[ircv[ipair], :]
+        self.t0 = t0[ipair]
+        self.reduction = self.nsrcIn / self.nsrc if self.nsrc > 0 else 1.0
+
+    def scatter(self, out, return_L=True, return_rays=False):
+        """
+        Put output out of raytrace, obtained with the planned data, back in
+        the order of the original data
+        """
+        if not return_L and not return_rays:
+            return out[self.ind]
+        out = list(out)
+        out[0] = out[0][self.ind]
+        if return_L:
+            out[1] = out[1][self.ind, :]
+        if return_rays:
+            rays = out[-1].take(self.ind)
+            out[-1] = rays.reverse() if self.swap else rays
+        return tuple(out)
+
+
+class CellConstraints(object):
+    """
+    Constraints on the values of grid cells, built with Grid.mapConstraints
+
+    Attributes:
+        cells: indices of the constrained cells
+        value: value at each cell (mean of the points in the cell)
+        variance: variance of each value
+        npoints: number of points averaged in each cell
+    """
+    def __init__(self, cells=None, value=None, variance=None, npoints=None):
+        self.cells = np.zeros((0, ), dtype=np.int64) if cells is None else cells
+        self.value = np.zeros((0, )) if value is None else value
+        self.variance = np.zeros((0, )) if variance is None else variance
+        self.npoints = np.zeros((0, ), dtype=np.int64) if npoints is None else npoints
+
+    def __len__(self):
+        return self.cells.size
+
+    def weights(self, wCont):
+        """
+        Returns the weight of each constraint
+
+        Weights are wCont divided by the standard deviation of the values
+        relative to the mean standard deviation, i.e. wCont for all
+        constraints if variances are equal, and wCont for constraints with
+        a null variance.
+        """
+        w = np.full(self.value.shape, float(wCont))
+        pos = self.variance > 0.0
+        if np.any(pos):
+            w[pos] *= np.mean(np.sqrt(self.variance[pos])) / np.sqrt(self.variance[pos])
+        return w
+
+    def rows(self, ncell, wCont, dtype=np.float64):
+        """
+        Returns the rows to append to a system of equations for the
+        values of the ncell cells, i.e. C (sparse, nconstraints x ncell)
+        and d such that C * x = d, weighted by wCont and the variances
+        """
+        w = self.weights(wCont)
+        C = csr_matrix((w.astype(dtype), (np.arange(self.cells.size), self.cells)),
+                       shape=(self.cells.size, ncell))
+        return C, (w * self.value).astype(dtype)
+
+
+class StraightRayCache(object):
+    """
+    On-disk cache of straight ray projection matrices
+
+    Matrices are stored in npz files in directory path, one file per
+    matrix, named after a hash of the grid node coordinates, of the Tx and
+    Rx coordinates of the selected data and of the type of matrix.  Least
+    recently used matrices are removed when the cache holds more than
+    maxEntries matrices or more than maxSize bytes.
+    """
+    def __init__(self, path, maxSize=500 * 1024**2, maxEntries=64):
+        self.path = path
+        self.maxSize = maxSize
+        self.maxEntries = maxEntries
+
+    @staticmethod
+    def sidecar(dbfile, **kwargs):
+        """
+        Returns a cache stored next to database file dbfile, or None for an
+        in-memory database
+        """
+        if dbfile == ':memory:' or dbfile == '':
+            return None
+        return StraightRayCache(dbfile + '.rays', **kwargs)
+
+    @staticmethod
+    def key(*arrays):
+        """
+        Returns the key of the matrix built from arrays (grid node
+        coordinates, Tx, Rx, ...); scalars and strings are accepted
+        """
+        h = hashlib.sha1()
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            h.update(str((a.dtype.str, a.shape)).encode())
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the matrix stored under key, or None if not in cache
+        """
+        filename = self._file(key)
+        try:
+            with np.load(filename) as f:
+                L = csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            os.utime(filename)  # most recently used
+        except (OSError, KeyError, ValueError):
+            return None
+        return L
+
+    def put(self, key, L):
+        """
+        Store matrix L under key and evict least recently used matrices
+        """
+        L = csr_matrix(L)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # write to a temporary file first, so that an interrupted write
+            # does not leave a corrupted matrix in the cache
+            tmp = self._file(key + '.tmp')
+            with open(tmp, 'wb') as f:
+                np.savez(f, data=L.data, indices=L.indices, indptr=L.indptr, shape=np.array(L.shape))
+            os.replace(tmp, self._file(key))
+        except OSError:
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used matrices until the cache size limits are met
+        """
+        try:
+            entries = [e for e in os.scandir(self.path) if e.name.endswith('.npz') and e.is_file()]
+        except OSError:
+            return
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries), reverse=True)
+        total = 0
+        for n, (_, size, path) in enumerate(entries):
+            total += size
+            if n >= self.maxEntries or total > self.maxSize:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        """
+        Remove all matrices from the cache
+        """
+        maxEntries = self.maxEntries
+        self.maxEntries = 0
+        self.evict()
+        self.maxEntries = maxEntries
+
+
+# Process-pool raytracing backend
+#
+# Each worker process holds its own Grid2Dcpp instance, and reads the
+# slowness, xi and theta vectors from shared memory filled by the parent
+# before each call to Grid2D.raytrace.
+
+_pool_grid = None
+_pool_model = None
+
+
+def _poolInit(typeG, grid_args, shared, single=False):
+    global _pool_grid, _pool_model
+    _pool_grid = cgrid2d.Grid2Dcpp(typeG, *grid_args)
+    _pool_grid.setSinglePrecision(single)
+    _pool_model = [np.frombuffer(a, dtype=np.float64) if a is not None else () for a in shared]
+
+
+def _poolRaytrace(task):
+    ind, Tx, Rx, t0, return_L, return_rays = task
+    slowness, xi, theta = _pool_model
+    out = _pool_grid.raytrace(slowness, xi, theta, Tx, Rx, t0, return_L, return_rays)
+    if not isinstance(out, tuple):
+        out = (out, )
+    return (ind, ) + out
+
+
+# spectral matrices computed by Grid2D.preFFTMA, least recently used first
+_fftma_cache = collections.OrderedDict()
+_fftma_cache_size = 8
+
+
 class Grid2D(Grid):
     """
     Class for 2D grids
@@ -273,37 +986,46 @@ class Grid2D(Grid):
 
     """
 
-    def __init__(self, grx=None, grz=None, nthreads=1):
+    def __init__(self, grx=None, grz=None, nthreads=1, nprocesses=1):
         Grid.__init__(self)
         if grx is not None:
             self.grx = grx
         if grz is not None:
             self.grz = grz
         self.nthreads = nthreads
+        self.nprocesses = nprocesses  # if > 1, raytracing is done in a pool of processes
+        self.method = 'spm'  # 'spm' for shortest path, 'fmm' for fast marching (traveltimes only)
         self.nsnx = 10
         self.nsnz = 10
         self.cgrid = None
+        self.pool = None
+        self.pool_key = None
+        self.pool_model = None
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
         self.borehole_x0 = 1
         self.x0 = np.array([])
+        self.proj = None  # (x0, a, az, dip) of the plane of the grid, see toGridFrame
         self.type = None
 
     def __reduce__(self):
         # cgrid excluded volontarily, it will be set to None after unpickling
         # (cgrid is instantiated when needed in method raytrace)
         # this is done to avoid writing code to pickle cython class Grid2Dcpp
+        # (the process pool is excluded for the same reason)
         return (Grid2D.rebuild, (self.grx, self.grz, self.cont, self.Tx, self.Rx,
                                  self.TxCosDir, self.RxCosDir, self.border,
                                  self.Tx_Z_water, self.Rx_Z_water, self.in_vect,
                                  self.nthreads, self.nsnx, self.nsnz, self.flip,
-                                 self.borehole_x0, self.x0, self.type))
+                                 self.borehole_x0, self.x0, self.type, self.nprocesses,
+                                 self.method, self.precision, self.proj))
 
     @staticmethod
     def rebuild(grx, grz, cont, Tx, Rx, TxCosDir, RxCosDir, border, Tx_Z_water,
-                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type):
+                Rx_Z_water, in_vect, nthreads, nsnx, nsnz, flip, borehole_x0, x0, _type,
+                nprocesses=1, method='spm', precision='float64', proj=None):
 
-        g = Grid2D(grx, grz, nthreads)
+        g = Grid2D(grx, grz, nthreads, nprocesses)
 
         g.cont = cont
         g.Tx = Tx
@@ -320,16 +1042,42 @@ class Grid2D(Grid):
         g.borehole_x0 = borehole_x0
         g.x0 = x0
         g.type = _type
+        g.method = method
+        g.precision = precision
+        g.proj = proj
 
         return g
 
-    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=()):
+    def toGridFrame(self, xyz):
+        """
+        Returns coordinates xyz (n x 3) in the coordinate system of the grid
+
+        If attribute proj holds the plane of the grid (point x0 and normal
+        a, as returned by lsplane) and the azimuth and dip of the plane,
+        points are projected on the plane and expressed relative to origin
+        x0 of the grid, as Tx and Rx.  Coordinates are returned unchanged
+        otherwise.
+        """
+        xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+        if self.proj is None:
+            return xyz
+        x0, a, az, dip = self.proj
+        return Grid.transl_rotat(Grid.proj_plane(xyz, x0, a), self.x0, az, dip)
+
+    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), return_L=True, return_rays=False):
         """
         Compute traveltimes, raypaths and build ray projection matrix
 
+        Traveltimes are computed with the shortest path method, or with the
+        fast marching method if attribute method is 'fmm'.  In the latter
+        case, only traveltimes in isotropic media are available, i.e.
+        return_L and return_rays must be False.
+
         Usages:
-            tt,L,rays = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)
-            tt,L = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)  {Note: rays can be omitted from output}
+            tt,L,rays = grid.raytrace(slowness,Tx,Rx,t0,xi,theta,return_rays=True)
+            tt,L = grid.raytrace(slowness,Tx,Rx,t0,xi,theta)
+            tt = grid.raytrace(slowness,Tx,Rx,t0,xi,theta,return_L=False)
+            tt,rays = grid.raytrace(slowness,Tx,Rx,t0,xi,theta,return_L=False,return_rays=True)
 
         Input:
             slowness: vector of slowness values at grid cells (ncell x 1)
@@ -340,14 +1088,16 @@ class Grid2D(Grid):
                 values are ratio of slowness in Z over slowness in X
             theta (optional): angle of rotation of the ellipse of anisotropy ( ncell x 1 ),
                 counter-clockwise from horizontal, units in radian
+            return_L: if True, return the ray projection matrix
+            return_rays: if True, return the raypaths (raypaths are only
+                reconstructed when L or the rays are needed)
         Output:
             tt: vector of traveltimes, ndata by 1
             L: ray projection matrix, ndata by ncell (ndata x 2*ncell for anisotropic media)
-            rays: tuple containing the matrices of coordinates of the ray
-                  paths, ndata by 1.  Each matrix is nPts by 2
+            rays: Rays instance holding the coordinates of the ray paths,
+                  rays[n] is the nPts by 2 matrix of ray n (float32)
         """
 
-        nout = nargout()
         # check input data consistency
 
         if Tx.ndim != 2 or Rx.ndim != 2:
@@ -373,27 +1123,241 @@ class Grid2D(Grid):
         elif len(t0) != Tx.shape[0]:
             raise ValueError('Length of t0 should equal number of Tx')
 
+        typeG = b'iso'
+        if len(xi) != 0:
+            if len(theta) != 0:
+                typeG = b'tilted'
+            else:
+                typeG = b'elliptical'
+
+        if self.method == 'fmm':
+            if return_L or return_rays:
+                raise ValueError('L and raypaths are not available with the fast marching method')
+            if typeG != b'iso':
+                raise ValueError('Fast marching method only available for isotropic media')
+            if self.cgrid is None:
+                self.cgrid = cgrid2d.Grid2Dcpp(typeG, *self._cgridArgs(self.nthreads))
+            return self._toPrecision(self.cgrid.raytraceFMM(slowness, Tx, Rx, t0))
+        elif self.method != 'spm':
+            raise ValueError('Unknown raytracing method: ' + str(self.method))
+
+        if self.nprocesses > 1:
+            return self._raytracePool(typeG, slowness, Tx, Rx, t0, xi, theta, return_L, return_rays)
+
         if self.cgrid is None:
-            nx = len(self.grx) - 1
-            nz = len(self.grz) - 1
-            dx = self.grx[1] - self.grx[0]
-            dz = self.grz[1] - self.grz[0]
+            self.cgrid = cgrid2d.Grid2Dcpp(typeG, *self._cgridArgs(self.nthreads))
+        self.cgrid.setSinglePrecision(self.getDtype() == np.float32)
 
-            typeG = b'iso'
-            if len(xi) != 0:
-                if len(theta) != 0:
-                    typeG = b'tilted'
-                else:
-                    typeG = b'elliptical'
-            self.cgrid = cgrid2d.Grid2Dcpp(typeG, nx, nz, dx, dz, self.grx[0], self.grz[0],
-                                           self.nsnx, self.nsnz, self.nthreads)
-
-        if nout == 2:
-            tt, L = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L
-        elif nout == 3:
-            tt, L, rays = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0)
-            return tt, L, rays
+        out = self.cgrid.raytrace(slowness, xi, theta, Tx, Rx, t0, return_L, return_rays)
+        if return_rays:
+            out = out[:-1] + (Rays(*out[-1]), )
+        return self._toPrecision(out)
+
+    def raytraceBending(self, slowness, Tx, Rx, rays, t0=(), maxit=30, tol=1.e-4, return_rays=False):
+        """
+        Refine raypaths by bending after a change of slowness
+
+        Each ray of rays (e.g. the raypaths of the previous curved ray
+        iteration) is resampled with nodes regularly spaced along its
+        length, and its nodes are moved to minimize the traveltime in
+        slowness, interpolated bilinearly between cell centers.  Rays not
+        converged after maxit iterations are computed again with the
+        shortest path method.  Traveltimes and L are those of the bent
+        rays in the cell-constant slowness model.  Isotropic media only.
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3)
+            Rx: coordinates of receivers      (ndata x 3)
+            rays: Rays instance holding the initial raypaths (ndata rays)
+            t0 (optional): initial time at sources points (ndata x 1)
+            maxit: maximum number of bending iterations
+            tol: convergence criterion, on the relative decrease of traveltime
+                and on the size of node moves relative to the cell size
+            return_rays: if True, return the raypaths
+        Output:
+            tt: vector of traveltimes, ndata by 1
+            L: ray projection matrix, ndata by ncell
+            rays: Rays instance holding the raypaths (if return_rays is True)
+            ind: boolean vector, True for data computed with the shortest path method
+        """
+        if len(rays) != Tx.shape[0] or Tx.shape != Rx.shape:
+            raise ValueError('rays, Tx and Rx should have ndata rows')
+        if len(slowness) != self.getNumberOfCells():
+            raise ValueError('Length of slowness vector should equal number of cells')
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        t0 = np.asarray(t0)
+
+        nx, nz = self.getNcell()
+        h = min(self.dx, self.dz)
+        lo = np.array([self.grx[0], self.grz[0]])
+        hi = np.array([self.grx[-1], self.grz[-1]])
+        S = np.asarray(slowness, dtype=np.float64).reshape(nx, nz)
+
+        # rays go from Tx to Rx, with end points exactly at Tx and Rx
+        tx = Tx[:, [0, 2]]
+        rx = Rx[:, [0, 2]]
+        first = rays._decode(rays.q[rays.offsets[:-1], :])
+        last = rays._decode(rays.q[np.maximum(rays.offsets[1:] - 1, 0), :])
+        if np.sum((first - tx)**2) > np.sum((last - tx)**2):
+            rays = rays.reverse()
+        # about one node per cell along the longest ray
+        ltot = np.sqrt(np.sum((rx - tx)**2, axis=1))
+        npts = int(min(max(np.ceil(1.5 * np.max(ltot, initial=h) / h), 4), 1000)) + 1
+        P = _resamplePolylines(rays.coords.astype(np.float64), rays.offsets, npts)
+        P[:, 0, :] = tx
+        P[:, -1, :] = rx
+
+        def traveltime(P):
+            l = np.sqrt(np.sum(np.diff(P, axis=1)**2, axis=2))
+            s, _ = _bilinear(S, P, lo, self.dx, self.dz)
+            return np.sum(l * 0.5 * (s[:, :-1] + s[:, 1:]), axis=1)
+
+        def gradient(P):
+            d = np.diff(P, axis=1)
+            l = np.sqrt(np.sum(d**2, axis=2))
+            u = d / np.maximum(l, 1.e-12 * h)[:, :, None]
+            s, ds = _bilinear(S, P, lo, self.dx, self.dz)
+            m = 0.5 * (s[:, :-1] + s[:, 1:])
+            G = np.zeros(P.shape)
+            G[:, 1:-1, :] = (u[:, :-1, :] * m[:, :-1, None] - u[:, 1:, :] * m[:, 1:, None] +
+                             0.5 * (l[:, :-1] + l[:, 1:])[:, :, None] * ds[:, 1:-1, :])
+            return G
+
+        T = traveltime(P)
+        step = np.full((P.shape[0], ), 0.5 * h)
+        converged = np.zeros((P.shape[0], ), dtype=bool)
+        active = np.arange(P.shape[0])
+        for it in range(maxit):
+            if active.size == 0:
+                break
+            Pa = P[active]
+            G = gradient(Pa)
+            gmax = np.max(np.sqrt(np.sum(G**2, axis=2)), axis=1)
+            gmax[gmax == 0.0] = 1.0
+            # nodes moved by at most step, then spaced regularly again
+            Ptry = np.clip(Pa - (step[active] / gmax)[:, None, None] * G, lo, hi)
+            Ptry[:, 0, :] = Pa[:, 0, :]
+            Ptry[:, -1, :] = Pa[:, -1, :]
+            Ptry = _resamplePolylines(Ptry.reshape(-1, 2), np.arange(active.size + 1) * npts, npts)
+            Ttry = traveltime(Ptry)
+
+            better = Ttry < T[active]
+            decrease = T[active] - Ttry
+            ib = active[better]
+            P[ib] = Ptry[better]
+            T[ib] = Ttry[better]
+            step[ib] *= 1.5
+            step[active[~better]] *= 0.5
+
+            done = (better & (decrease <= tol * Ttry)) | (step[active] < tol * h)
+            converged[active[done]] = True
+            active = active[~done]
+
+        ind = ~converged
+        L = _polylinesL(P, self.grx, self.grz)
+        if return_rays:
+            out_rays = Rays(P.reshape(-1, 2).astype(np.float32), np.arange(P.shape[0] + 1, dtype=np.int64) * npts)
+        if np.any(ind):
+            out = self.raytrace(slowness, Tx[ind, :], Rx[ind, :], t0[ind], return_rays=return_rays)
+            iold = np.nonzero(~ind)[0]
+            inew = np.nonzero(ind)[0]
+            order = np.argsort(np.concatenate((iold, inew)))
+            L = scipy.sparse.vstack((L[iold, :], out[1]), format='csr')[order, :]
+            if return_rays:
+                out_rays = Rays.concatenate((out_rays.take(iold), out[2])).take(order)
+
+        tt = L * np.asarray(slowness, dtype=np.float64) + t0
+        L = L.astype(self.getDtype())
+        tt = tt.astype(self.getDtype())
+        if return_rays:
+            return tt, L, out_rays, ind
+        return tt, L, ind
+
+    def _cgridArgs(self, nthreads):
+        nx = len(self.grx) - 1
+        nz = len(self.grz) - 1
+        dx = self.grx[1] - self.grx[0]
+        dz = self.grz[1] - self.grz[0]
+        return (nx, nz, dx, dz, self.grx[0], self.grz[0], self.nsnx, self.nsnz, nthreads)
+
+    def _raytracePool(self, typeG, slowness, Tx, Rx, t0, xi, theta, return_L, return_rays):
+        """
+        Raytrace in a pool of processes, sources are partitioned between the
+        workers and the results are put back in the original data order
+        """
+        ncell = len(slowness)
+        single = self.getDtype() == np.float32
+        key = (typeG, ncell, self.nprocesses, single) + self._cgridArgs(1)
+        if self.pool is None or self.pool_key != key:
+            self.closePool()
+            shared = [RawArray('d', ncell), None, None]
+            if typeG != b'iso':
+                shared[1] = RawArray('d', ncell)
+            if typeG == b'tilted':
+                shared[2] = RawArray('d', ncell)
+            # each worker runs a single thread, parallelism comes from the processes
+            self.pool = multiprocessing.Pool(self.nprocesses, _poolInit,
+                                             (typeG, self._cgridArgs(1), shared, single))
+            self.pool_key = key
+            self.pool_model = [np.frombuffer(a, dtype=np.float64) if a is not None else None for a in shared]
+
+        self.pool_model[0][:] = slowness
+        if len(xi) != 0:
+            self.pool_model[1][:] = xi
+        if len(theta) != 0:
+            self.pool_model[2][:] = theta
+
+        # all data of a given source go to the same worker, and sources are
+        # dealt round robin in more tasks than workers to balance the load
+        _, isrc = np.unique(Tx[:, [0, 2]], axis=0, return_inverse=True)
+        isrc = isrc.reshape(-1)
+        nsrc = isrc.max() + 1
+        ntask = min(nsrc, 4 * self.nprocesses)
+        task_no = (np.arange(nsrc) % ntask)[isrc]
+
+        tasks = []
+        for n in range(ntask):
+            ind = np.nonzero(task_no == n)[0]
+            tasks.append((ind, Tx[ind, :], Rx[ind, :], t0[ind], return_L, return_rays))
+
+        results = self.pool.map(_poolRaytrace, tasks)
+
+        ind = np.concatenate([r[0] for r in results])
+        tt = np.empty((Tx.shape[0], ), dtype=self.getDtype())
+        tt[ind] = np.concatenate([r[1] for r in results])
+        out = [tt]
+        if return_L:
+            L = scipy.sparse.vstack([r[2] for r in results], format='csr')
+            out.append(L[np.argsort(ind), :])
+        if return_rays:
+            rays = Rays.concatenate([Rays(*r[-1]) for r in results])
+            out.append(rays.take(np.argsort(ind)))
+
+        if len(out) == 1:
+            return tt
+        return tuple(out)
+
+    def closePool(self):
+        """
+        Terminate the processes used for raytracing, if any
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.pool_key = None
+        self.pool_model = None
+
+    def getThreadTiming(self):
+        """
+        Return the wall time (s) and the number of sources processed by each
+        thread during the last call to raytrace
+        """
+        if self.cgrid is None:
+            return np.array([]), np.array([], dtype=np.int64)
+        return self.cgrid.getThreadTiming()
 
     def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
         """
@@ -422,10 +1386,23 @@ class Grid2D(Grid):
         else:
             grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
 
+        Tx = self.Tx[np.ix_(ind, [0, 2])]
+        Rx = self.Rx[np.ix_(ind, [0, 2])]
+
+        if self.rayCache is not None:
+            key = self.rayCache.key(grx, grz, Tx, Rx, bool(aniso))
+            L = self.rayCache.get(key)
+            if L is not None:
+                return L.astype(self.getDtype(), copy=False)
+
         if not aniso:
-            return cgrid2d.Grid2Dcpp.Lsr2d(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
+            L = cgrid2d.Grid2Dcpp.Lsr2d(Tx, Rx, grx, grz)
         else:
-            return cgrid2d.Grid2Dcpp.Lsr2da(self.Tx[np.ix_(ind, [0, 2])], self.Rx[np.ix_(ind, [0, 2])], grx, grz)
+            L = cgrid2d.Grid2Dcpp.Lsr2da(Tx, Rx, grx, grz)
+
+        if self.rayCache is not None:
+            self.rayCache.put(key, L)
+        return L.astype(self.getDtype(), copy=False)
 
     def getCellCenter(self, dx=None, dz=None):
         """
@@ -476,190 +1453,131 @@ class Grid2D(Grid):
 
         return True
 
-    def derivative(self, order, normalize=False):
-        """
-        Compute spatial derivative operators for grid _cells_
-
-        For 1st order:
-            forward operator is (u_{i+1} - u_i)/dx
-            centered operator is (u_{i+1} - u_{i-1})/(2dx)
-            backward operator is (u_i - u_{i-1})/dx
-
-        For 2nd order:
-            forward operator is (u_i - 2u_{i+1} + u_{i+2})/dx^2
-            centered operator is (u_{i-1} - 2u_i + u_{i+1})/dx^2
-            backward operator is (u_{i-2} - 2u_{i-1} + u_i)/dx^2
-        """
-        dx = 1
-        dz = 1
-        if normalize:
-            dx = self.dx()
-            dz = self.dz()
-
-        nx = len(self.grx) - 1
-        nz = len(self.grz) - 1
-
-        if order == 1:
-
-            # forward operator is (u_{i+1} - u_i)/dx
-            # centered operator is (u_{i+1} - u_{i-1})/(2dx)
-            # backward operator is (u_i - u_{i-1})/dx
-
-            idx = 1 / dx
-            idz = 1 / dz
-
-            i = np.kron(np.arange(nx * nz), np.ones((2, )))
-            j = np.zeros((nz * nx * 2, ))
-            v = np.zeros((nz * nx * 2, ))
-
-            jj = np.vstack((np.arange(nz), nz + np.arange(nz))).T
-            jj = jj.flatten()
-            j[:2 * nz] = jj
-            vd = idx * np.tile(np.array([-1, 1]), (nz, ))
-            v[:2 * nz] = vd
-
-            jj = np.vstack((-nz + np.arange(nz), nz + np.arange(nz))).T
-            jj = jj.flatten()
-            for n in range(1, nx - 1):
-                j[n * 2 * nz:(n + 1) * 2 * nz] = n * nz + jj
-                v[n * 2 * nz:(n + 1) * 2 * nz] = 0.5 * vd
-
-            jj = np.vstack((-nz + np.arange(nz), np.arange(nz))).T
-            jj = jj.flatten()
-            j[(nx - 1) * 2 * nz:nx * 2 * nz] = (nx - 1) * nz + jj
-            v[(nx - 1) * 2 * nz:nx * 2 * nz] = vd
-
-            Dx = csr_matrix((v, (i, j)))
-
-            jj = np.vstack((np.hstack((0, np.arange(nz - 1))),
-                            np.hstack((np.arange(1, nz), nz - 1)))).T
-            jj = jj.flatten()
-            vd = idz * np.hstack((np.array([-1, 1]),
-                                  np.tile(np.array([-0.5, 0.5]), (nz - 2,)), np.array([-1, 1])))
-
-            for n in range(nx):
-                j[n * 2 * nz:(n + 1) * 2 * nz] = n * nz + jj
-                v[n * 2 * nz:(n + 1) * 2 * nz] = vd
-
-            Dz = csr_matrix((v, (i, j)))
-        else:  # 2nd order
-
-            # forward operator is (u_i - 2u_{i+1} + u_{i+2})/dx^2
-            # centered operator is (u_{i-1} - 2u_i + u_{i+1})/dx^2
-            # backward operator is (u_{i-2} - 2u_{i-1} + u_i)/dx^2
-
-            idx2 = 1 / (dx * dx)
-            idz2 = 1 / (dz * dz)
-
-            i = np.kron(np.arange(nx * nz), np.ones((3, )))
-            j = np.zeros((nz * nx * 3, ))
-            v = np.zeros((nz * nx * 3, ))
-
-            jj = np.vstack((np.arange(nz), nz + np.arange(nz), 2 * nz + np.arange(nz))).T
-            jj = jj.flatten()
-            j[:3 * nz] = jj
-            vd = idx2 * np.tile(np.array([1.0, -2.0, 1.0]), (nz, ))
-            v[:3 * nz] = vd
-
-            for n in range(1, nx - 1):
-                j[n * 3 * nz:(n + 1) * 3 * nz] = (n - 1) * nz + jj
-                v[n * 3 * nz:(n + 1) * 3 * nz] = vd
-
-            j[(nx - 1) * 3 * nz:nx * 3 * nz] = (nx - 3) * nz + jj
-            v[(nx - 1) * 3 * nz:nx * 3 * nz] = vd
-
-            Dx = csr_matrix((v, (i, j)))
-
-            jj = np.vstack((np.hstack((0, np.arange(nz - 2), nz - 3)),
-                            np.hstack((1, np.arange(1, nz - 1), nz - 2)),
-                            np.hstack((2, np.arange(2, nz), nz - 1)))).T
-            jj = jj.flatten()
-            vd = vd * idz2 / idx2
-
-            for n in range(nx):
-                j[n * 3 * nz:(n + 1) * 3 * nz] = n * nz + jj
-                v[n * 3 * nz:(n + 1) * 3 * nz] = vd
-
-            Dz = csr_matrix((v, (i, j)))
-
-        # no derivative along y, empty Dy matrix
-        Dy = csr_matrix(Dx.shape)
-
-        return Dx, Dy, Dz
-
     def preFFTMA(self, cm):
         """
         Compute matrix G for FFT-MA simulations
 
+        The covariance is computed on a grid at least twice as large as the
+        grid, enlarged until the covariance falls to zero.  G is kept in
+        a cache for each grid geometry and covariance model, and should
+        therefore not be modified in place.
+
         INPUT
             cm: list of covariance models
 
         OUTPUT
-            G: covariance matrix in spectral domain
+            G: square root of the covariance matrix in spectral domain, for
+               real-to-complex transforms (Nx x Nz/2+1, real)
         """
+        key = (self.grx.tobytes(), self.grz.tobytes(), _covarianceKey(cm))
+        if key in _fftma_cache:
+            _fftma_cache.move_to_end(key)
+            return _fftma_cache[key]
+
         small = 1.0e-6
         Nx = 2 * self.grx.size
         Nz = 2 * self.grz.size
 
-        Nx2 = Nx / 2
-        Nz2 = Nz / 2
-
-        x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-        z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
-
-        x = np.kron(x, np.ones((Nz, )))
-        z = np.kron(z, np.ones((1, Nx)).T).flatten()
-
-        d = 0
-        for c in cm:
-            d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-        K = d.reshape(Nx, Nz)
-
-        mk = True
-        while mk:
+        def covariance(x, z):
+            d = 0
+            for c in cm:
+                d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
+            return d
+
+        # Enlarge grid to make sure that covariance falls to zero, looking
+        # at the covariance along the axes only
+        while True:
+            x = _fftmaAxis(Nx, self.dx)
+            z = _fftmaAxis(Nz, self.dz)
             mk = False
-            if np.min(K[0, :]) > small:
-                # Enlarge grid to make sure that covariance falls to zero
+            if np.min(covariance(np.zeros(z.shape), z)) > small:
                 Nz = 2 * Nz
                 mk = True
-
-            if np.min(K[:, 0]) > small:
+            if np.min(covariance(x, np.zeros(x.shape))) > small:
                 Nx = 2 * Nx
                 mk = True
+            if not mk:
+                break
 
-            if mk:
-                Nx2 = Nx / 2
-                Nz2 = Nz / 2
+        xx, zz = np.meshgrid(x, z, indexing='ij')
+        K = covariance(xx.ravel(), zz.ravel()).reshape(Nx, Nz)
 
-                x = self.dx * np.hstack((np.arange(Nx2), np.arange(-Nx2 + 1, 1)))
-                z = self.dz * np.hstack((np.arange(Nz2), np.arange(-Nz2 + 1, 1)))
+        # K being real and even, its spectrum is real; small negative values
+        # due to truncation are set to zero
+        G = np.sqrt(np.maximum(scipy.fft.rfft2(K, workers=-1).real, 0.0))
 
-                x = np.kron(x, np.ones((Nz,)))
-                z = np.kron(z, np.ones((1, Nx)).T).flatten()
+        _fftma_cache[key] = G
+        while len(_fftma_cache) > _fftma_cache_size:
+            _fftma_cache.popitem(last=False)
+        return G
 
-                d = 0
-                for c in cm:
-                    d = d + c.compute(np.vstack((x, z)).T, np.zeros((1, 2)))
-                K = d.reshape(Nx, Nz)
-
-        return np.sqrt(np.fft.fft2(K))
-
-    def FFTMA(self, G):
+    def FFTMA(self, G, rng=None):
         """
         Perform FFT-MA simulation using pre-computed spectral matrix
 
         INPUT
             G: covariance matrix in spectral domain as return by preFFTMA
+            rng: random number generator (numpy.random is used by default)
 
         OUTPUT
             Z: simulated field of size nx x nz
         """
-        Nx, Nz = G.shape
-        U = np.fft.fft2(np.random.randn(G.shape[0], G.shape[1]))
-        Z = np.real(np.fft.ifft2(G * U))
+        if rng is None:
+            rng = np.random
+        Nx, Nz = G.shape[0], 2 * (G.shape[1] - 1)
+        return self._FFTMAfields(G, rng.standard_normal((1, Nx, Nz)))[0]
 
-        return Z[int(round((Nx + 2) / 2)):(int(round((Nx + 2) / 2)) + self.grx.size - 1),
-                 int(round((Nz + 2) / 2)):(int(round((Nz + 2) / 2)) + self.grz.size - 1)]
+    def FFTMAbatch(self, cm, nreal, out=None, seed=None, batch=16, workers=-1):
+        """
+        Perform a batch of FFT-MA simulations
+
+        Each realization uses its own random stream, spawned from
+        numpy.random.SeedSequence(seed), so that realizations are
+        reproducible and independent of the batch size.
+
+        INPUT
+            cm: list of covariance models
+            nreal: number of realizations
+            out: array (nreal x nx x nz) where realizations are stored, or
+                 name of a .npy file to create as a memory-mapped array
+                 (an array is allocated if None)
+            seed: seed of the random streams (see numpy.random.SeedSequence)
+            batch: number of realizations transformed at once
+            workers: number of threads used for the FFTs (-1 for all CPUs)
+
+        OUTPUT
+            Z: simulated fields, nreal x nx x nz
+        """
+        G = self.preFFTMA(cm)
+        Nx, Nz = G.shape[0], 2 * (G.shape[1] - 1)
+        shape = (nreal, self.grx.size - 1, self.grz.size - 1)
+        if out is None:
+            out = np.empty(shape)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=shape)
+        elif out.shape != shape:
+            raise ValueError('out should be nreal x nx x nz')
+
+        streams = np.random.SeedSequence(seed).spawn(nreal)
+        for n0 in range(0, nreal, batch):
+            n1 = min(n0 + batch, nreal)
+            U = np.empty((n1 - n0, Nx, Nz))
+            for n in range(n0, n1):
+                np.random.default_rng(streams[n]).standard_normal((Nx, Nz), out=U[n - n0])
+            out[n0:n1] = self._FFTMAfields(G, U, workers)
+
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def _FFTMAfields(self, G, U, workers=-1):
+        # U: white noise, nfields x Nx x Nz
+        Nx, Nz = U.shape[1:]
+        Z = scipy.fft.irfft2(G * scipy.fft.rfft2(U, workers=workers), s=(Nx, Nz), workers=workers)
+
+        ix = int(round((Nx + 2) / 2))
+        iz = int(round((Nz + 2) / 2))
+        return Z[:, ix:ix + self.grx.size - 1, iz:iz + self.grz.size - 1]
 
     def toXdmf(self, field, fieldname, filename):
         """
@@ -707,9 +1625,133 @@ class Grid2D(Grid):
         h5f.close()
 
 
+class XdmfWriter(object):
+    """
+    Write a sequence of fields (e.g. inversion iterations or simulations)
+    of a grid in xdmf format
+
+    Fields are appended one at a time to a chunked, compressed dataset of
+    a single HDF5 file (filename + '.h5', dataset fieldname, nsteps x nz x nx
+    or nsteps x nz x ny x nx), the time of each step being stored in dataset
+    "time".  The xdmf file, a temporal collection holding one grid per
+    step, is written by close() or flush().
+
+    Usage:
+        with XdmfWriter(grid, 'inv.xmf', 'slowness') as w:
+            for n in range(niter):
+                ...
+                w.append(s, n)
+    """
+    def __init__(self, grid, filename, fieldname, compression='gzip', level=4):
+        self.grid = grid
+        self.filename = filename
+        self.fieldname = fieldname
+        self.nsteps = 0
+
+        if grid.gry.size > 1:
+            self.shape = (grid.grz.size - 1, grid.gry.size - 1, grid.grx.size - 1)
+        else:
+            self.shape = (grid.grz.size - 1, grid.grx.size - 1)
+
+        self.h5f = h5py.File(filename + '.h5', 'w')
+        self.data = self.h5f.create_dataset(fieldname, shape=(0, ) + self.shape, maxshape=(None, ) + self.shape,
+                                            dtype=np.float32, chunks=(1, ) + self.shape, shuffle=True,
+                                            compression=compression, compression_opts=level)
+        self.time = self.h5f.create_dataset('time', shape=(0, ), maxshape=(None, ), dtype=np.float64, chunks=(1024, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, field, time=None):
+        """
+        Append a field, of size equal to the number of cells in the grid, at
+        time time (step number by default)
+        """
+        if time is None:
+            time = self.nsteps
+        ncell = self.grid.getNcell()
+        # cells are stored with Z varying fastest, xdmf wants X varying fastest
+        field = np.asarray(field).reshape(ncell).T
+
+        n = self.nsteps
+        self.data.resize(n + 1, axis=0)
+        self.data[n] = field.astype(np.float32)
+        self.time.resize(n + 1, axis=0)
+        self.time[n] = time
+        self.nsteps = n + 1
+
+    def flush(self):
+        """
+        Write the xdmf file for the steps appended so far, and flush the HDF5 file
+        """
+        self.h5f.flush()
+        g = self.grid
+        dims = ' '.join(repr(d) for d in self.shape)
+        if len(self.shape) == 3:
+            topology = '3DCORECTMesh'
+            geometry = 'ORIGIN_DXDYDZ'
+            origin = (g.grz[0] + g.dz / 2, g.gry[0] + g.dy / 2, g.grx[0] + g.dx / 2)
+            spacing = (g.dz, g.dy, g.dx)
+        else:
+            topology = '2DCORECTMesh'
+            geometry = 'ORIGIN_DXDY'
+            origin = (g.grz[0] + g.dz / 2, g.grx[0] + g.dx / 2)
+            spacing = (g.dz, g.dx)
+        nodes = ' '.join(repr(d + 1) for d in self.shape)
+        h5name = os.path.basename(self.filename) + '.h5'
+        nd = len(self.shape) + 1
+        start = ' '.join(['0'] * (nd - 1))
+        ones = ' '.join(['1'] * nd)
+        times = self.time[:self.nsteps]
+
+        # written step by step to keep memory usage independent of the number of steps
+        with open(self.filename, 'w') as f:
+            f.write('<?xml version="1.0" ?>\n')
+            f.write('<!DOCTYPE Xdmf SYSTEM "Xdmf.dtd" []>\n')
+            f.write('<Xdmf xmlns:xi="http://www.w3.org/2003/XInclude" Version="2.2">\n')
+            f.write(' <Domain>\n')
+            f.write('   <Grid Name="TimeSeries" GridType="Collection" CollectionType="Temporal">\n')
+            for n in range(self.nsteps):
+                f.write('     <Grid Name="Step ' + repr(n) + '" GridType="Uniform">\n')
+                f.write('       <Time Value="' + repr(float(times[n])) + '"/>\n')
+                f.write('       <Topology TopologyType="' + topology + '" NumberOfElements="' + nodes + '"/>\n')
+                f.write('       <Geometry GeometryType="' + geometry + '">\n')
+                f.write('         <DataItem Dimensions="' + repr(nd - 1) + '" NumberType="Float" Precision="8" Format="XML">' +
+                        ' '.join(repr(float(o)) for o in origin) + '</DataItem>\n')
+                f.write('         <DataItem Dimensions="' + repr(nd - 1) + '" NumberType="Float" Precision="8" Format="XML">' +
+                        ' '.join(repr(float(d)) for d in spacing) + '</DataItem>\n')
+                f.write('       </Geometry>\n')
+                f.write('       <Attribute Name="' + self.fieldname + '" AttributeType="Scalar" Center="Cell">\n')
+                f.write('         <DataItem ItemType="HyperSlab" Dimensions="' + dims + '" Type="HyperSlab">\n')
+                f.write('           <DataItem Dimensions="3 ' + repr(nd) + '" Format="XML">' + repr(n) + ' ' + start +
+                        ' ' + ones + ' 1 ' + dims + '</DataItem>\n')
+                f.write('           <DataItem Dimensions="' + repr(self.nsteps) + ' ' + dims +
+                        '" NumberType="Float" Precision="4" Format="HDF">' + h5name + ':/' + self.fieldname + '</DataItem>\n')
+                f.write('         </DataItem>\n')
+                f.write('       </Attribute>\n')
+                f.write('     </Grid>\n')
+            f.write('   </Grid>\n')
+            f.write(' </Domain>\n')
+            f.write('</Xdmf>\n')
+
+    def close(self):
+        """
+        Write the xdmf file and close the HDF5 file
+        """
+        if self.h5f is not None:
+            self.flush()
+            self.h5f.close()
+            self.h5f = None
+
+
 class Grid3D(Grid):
     """
-    Class for 3D grids -> TO COMPLETE!!!
+    Class for 3D grids
+
+    Cells are numbered with z varying fastest, then y, then x
     """
     def __init__(self, grx=None, gry=None, grz=None, nthreads=1):
         Grid.__init__(self)
@@ -720,9 +1762,10 @@ class Grid3D(Grid):
         if grz is not None:
             self.grz = grz
         self.nthreads = nthreads
-        self.nsnx = 10
-        self.nsny = 10
-        self.nsnz = 10
+        # nodes are also placed on faces in 3D, 5 gives an accuracy close to 10 in 2D
+        self.nsnx = 5
+        self.nsny = 5
+        self.nsnz = 5
         self.cgrid = None
         self.border = np.array([1, 1, 1, 1])
         self.flip = 0
@@ -730,6 +1773,332 @@ class Grid3D(Grid):
         self.x0 = np.array([])
         self.type = None
 
+    def __reduce__(self):
+        # cgrid excluded volontarily, see Grid2D.__reduce__
+        return (Grid3D.rebuild, (self.grx, self.gry, self.grz, self.cont, self.Tx, self.Rx,
+                                 self.TxCosDir, self.RxCosDir, self.border,
+                                 self.Tx_Z_water, self.Rx_Z_water, self.in_vect,
+                                 self.nthreads, self.nsnx, self.nsny, self.nsnz, self.flip,
+                                 self.borehole_x0, self.x0, self.type, self.precision))
+
+    @staticmethod
+    def rebuild(grx, gry, grz, cont, Tx, Rx, TxCosDir, RxCosDir, border, Tx_Z_water,
+                Rx_Z_water, in_vect, nthreads, nsnx, nsny, nsnz, flip, borehole_x0, x0, _type,
+                precision='float64'):
+
+        g = Grid3D(grx, gry, grz, nthreads)
+        g.cont = cont
+        g.Tx = Tx
+        g.Rx = Rx
+        g.TxCosDir = TxCosDir
+        g.RxCosDir = RxCosDir
+        g.border = border
+        g.Tx_Z_water = Tx_Z_water
+        g.Rx_Z_water = Rx_Z_water
+        g.in_vect = in_vect
+        g.nsnx = nsnx
+        g.nsny = nsny
+        g.nsnz = nsnz
+        g.flip = flip
+        g.borehole_x0 = borehole_x0
+        g.x0 = x0
+        g.type = _type
+        g.precision = precision
+
+        return g
+
+    def raytrace(self, slowness, Tx, Rx, t0=(), xi=(), theta=(), return_L=True, return_rays=False):
+        """
+        Compute traveltimes, raypaths and build ray projection matrix
+
+        Usages are the same as for Grid2D.raytrace, except that anisotropy
+        is not available in 3D.  Secondary nodes are on cell edges and
+        faces, memory used for raytracing is about 17 bytes per node and
+        per thread, e.g. 650 MB per thread for a 100 x 100 x 200 grid with
+        nsnx = nsny = nsnz = 2 (38.5 million nodes).  In a homogeneous
+        medium, traveltimes are too large by at most about 1.6% with 2
+        secondary nodes, 0.9% with 3 and 0.35% with 5.
+
+        Input:
+            slowness: vector of slowness values at grid cells (ncell x 1)
+            Tx: coordinates of sources points (ndata x 3)
+            Rx: coordinates of receivers      (ndata x 3)
+            t0 (optional): initial time at sources points (ndata x 1)
+            return_L: if True, return the ray projection matrix
+            return_rays: if True, return the raypaths
+        Output:
+            tt: vector of traveltimes, ndata by 1
+            L: ray projection matrix, ndata by ncell
+            rays: Rays instance holding the coordinates of the ray paths,
+                  rays[n] is the nPts by 3 matrix of ray n (float32)
+        """
+        if Tx.ndim != 2 or Rx.ndim != 2:
+            raise ValueError('Tx and Rx should be 2D arrays')
+
+        if Tx.shape[1] != 3 or Rx.shape[1] != 3:
+            raise ValueError('Tx and Rx should be ndata x 3')
+
+        if Tx.shape != Rx.shape:
+            raise ValueError('Tx and Rx should be of equal size')
+
+        if len(slowness) != self.getNumberOfCells():
+            raise ValueError('Length of slowness vector should equal number of cells')
+
+        if len(xi) != 0 or len(theta) != 0:
+            raise ValueError('Anisotropic raytracing not available for 3D grids')
+
+        if len(t0) == 0:
+            t0 = np.zeros([Tx.shape[0], ])
+        elif len(t0) != Tx.shape[0]:
+            raise ValueError('Length of t0 should equal number of Tx')
+
+        if self.cgrid is None:
+            nx, ny, nz = self.getNcell()
+            self.cgrid = cgrid3d.Grid3Dcpp(nx, ny, nz, self.dx, self.dy, self.dz,
+                                           self.grx[0], self.gry[0], self.grz[0],
+                                           self.nsnx, self.nsny, self.nsnz, self.nthreads)
+        self.cgrid.setSinglePrecision(self.getDtype() == np.float32)
+
+        out = self.cgrid.raytrace(slowness, Tx, Rx, t0, return_L, return_rays)
+        if return_rays:
+            out = out[:-1] + (Rays(*out[-1]), )
+        return self._toPrecision(out)
+
+    def getThreadTiming(self):
+        """
+        Return the wall time (s) and the number of sources processed by each
+        thread during the last call to raytrace
+        """
+        if self.cgrid is None:
+            return np.array([]), np.array([], dtype=np.int64)
+        return self.cgrid.getThreadTiming()
+
+    def getForwardStraightRays(self, ind=None, dx=None, dy=None, dz=None, aniso=False):
+        """
+        Build ray projection matrix for straight rays
+
+        Input:
+            ind: indices of Tx-Rx pairs for which matrix is built
+            dx: grid cell size along X (default is size of grid instance)
+            dy: grid cell size along Y (default is size of grid instance)
+            dz: grid cell size along Z (default is size of grid instance)
+            aniso: not available for 3D grids
+
+        Output:
+            L: ray projection matrix, ndata by ncell
+        """
+        if aniso:
+            raise ValueError('Anisotropic straight rays not available for 3D grids')
+
+        if ind is None:
+            ind = np.ones((self.Tx.shape[0],), dtype=bool)
+
+        small = 0.00001
+        if dx is None or dx == 0:
+            grx = self.grx
+        else:
+            grx = np.arange(self.grx[0], self.grx[-1] + small, dx)
+
+        if dy is None or dy == 0:
+            gry = self.gry
+        else:
+            gry = np.arange(self.gry[0], self.gry[-1] + small, dy)
+
+        if dz is None or dz == 0:
+            grz = self.grz
+        else:
+            grz = np.arange(self.grz[0], self.grz[-1] + small, dz)
+
+        Tx = self.Tx[ind, :]
+        Rx = self.Rx[ind, :]
+
+        if self.rayCache is not None:
+            key = self.rayCache.key(grx, gry, grz, Tx, Rx)
+            L = self.rayCache.get(key)
+            if L is not None:
+                return L.astype(self.getDtype(), copy=False)
+
+        L = cgrid3d.Grid3Dcpp.Lsr3d(Tx, Rx, grx, gry, grz)
+
+        if self.rayCache is not None:
+            self.rayCache.put(key, L)
+        return L.astype(self.getDtype(), copy=False)
+
+    def getCellCenter(self, dx=None, dy=None, dz=None):
+        """
+        Returns a nCell x 3 array containing the coordinates of the center of the cells
+        """
+        if dx is None:
+            dx = self.dx
+        if dy is None:
+            dy = self.dy
+        if dz is None:
+            dz = self.dz
+
+        x = np.arange(self.grx[0] + dx / 2.0, self.grx[-1] - dx / 3.0, dx)  # divide by 3 to avoid truncation error
+        y = np.arange(self.gry[0] + dy / 2.0, self.gry[-1] - dy / 3.0, dy)
+        z = np.arange(self.grz[0] + dz / 2.0, self.grz[-1] - dz / 3.0, dz)
+
+        xx, yy, zz = np.meshgrid(x, y, z, indexing='ij')
+        return np.vstack((xx.ravel(), yy.ravel(), zz.ravel())).T
+
+
+@functools.lru_cache(maxsize=16)
+def _derivativeOperators(ncell, d, order):
+    """
+    Derivative operators for a grid of ncell = (nx, nz) or (nx, ny, nz)
+    cells of size d = (dx, dy, dz), the index of Z varying fastest
+    """
+    if len(ncell) == 2:
+        nx, nz = ncell
+        ny = 1
+    else:
+        nx, ny, nz = ncell
+    I = scipy.sparse.identity
+
+    Dx = scipy.sparse.kron(_derivative1D(nx, order, d[0]), I(ny * nz), format='csr')
+    if len(ncell) == 2:
+        Dy = csr_matrix((0, nx * nz))
+    else:
+        Dy = scipy.sparse.kron(scipy.sparse.kron(I(nx), _derivative1D(ny, order, d[1])), I(nz), format='csr')
+    Dz = scipy.sparse.kron(I(nx * ny), _derivative1D(nz, order, d[2]), format='csr')
+
+    return Dx, Dy, Dz
+
+
+def _resamplePolylines(coords, offsets, npts):
+    """
+    Resample polylines stored in a flat buffer (see Rays) with npts points
+    regularly spaced along their length, returns a (nlines, npts, ndim) array
+    """
+    nlines = offsets.size - 1
+    d = np.sqrt(np.sum(np.diff(coords, axis=0)**2, axis=1))
+    d[offsets[1:-1] - 1] = 0.0  # no segment between consecutive polylines
+    cum = np.concatenate(([0.0], np.cumsum(d)))
+    start = cum[offsets[:-1]]
+    ltot = cum[offsets[1:] - 1] - start
+    target = start[:, None] + ltot[:, None] * np.linspace(0.0, 1.0, npts)
+    # segment of each new point, kept within its polyline
+    i = np.searchsorted(cum, target, side='right') - 1
+    i = np.clip(i, offsets[:-1, None], np.maximum(offsets[1:, None] - 2, offsets[:-1, None]))
+    j = np.minimum(i + 1, offsets[1:, None] - 1)
+    dseg = cum[j] - cum[i]
+    f = np.where(dseg > 0.0, (target - cum[i]) / np.where(dseg > 0.0, dseg, 1.0), 0.0)
+    f = np.clip(f, 0.0, 1.0)[:, :, None]
+    return (1.0 - f) * coords[i] + f * coords[j] if nlines > 0 else np.zeros((0, npts, coords.shape[1]))
+
+
+def _bilinear(S, P, lo, dx, dz):
+    """
+    Bilinear interpolation between cell centers of values S (nx x nz) at
+    points P (... x 2), returns values and gradient, values being constant
+    beyond the centers of the border cells
+    """
+    nx, nz = S.shape
+    u = np.clip((P[..., 0] - lo[0]) / dx - 0.5, 0.0, nx - 1)
+    v = np.clip((P[..., 1] - lo[1]) / dz - 0.5, 0.0, nz - 1)
+    i0 = np.minimum(np.floor(u).astype(np.int64), max(nx - 2, 0))
+    k0 = np.minimum(np.floor(v).astype(np.int64), max(nz - 2, 0))
+    i1 = np.minimum(i0 + 1, nx - 1)
+    k1 = np.minimum(k0 + 1, nz - 1)
+    fx = u - i0
+    fz = v - k0
+    s00, s10, s01, s11 = S[i0, k0], S[i1, k0], S[i0, k1], S[i1, k1]
+    s = s00 * (1 - fx) * (1 - fz) + s10 * fx * (1 - fz) + s01 * (1 - fx) * fz + s11 * fx * fz
+    ds = np.empty(P.shape)
+    ds[..., 0] = ((s10 - s00) * (1 - fz) + (s11 - s01) * fz) / dx
+    ds[..., 1] = ((s01 - s00) * (1 - fx) + (s11 - s10) * fx) / dz
+    return s, ds
+
+
+def _polylinesL(P, grx, grz):
+    """
+    Ray projection matrix of polylines P (nlines x npts x 2), i.e. length
+    of each polyline in each cell of the grid defined by grx and grz
+    """
+    nlines, npts = P.shape[0], P.shape[1]
+    nx, nz = grx.size - 1, grz.size - 1
+    p0 = P[:, :-1, :].reshape(-1, 2)
+    p1 = P[:, 1:, :].reshape(-1, 2)
+    nseg = p0.shape[0]
+    dp = p1 - p0
+    seglen = np.sqrt(np.sum(dp**2, axis=1))
+
+    # parameter t along each segment of the crossings with grid lines
+    iseg = [np.arange(nseg), np.arange(nseg)]
+    t = [np.zeros((nseg, )), np.ones((nseg, ))]
+    for k, gr in ((0, grx), (1, grz)):
+        a = np.minimum(p0[:, k], p1[:, k])
+        b = np.maximum(p0[:, k], p1[:, k])
+        first = np.searchsorted(gr, a, side='right')
+        count = np.maximum(np.searchsorted(gr, b, side='left') - first, 0)
+        seg = np.repeat(np.arange(nseg), count)
+        start = np.cumsum(count) - count
+        line = np.repeat(first - start, count) + np.arange(count.sum())
+        iseg.append(seg)
+        t.append((gr[line] - p0[seg, k]) / dp[seg, k])
+    iseg = np.concatenate(iseg)
+    t = np.concatenate(t)
+    o = np.lexsort((t, iseg))
+    iseg = iseg[o]
+    t = t[o]
+
+    # pieces between consecutive crossings of a segment
+    same = iseg[1:] == iseg[:-1]
+    seg = iseg[:-1][same]
+    ta = t[:-1][same]
+    tb = t[1:][same]
+    length = (tb - ta) * seglen[seg]
+    mid = p0[seg] + (0.5 * (ta + tb))[:, None] * dp[seg]
+    ix = np.clip(np.floor((mid[:, 0] - grx[0]) / (grx[1] - grx[0])).astype(np.int64), 0, nx - 1)
+    iz = np.clip(np.floor((mid[:, 1] - grz[0]) / (grz[1] - grz[0])).astype(np.int64), 0, nz - 1)
+    keep = length > 0.0
+    row = seg[keep] // (npts - 1)
+    # duplicates, i.e. pieces of a polyline in the same cell, are summed
+    return csr_matrix((length[keep], (row, ix[keep] * nz + iz[keep])), shape=(nlines, nx * nz))
+
+
+def _fftmaAxis(N, d):
+    # coordinates along one axis of the grid used for FFT-MA simulations, in
+    # the order of the DFT, so that the covariance matrix is even
+    N2 = N // 2
+    return d * np.hstack((np.arange(N2 + 1), np.arange(-N2 + 1, 0)))
+
+
+def _covarianceKey(cm):
+    # hashable description of a list of covariance models
+    return tuple((type(c).__name__, tuple(np.ravel(c.range).tolist()), tuple(np.ravel(c.angle).tolist()),
+                  tuple(np.ravel(c.sill).tolist())) for c in cm)
+
+
+def _derivative1D(n, order, d):
+    """
+    1D derivative operator for n cells of size d, with forward operator at
+    the first cell(s), centered operator inside and backward operator at
+    the last cell(s) (see Grid.derivative)
+    """
+    if n < order + 1:
+        # not enough cells to compute derivative
+        return csr_matrix((n, n))
+
+    if order == 1:
+        i = np.repeat(np.arange(n), 2)
+        j = np.vstack((np.arange(-1, n - 1), np.arange(1, n + 1))).T
+        j[0, :] = [0, 1]
+        j[-1, :] = [n - 2, n - 1]
+        v = np.tile(np.array([-0.5, 0.5]), (n, 1))
+        v[0, :] = [-1.0, 1.0]
+        v[-1, :] = [-1.0, 1.0]
+        v /= d
+    else:
+        i = np.repeat(np.arange(n), 3)
+        j = np.vstack((np.arange(-1, n - 1), np.arange(n), np.arange(1, n + 1))).T
+        j[0, :] = [0, 1, 2]
+        j[-1, :] = [n - 3, n - 2, n - 1]
+        v = np.tile(np.array([1.0, -2.0, 1.0]), (n, 1)) / (d * d)
+
+    return csr_matrix((v.ravel(), (i, j.ravel())), shape=(n, n))
+
 
 if __name__ == '__main__':
 
@@ -742,6 +2111,22 @@ if __name__ == '__main__':
     testDeriv = False
     testFFTMA = True
     testPickle = False
+    testBenchInput = False
+    testBenchReturn = False
+    testBenchThreads = False
+    testPool = False
+    testRaytrace3D = False
+    testBenchFMM = False
+    testRays = False
+    testMerge = False
+    testRayCache = False
+    testProj = False
+    testFFTMAbatch = False
+    testXdmfWriter = False
+    testPrecision = False
+    testTuneNodes = False
+    testBending = False
+    testUpdate = False
 
     if testRaytrace:
         grx = np.linspace(0, 10, num=21)
@@ -768,9 +2153,9 @@ if __name__ == '__main__':
                        [9.8, 0.0, 6.2]])
         t0 = np.zeros([6, ])
 
-        tt1, L1, rays1 = grid.raytrace(slowness, Tx, Rx, t0)
+        tt1, L1, rays1 = grid.raytrace(slowness, Tx, Rx, t0, return_rays=True)
         tt1b, L1b = grid.raytrace(slowness, Tx, Rx, t0)
-        tt2, L2, rays2 = grid.raytrace(slowness, Tx, Rx)
+        tt2, L2, rays2 = grid.raytrace(slowness, Tx, Rx, return_rays=True)
 
         d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
 
@@ -836,7 +2221,7 @@ if __name__ == '__main__':
 
         print(ttsr)
 
-        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx)
+        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx, return_rays=True)
 
     if testStatic:
 
@@ -990,6 +2375,19 @@ if __name__ == '__main__':
         plt.colorbar()
         plt.show()
 
+        grid = Grid2D(np.linspace(0, 100, num=1001), np.linspace(0, 100, num=1001))
+        tic = time.perf_counter()
+        grid.derivative(2, normalize=True)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        grid.derivative(2, normalize=True)
+        print('2D, 1e6 cells: {0:g} s, cached: {1:g} s'.format(t1, time.perf_counter() - tic))
+
+        grid = Grid3D(np.linspace(0, 10, num=101), np.linspace(0, 10, num=101), np.linspace(0, 10, num=101))
+        tic = time.perf_counter()
+        Dx, Dy, Dz = grid.derivative(1)
+        print('3D, 1e6 cells: {0:g} s'.format(time.perf_counter() - tic))
+
     if testFFTMA:
         grx = np.linspace(0, 3, num=50)
         grz = np.linspace(0, 6, num=100)
@@ -1049,7 +2447,7 @@ if __name__ == '__main__':
         Lsr1 = grid.getForwardStraightRays()
         ttsr1 = Lsr1 * s
 
-        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx)
+        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx, return_rays=True)
 
         with open('/tmp/data.pickle', 'wb') as f:
             # Pickle the 'data' dictionary using the highest protocol available.
@@ -1065,10 +2463,592 @@ if __name__ == '__main__':
         Lsr2 = grid.getForwardStraightRays()
         ttsr2 = Lsr2 * s
 
-        tt2, L2, rays2 = grid.raytrace(s, Tx, Rx)
+        tt2, L2, rays2 = grid.raytrace(s, Tx, Rx, return_rays=True)
 
         print(ttsr)
         print(ttsr1)
         print(ttsr2)
         print(tt1)
         print(tt2)
+
+    if testBenchInput:
+        # 200k cells and 30k rays from 10 sources, tt and L as in the curved
+        # iterations of invLSQR.  The call is the same as with the former
+        # Grid2Dcpp.raytrace (input copied one element at a time, number of
+        # outputs given by nargout), it can be timed with cutils.cgrid2d
+        # built from the former cgrid2d.pyx to compare.
+        grx = np.linspace(0, 40, num=401)
+        grz = np.linspace(0, 50, num=501)
+        grid = Grid2D(grx, grz)
+        grid.nsnx = grid.nsnz = 2
+        cgrid = cgrid2d.Grid2Dcpp(b'iso', *grid._cgridArgs(1))
+        nc = grid.getNumberOfCells()
+        s = 1.0 + 0.1 * np.random.rand(nc)
+
+        zt = np.linspace(0.5, 49.5, 10)
+        zr = np.linspace(0.25, 49.75, 3000)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(zt.size), np.zeros(zt.size), zt)).T, zr.size, axis=0)
+        Rx = np.tile(np.vstack((39.5 * np.ones(zr.size), np.zeros(zr.size), zr)).T, (zt.size, 1))
+        t0 = np.zeros((Tx.shape[0],))
+
+        t_call = np.inf
+        for n in range(3):
+            tic = time.perf_counter()
+            tt, L = cgrid.raytrace(s, [], [], Tx, Rx, t0)
+            t_call = min(t_call, time.perf_counter() - tic)
+        print('raytrace, {0:d} cells, {1:d} rays: {2:g} s'.format(nc, Tx.shape[0], t_call))
+
+    if testBenchReturn:
+        grx = np.linspace(0, 20, num=101)
+        grz = np.linspace(0, 30, num=151)
+        grid = Grid2D(grx, grz)
+        grid.nsnx = grid.nsnz = 5
+        nc = grid.getNumberOfCells()
+        s = 1.0 + 0.1 * np.random.rand(nc)
+
+        # many receivers per source, so that the work done for each
+        # receiver (traveltime lookup, raypath) is a measurable share
+        zt = np.linspace(0.5, 29.5, 10)
+        zr = np.linspace(0.25, 29.75, 2000)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(zt.size), np.zeros(zt.size), zt)).T, zr.size, axis=0)
+        Rx = np.tile(np.vstack((19.5 * np.ones(zr.size), np.zeros(zr.size), zr)).T, (zt.size, 1))
+
+        timing = []
+        for return_L, return_rays in ((False, False), (True, False), (True, True)):
+            best = np.inf
+            for n in range(3):
+                tic = time.perf_counter()
+                grid.raytrace(s, Tx, Rx, return_L=return_L, return_rays=return_rays)
+                best = min(best, time.perf_counter() - tic)
+            timing.append(best)
+
+        print('tt only:      {0:g} s, speedup: {1:.2f}'.format(timing[0], timing[2] / timing[0]))
+        print('tt and L:     {0:g} s, speedup: {1:.2f}'.format(timing[1], timing[2] / timing[1]))
+        print('tt, L, rays:  {0:g} s'.format(timing[2]))
+
+    if testBenchThreads:
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        nc = (grx.size - 1) * (grz.size - 1)
+        s = 1.0 + 0.1 * np.random.rand(nc)
+
+        z = np.linspace(0.5, 29.5, 64)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.5 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        t_ref = None
+        nt = 1
+        while nt <= os.cpu_count():
+            grid = Grid2D(grx, grz, nthreads=nt)
+            tic = time.perf_counter()
+            grid.raytrace(s, Tx, Rx)
+            elapsed = time.perf_counter() - tic
+            if t_ref is None:
+                t_ref = elapsed
+            times, nsrc = grid.getThreadTiming()
+            print('{0:3d} threads: {1:8.3f} s, speedup {2:5.2f}, efficiency {3:4.2f}'.format(nt, elapsed, t_ref / elapsed, t_ref / elapsed / nt))
+            print('     thread times (s): ' + ' '.join('{0:.2f}'.format(t) for t in times))
+            print('     sources/thread:   ' + ' '.join(str(n) for n in nsrc))
+            nt *= 2
+
+    if testPool:
+        grx = np.linspace(0, 20, num=41)
+        grz = np.linspace(0, 30, num=61)
+        nc = (grx.size - 1) * (grz.size - 1)
+        s = 1.0 + 0.1 * np.random.rand(nc)
+
+        z = np.linspace(0.5, 29.5, 20)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.5 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+        # shuffle data so that results have to be put back in order
+        ind = np.random.permutation(Tx.shape[0])
+        Tx = Tx[ind, :]
+        Rx = Rx[ind, :]
+
+        grid = Grid2D(grx, grz)
+        tic = time.perf_counter()
+        tt1, L1, rays1 = grid.raytrace(s, Tx, Rx, return_rays=True)
+        print('in-process: {0:g} s'.format(time.perf_counter() - tic))
+
+        grid_p = Grid2D(grx, grz, nprocesses=4)
+        tic = time.perf_counter()
+        tt2, L2, rays2 = grid_p.raytrace(s, Tx, Rx, return_rays=True)
+        print('4 processes: {0:g} s'.format(time.perf_counter() - tic))
+        grid_p.closePool()
+
+        print('identical tt: {0}, L: {1}, rays: {2}'.format(np.array_equal(tt1, tt2),
+                                                            (L1 != L2).nnz == 0,
+                                                            all(np.array_equal(r1, r2) for r1, r2 in zip(rays1, rays2))))
+
+    if testRaytrace3D:
+        grx = np.linspace(0, 10, num=21)
+        gry = np.linspace(0, 8, num=17)
+        grz = np.linspace(0, 15, num=31)
+
+        grid = Grid3D(grx, gry, grz)
+        grid.nsnx = grid.nsny = grid.nsnz = 5
+        slowness = np.ones((grid.getNumberOfCells(), ))
+
+        z = np.linspace(0.5, 14.5, 8)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(z.size), 1.2 * np.ones(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((9.5 * np.ones(z.size), 6.3 * np.ones(z.size), z)).T, (z.size, 1))
+        grid.Tx = Tx
+        grid.Rx = Rx
+
+        tic = time.perf_counter()
+        tt, L, rays = grid.raytrace(slowness, Tx, Rx, return_rays=True)
+        print('raytracing: {0:g} s, {1:d} nodes'.format(time.perf_counter() - tic, grid.cgrid.getNumberOfNodes()))
+
+        # tolerances: 0.5% on traveltimes with 5 secondary nodes (0.35%
+        # measured), L consistent with traveltimes, exact straight rays
+        d = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+        errT = np.max(np.abs(tt - d) / d)
+        errL = np.max(np.abs(L * slowness - tt))
+        print('max relative error on tt: {0:g}'.format(errT))
+        print('max |L*s - tt|: {0:g}'.format(errL))
+        assert errT < 5.e-3 and errL < 1.e-8 * np.max(tt)
+
+        Ls = grid.getForwardStraightRays()
+        errS = np.max(np.abs(Ls * slowness - d))
+        print('max |Lsr*s - d|: {0:g}'.format(errS))
+        assert errS < 1.e-8 * np.max(d)
+
+        grid2 = Grid3D(grx, gry, grz, nthreads=4)
+        grid2.nsnx = grid2.nsny = grid2.nsnz = 5
+        tt2, L2 = grid2.raytrace(slowness, Tx, Rx)
+        same = np.array_equal(tt, tt2) and (L != L2).nnz == 0
+        print('identical with 4 threads: {0}'.format(same))
+        assert same
+
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
+        for r in rays:
+            ax.plot(r[:, 0], r[:, 1], r[:, 2])
+        plt.show()
+
+    if testBenchFMM:
+        # traveltimes with the fast marching method compared with the shortest
+        # path method, against analytic values in a homogeneous medium and
+        # against a fine shortest path solution in a heterogeneous medium
+
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        nc = (grx.size - 1) * (grz.size - 1)
+
+        z = np.linspace(0.5, 29.5, 30)
+        Tx = np.repeat(np.vstack((1.0 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.0 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        x = 0.5 * (grx[1:] + grx[:-1])
+        zc = 0.5 * (grz[1:] + grz[:-1])
+        xx, zz = np.meshgrid(x, zc, indexing='ij')
+        s_hetero = (1.0 + 0.2 * np.exp(-((xx - 10.0)**2 + (zz - 15.0)**2) / 20.0)).ravel()
+
+        for name, s in (('homogeneous', np.ones((nc, ))), ('heterogeneous', s_hetero)):
+            if name == 'homogeneous':
+                tt_ref = np.sqrt(np.sum((Tx - Rx)**2, axis=1))
+            else:
+                g = Grid2D(grx, grz)
+                g.nsnx = g.nsnz = 20
+                tt_ref = g.raytrace(s, Tx, Rx, return_L=False)
+
+            print(name)
+            for method, nsn in (('spm', 5), ('spm', 10), ('fmm', 0)):
+                g = Grid2D(grx, grz)
+                g.method = method
+                g.nsnx = g.nsnz = nsn
+                tic = time.perf_counter()
+                tt = g.raytrace(s, Tx, Rx, return_L=False)
+                t = time.perf_counter() - tic
+                err = np.abs(tt - tt_ref) / tt_ref
+                label = method if method == 'fmm' else '{0:s} nsn={1:d}'.format(method, nsn)
+                print('  {0:12s} {1:8.3f} s   mean rel. error {2:.2e}   max rel. error {3:.2e}'.format(label, t, err.mean(), err.max()))
+
+    if testRays:
+        import pickle
+        import tempfile
+
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        s = 1.0 + 0.1 * np.random.rand((grx.size - 1) * (grz.size - 1))
+
+        z = np.linspace(0.5, 29.5, 60)
+        Tx = np.repeat(np.vstack((0.5 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.5 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        grid = Grid2D(grx, grz)
+        grid.nsnx = grid.nsnz = 5
+        tt, rays = grid.raytrace(s, Tx, Rx, return_L=False, return_rays=True)
+
+        # former storage, one float64 array per ray
+        rays_tuple = tuple(np.array(r, dtype=np.float64) for r in rays)
+
+        print('{0:d} rays, {1:d} points'.format(len(rays), rays.q.shape[0]))
+        print('pickle size: tuple {0:d} kB, flat {1:d} kB'.format(len(pickle.dumps(rays_tuple)) // 1024,
+                                                                 len(pickle.dumps(rays)) // 1024))
+        print('memory: tuple {0:d} kB, flat {1:d} kB'.format(sum(r.nbytes + 112 for r in rays_tuple) // 1024,
+                                                            rays.nbytes // 1024))
+
+        ind = np.random.permutation(len(rays))[:100]
+        sub = rays.take(ind)
+        print('take: {0}'.format(all(np.array_equal(sub[n], rays[i]) for n, i in enumerate(ind))))
+        print('concatenate: {0}'.format(np.array_equal(Rays.concatenate([rays[:10], rays[10:]]).coords, rays.coords)))
+
+        x, z = rays.plotData(ind)
+        print('plotData: {0}'.format(np.array_equal(x[~np.isnan(x)], sub.coords[:, 0])))
+
+        filename = os.path.join(tempfile.mkdtemp(), 'rays.npz')
+        rays.save(filename)
+        rays2 = Rays.load(filename)
+        print('save/load: {0}'.format(np.array_equal(rays2.coords, rays.coords) and np.array_equal(rays2.offsets, rays.offsets)))
+        rays2 = pickle.loads(pickle.dumps(rays))
+        print('pickle: {0}'.format(np.array_equal(rays2.q, rays.q) and np.array_equal(rays2.offsets, rays.offsets)))
+
+        # coordinates are within step / 2 of those given
+        c = rays.coords + 0.01 * np.random.rand(*rays.q.shape)
+        rays2 = Rays(c, rays.offsets)
+        err = np.abs(rays2.coords - c).max(axis=0)
+        print('quantization error: {0}'.format(err))
+        assert np.all(err <= 0.5 * rays2.step + 1e-5 * np.abs(c).max(axis=0))
+
+    if testMerge:
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        s = 1.0 + 0.1 * np.random.rand((grx.size - 1) * (grz.size - 1))
+
+        # two MOGs sharing the same Tx borehole, with many Tx and few Rx;
+        # Tx are inside cells, see SourcePlan for positions on cell boundaries
+        zt = np.linspace(0.6, 29.4, 120)
+        zr = np.linspace(0.5, 29.5, 15)
+        Tx1 = np.repeat(np.vstack((0.6 * np.ones(zt.size), np.zeros(zt.size), zt)).T, zr.size, axis=0)
+        Rx1 = np.tile(np.vstack((19.5 * np.ones(zr.size), np.zeros(zr.size), zr)).T, (zt.size, 1))
+        Rx2 = np.tile(np.vstack((10.5 * np.ones(zr.size), np.zeros(zr.size), zr)).T, (zt.size, 1))
+        Tx = np.vstack((Tx1, Tx1 + 1.e-9, Tx1[:100, :]))  # second MOG with round-off, repeated data
+        Rx = np.vstack((Rx1, Rx2, Rx1[:100, :]))
+
+        grid = Grid2D(grx, grz)
+        grid.nsnx = grid.nsnz = 5
+
+        tic = time.perf_counter()
+        tt, L, rays = grid.raytrace(s, Tx, Rx, return_rays=True)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        tt2, L2, rays2 = grid.raytraceMerged(s, Tx, Rx, return_rays=True)
+        t2 = time.perf_counter() - tic
+
+        plan = grid.lastPlan
+        print('{0:d} data, sources: {1:d} -> {2:d} (reduction {3:.1f}), swap: {4}'.format(Tx.shape[0], plan.nsrcIn, plan.nsrc,
+                                                                                         plan.reduction, plan.swap))
+        print('raytrace: {0:g} s, raytraceMerged: {1:g} s'.format(t1, t2))
+        errSwap = np.max(np.abs(tt - tt2) / tt)
+        errL = np.max(np.abs(L2 * s - tt2))
+        startTx = np.allclose(np.array([r[0, :] for r in rays2]), Tx[:, [0, 2]], atol=0.5 * rays2.step.max() + 1.e-5)
+        print('max |tt - tt_merged| / tt: {0:g}'.format(errSwap))
+        print('max |L*s - tt_merged|: {0:g}'.format(errL))
+        print('rays start at Tx: {0}'.format(startTx))
+
+        # without the swap, merged sources move by less than tol along x and z
+        tol = 1.e-6
+        tt3 = grid.raytraceMerged(s, Tx, Rx, return_L=False, reciprocity=False, tol=tol)
+        errMerge = np.max(np.abs(tt - tt3))
+        print('no swap, max |tt - tt_merged|: {0:g} (bound {1:g})'.format(errMerge, s.max() * tol * np.sqrt(2)))
+
+        assert errMerge <= s.max() * tol * np.sqrt(2)
+        # the shortest path method is not exactly reciprocal, the swap changes
+        # traveltimes within its accuracy (up to 7e-6 measured with 5 nodes)
+        assert errSwap < 1.e-3
+        assert errL < 1.e-10 * np.max(tt2) and startTx
+
+    if testRayCache:
+        import tempfile
+
+        grid = Grid2D(np.linspace(0, 20, num=201), np.linspace(0, 30, num=301))
+        z = np.linspace(0.5, 29.5, 100)
+        grid.Tx = np.repeat(np.vstack((0.5 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        grid.Rx = np.tile(np.vstack((19.5 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+        grid.rayCache = StraightRayCache(tempfile.mkdtemp(), maxEntries=2)
+
+        for aniso in (False, True, False):
+            tic = time.perf_counter()
+            L = grid.getForwardStraightRays(aniso=aniso)
+            print('aniso {0}: {1:g} s'.format(aniso, time.perf_counter() - tic))
+
+        grid.rayCache.maxEntries = 64
+        grid.rayCache.put(grid.rayCache.key('other'), L)
+        print('entries: {0:d}, {1:d} MB'.format(len(os.listdir(grid.rayCache.path)),
+                                               sum(e.stat().st_size for e in os.scandir(grid.rayCache.path)) // 1024**2))
+        grid.rayCache.maxEntries = 2
+        grid.rayCache.evict()  # removes the anisotropic matrix, least recently used
+        print('entries: {0:d}'.format(len(os.listdir(grid.rayCache.path))))
+
+        Lc = grid.getForwardStraightRays()
+        grid.rayCache.clear()
+        grid.rayCache = None
+        print('identical: {0}'.format((abs(Lc - grid.getForwardStraightRays())).max() == 0))
+
+    if testProj:
+        # former implementations, looping over points
+
+        def proj_plane_loop(data, x0, a):
+            p_data = data.copy()
+            for n in np.arange(data.shape[0]):
+                r = x0 - data[n, :]
+                p = np.dot(a, r)
+                p_data[n, :] = data[n, :] + p * a
+            return p_data
+
+        def proj_planes_loop(data, planes):
+            p_data = data.copy()
+            no_plane = np.zeros((data.shape[0],), dtype=int)
+            p = np.zeros((len(planes),))
+            for n in np.arange(data.shape[0]):
+                for nn in np.arange(len(planes)):
+                    r = planes[nn].x0 - data[n, :]
+                    p[nn] = np.dot(planes[nn].a, r)
+                no = np.argmin(np.abs(p))
+                p_data[n, :] = data[n, :] + p[no] * planes[no].a
+                no_plane[n] = no
+            return p_data, no_plane
+
+        def transl_rotat_loop(data, origin, az, dip):
+            m_data = np.vstack([data[:, 0] - origin[0], data[:, 1] - origin[1], data[:, 2] - origin[2]]).T
+            rot = np.array([[np.cos(az), -np.sin(az)], [np.sin(az), np.cos(az)]])
+            for n in np.arange(m_data.shape[0]):
+                m_data[n, :2] = np.dot(m_data[n, :2], rot.T)
+            rot = np.array([[np.cos(dip), -np.sin(dip)], [np.sin(dip), np.cos(dip)]])
+            for n in np.arange(m_data.shape[0]):
+                m_data[n, 1:] = np.dot(m_data[n, 1:], rot.T)
+            return m_data
+
+        class Plane:
+            def __init__(self, x0, a):
+                self.x0 = x0
+                self.a = a / np.linalg.norm(a)
+
+        data = 20.0 * np.random.rand(50000, 3)
+        planes = [Plane(20.0 * np.random.rand(3), np.random.randn(3)) for n in range(4)]
+
+        tic = time.perf_counter()
+        p1 = proj_plane_loop(data, planes[0].x0, planes[0].a)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        p2 = Grid.proj_plane(data, planes[0].x0, planes[0].a)
+        t2 = time.perf_counter() - tic
+        print('proj_plane: {0:g} s -> {1:g} s, max diff {2:g}'.format(t1, t2, np.max(np.abs(p1 - p2))))
+
+        tic = time.perf_counter()
+        p1, no1 = proj_planes_loop(data, planes)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        p2, no2 = Grid.proj_planes(data, planes)
+        t2 = time.perf_counter() - tic
+        print('proj_planes: {0:g} s -> {1:g} s, max diff {2:g}, same planes: {3}'.format(t1, t2, np.max(np.abs(p1 - p2)),
+                                                                                        np.array_equal(no1, no2)))
+
+        tic = time.perf_counter()
+        m1 = transl_rotat_loop(data, np.array([1.0, 2.0, 3.0]), 0.3, -0.2)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        m2 = Grid.transl_rotat(data, np.array([1.0, 2.0, 3.0]), 0.3, -0.2)
+        t2 = time.perf_counter() - tic
+        print('transl_rotat: {0:g} s -> {1:g} s, max diff {2:g}'.format(t1, t2, np.max(np.abs(m1 - m2))))
+
+    if testFFTMAbatch:
+        import tempfile
+
+        grid = Grid2D(np.linspace(0, 10, num=101), np.linspace(0, 20, num=201))
+        cm = [covar.CovarianceExponential(np.array([5.0, 2.0]), np.array([30.0]), 2.5),
+              covar.CovarianceSpherical(np.array([1.0, 1.0]), np.array([0.0]), 0.5)]
+
+        tic = time.perf_counter()
+        G = grid.preFFTMA(cm)
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        grid.preFFTMA(cm)
+        print('preFFTMA: {0:g} s, cached: {1:g} s, G: {2}'.format(t1, time.perf_counter() - tic, G.shape))
+
+        # former implementation, complex FFTs, with the same white noise and covariance
+        Nx, Nz = G.shape[0], 2 * (G.shape[1] - 1)
+        x = _fftmaAxis(Nx, grid.dx)
+        z = _fftmaAxis(Nz, grid.dz)
+        xx, zz = np.meshgrid(x, z, indexing='ij')
+        K = sum(c.compute(np.vstack((xx.ravel(), zz.ravel())).T, np.zeros((1, 2))) for c in cm).reshape(Nx, Nz)
+        Gc = np.sqrt(np.fft.fft2(K))
+        U = np.random.randn(Nx, Nz)
+        Z1 = np.real(np.fft.ifft2(Gc * np.fft.fft2(U)))
+        Z1 = Z1[int(round((Nx + 2) / 2)):(int(round((Nx + 2) / 2)) + grid.grx.size - 1),
+                int(round((Nz + 2) / 2)):(int(round((Nz + 2) / 2)) + grid.grz.size - 1)]
+        Z2 = grid._FFTMAfields(G, U[np.newaxis, :, :])[0]
+        print('max |Z_complex - Z_real| / std: {0:g}'.format(np.max(np.abs(Z1 - Z2)) / np.std(Z1)))
+
+        nreal = 100
+        tic = time.perf_counter()
+        for n in range(nreal):
+            np.real(np.fft.ifft2(Gc * np.fft.fft2(np.random.randn(Nx, Nz))))
+        t1 = time.perf_counter() - tic
+        tic = time.perf_counter()
+        Z = grid.FFTMAbatch(cm, nreal, seed=42)
+        t2 = time.perf_counter() - tic
+        print('{0:d} realizations: complex FFTs {1:g} s, FFTMAbatch {2:g} s'.format(nreal, t1, t2))
+
+        filename = os.path.join(tempfile.mkdtemp(), 'fftma.npy')
+        Zm = grid.FFTMAbatch(cm, nreal, out=filename, seed=42, batch=7)
+        print('reproducible with other batch size and memmap: {0}'.format(np.array_equal(Z, np.load(filename))))
+        print('mean variance: {0:g} (sill 3)'.format(np.mean(np.var(Z, axis=0))))
+        del Zm
+
+    if testXdmfWriter:
+        import tempfile
+        import tracemalloc
+
+        grid = Grid2D(np.linspace(0, 10, num=101), np.linspace(0, 20, num=201))
+        cm = [covar.CovarianceExponential(np.array([4.0, 2.0]), np.array([0.0]), 1.0)]
+        filename = os.path.join(tempfile.mkdtemp(), 'ensemble.xmf')
+
+        tracemalloc.start()
+        with XdmfWriter(grid, filename, 'fftma') as w:
+            for n in range(500):
+                w.append(grid.FFTMAbatch(cm, 1, seed=n)[0], time=n)
+                if n == 49 or n == 499:
+                    print('step {0:d}, peak memory {1:d} kB'.format(n + 1, tracemalloc.get_traced_memory()[1] // 1024))
+        tracemalloc.stop()
+
+        with h5py.File(filename + '.h5', 'r') as f:
+            Z = f['fftma'][123].T
+            print('fields: {0}, file size {1:d} kB, xmf size {2:d} kB'.format(f['fftma'].shape, os.path.getsize(filename + '.h5') // 1024,
+                                                                          os.path.getsize(filename) // 1024))
+        print('max diff: {0:g}'.format(np.max(np.abs(Z - grid.FFTMAbatch(cm, 1, seed=123)[0]))))
+
+    if testPrecision:
+        from inversion import invLSQR, InvLSQRParams
+
+        grx = np.linspace(0, 10, num=51)
+        grz = np.linspace(0, 20, num=101)
+        xc, zc = np.meshgrid(0.5 * (grx[1:] + grx[:-1]), 0.5 * (grz[1:] + grz[:-1]), indexing='ij')
+        s = (10.0 * (1.0 + 0.1 * np.exp(-((xc - 5.0)**2 + (zc - 10.0)**2) / 4.0))).ravel()
+        z = np.linspace(0.5, 19.5, 40)
+        Tx = np.repeat(np.vstack((0.2 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((9.8 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        grid = Grid2D(grx, grz)
+        grid.nsnx = grid.nsnz = 5
+        tt64, L64 = grid.raytrace(s, Tx, Rx)
+        grid.precision = 'float32'
+        tt32, L32 = grid.raytrace(s, Tx, Rx)
+        # tolerances: traveltimes and L*s within 1e-5 (relative), slowness
+        # within 1e-3 (relative) and rms residuals within 1% after inversion
+        errT = np.max(np.abs(tt64 - tt32) / tt64)
+        errL = np.max(np.abs(L64 * s - L32 * s.astype(np.float32)) / tt64)
+        print('tt: {0} -> {1}, max rel. diff: {2:g}'.format(tt64.dtype, tt32.dtype, errT))
+        print('L: {0} -> {1}, data size {2:d} kB -> {3:d} kB, max rel. diff of L*s: {4:g}'.format(
+            L64.dtype, L32.dtype, L64.data.nbytes // 1024, L32.data.nbytes // 1024, errL))
+        assert errT < 1.e-5 and errL < 1.e-5
+
+        grid.precision = 'float64'
+        grid.Tx = Tx
+        grid.Rx = Rx
+        data = np.hstack((Tx, Rx, tt64[:, None], np.zeros((tt64.size, 1)), np.arange(tt64.size)[:, None]))
+        tomo = {}
+        for precision in ('float64', 'float32'):
+            params = InvLSQRParams()
+            params.numItStraight = 2
+            params.numItCurved = 4
+            params.alphax = params.alphaz = 5.0
+            params.dv_max = 0.5
+            params.nbreiter = 200
+            params.tol = 1.e-6
+            params.saveInvData = 1
+            params.precision = precision
+            tomo[precision] = invLSQR(params, data, np.ones(tt64.size, dtype=bool), grid, np.zeros(1))
+        s64, s32 = tomo['float64'].s, tomo['float32'].s
+        errS = np.max(np.abs(s64 - s32) / s64)
+        rms64 = np.sqrt(np.mean(tomo['float64'].invData.res[:, -1]**2))
+        rms32 = np.sqrt(np.mean(tomo['float32'].invData.res[:, -1]**2))
+        print('s: {0} -> {1}, max rel. diff: {2:g}'.format(s64.dtype, s32.dtype, errS))
+        print('rms residuals: {0:g} (float64), {1:g} (float32)'.format(rms64, rms32))
+        assert errS < 1.e-3 and abs(rms32 - rms64) < 0.01 * rms64
+
+    if testTuneNodes:
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        xc, zc = np.meshgrid(0.5 * (grx[1:] + grx[:-1]), 0.5 * (grz[1:] + grz[:-1]), indexing='ij')
+        s = (1.0 + 0.2 * np.exp(-((xc - 10.0)**2 + (zc - 15.0)**2) / 20.0)).ravel()
+        z = np.linspace(0.5, 29.5, 60)
+        Tx = np.repeat(np.vstack((1.0 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.0 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        grid = Grid2D(grx, grz)
+        for tol in (1.e-2, 1.e-3, 2.e-4):
+            nsn, table = grid.tuneSecondaryNodes(s, Tx, Rx, tol=tol)
+            print('tol {0:g}: nsnx = nsnz = {1:d}'.format(tol, nsn))
+        for row in table:
+            print('  nsn {0:3.0f}  {1:7.3f} s   mean rel. error {2:.2e}   max rel. error {3:.2e}'.format(*row))
+
+        # check on all the data
+        tt_ref = Grid2D(grx, grz)
+        tt_ref.nsnx = tt_ref.nsnz = 30
+        tt_ref = tt_ref.raytrace(s, Tx, Rx, return_L=False)
+        for nsn in (grid.nsnx, 10):
+            g = Grid2D(grx, grz)
+            g.nsnx = g.nsnz = nsn
+            tic = time.perf_counter()
+            tt = g.raytrace(s, Tx, Rx, return_L=False)
+            t = time.perf_counter() - tic
+            print('all data, nsn {0:d}: {1:.3f} s, max rel. error {2:.2e}'.format(nsn, t, np.max(np.abs(tt - tt_ref) / tt_ref)))
+
+    if testBending:
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        xc, zc = np.meshgrid(0.5 * (grx[1:] + grx[:-1]), 0.5 * (grz[1:] + grz[:-1]), indexing='ij')
+        s1 = (1.0 + 0.2 * np.exp(-((xc - 10.0)**2 + (zc - 15.0)**2) / 20.0)).ravel()
+        s2 = s1 * (1.0 + 0.02 * np.sin(xc / 3.0) * np.cos(zc / 4.0)).ravel()
+        z = np.linspace(0.5, 29.5, 60)
+        Tx = np.repeat(np.vstack((1.0 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.0 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        grid = Grid2D(grx, grz)
+        tt1, L1, rays1 = grid.raytrace(s1, Tx, Rx, return_rays=True)
+
+        tic = time.perf_counter()
+        tt_spm, L_spm = grid.raytrace(s2, Tx, Rx)
+        t_spm = time.perf_counter() - tic
+        tic = time.perf_counter()
+        tt_b, L_b, ind = grid.raytraceBending(s2, Tx, Rx, rays1)
+        t_b = time.perf_counter() - tic
+
+        print('shortest path: {0:.3f} s, bending: {1:.3f} s ({2:d} rays traced again)'.format(t_spm, t_b, int(ind.sum())))
+        print('tt max rel. diff: {0:g}'.format(np.max(np.abs(tt_b - tt_spm) / tt_spm)))
+        print('L*s max rel. diff: {0:g}'.format(np.max(np.abs(L_b * s2 - L_spm * s2) / (L_spm * s2))))
+
+    if testUpdate:
+        grx = np.linspace(0, 20, num=81)
+        grz = np.linspace(0, 30, num=121)
+        xc, zc = np.meshgrid(0.5 * (grx[1:] + grx[:-1]), 0.5 * (grz[1:] + grz[:-1]), indexing='ij')
+        s = (1.0 + 0.2 * np.exp(-((xc - 10.0)**2 + (zc - 15.0)**2) / 20.0)).ravel()
+        anomaly = (np.exp(-((xc - 8.0)**2 + (zc - 12.0)**2) / 8.0)).ravel()
+        z = np.linspace(0.5, 29.5, 30)
+        Tx = np.repeat(np.vstack((1.0 * np.ones(z.size), np.zeros(z.size), z)).T, z.size, axis=0)
+        Rx = np.tile(np.vstack((19.0 * np.ones(z.size), np.zeros(z.size), z)).T, (z.size, 1))
+
+        grid = Grid2D(grx, grz)
+        tol = 0.01
+        _, L = grid.raytrace(s, Tx, Rx)
+        s_L = [s]
+        version = np.zeros((Tx.shape[0], ), dtype=np.int64)
+        # ten steps of 0.5% at the anomaly, each one below tol but 5.1% in total
+        for n in range(10):
+            s = s * (1.0 + 0.005 * anomaly)
+            tt, L, ind = grid.raytraceUpdate(s, Tx, Rx, L, s_L, tol, version=version)
+            version[ind] = len(s_L)
+            s_L.append(s)
+            used = np.unique(version)
+            s_L = [s_L[v] for v in used]
+            version = np.searchsorted(used, version)
+            print('step {0:d}: {1:d} rays traced again, {2:d} models kept'.format(n + 1, int(ind.sum()), len(s_L)))
+
+        tt_ref, L_ref = grid.raytrace(s, Tx, Rx)
+        errL = abs(L - L_ref).max()
+        errT = np.max(np.abs(tt - tt_ref))
+        print('max |L - L_ref|: {0:g}, max |tt - tt_ref|: {1:g}'.format(errL, errT))
+        # rays kept were traced in a model within tol of the final one
+        assert errT < tol * np.max(tt_ref)
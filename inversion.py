@@ -19,10 +19,15 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import multiprocessing
+
 import numpy as np
-import scipy as spy
+import scipy.linalg
+import scipy.sparse
 from scipy.sparse import linalg
 
+from grid import XdmfWriter
+
 
 class InvLSQRParams(object):
     def __init__(self):
@@ -40,9 +45,24 @@ class InvLSQRParams(object):
         self.order          = 1
         self.nbreiter       = 0
         self.dv_max         = 0
-
-
-def invLSQR(params, data, idata, grid, L, app=None, ui=None):
+        self.incremental    = 0     # if 1, only rays crossing modified cells are traced again
+        self.incrementalTol = 0.01  # relative slowness change above which a cell is modified
+        self.mergeSources   = 0     # if 1, identical sources of all selected MOGs are raytraced once
+        self.xdmfFile       = ''    # if not empty, slowness models of all iterations are saved in this xdmf file
+        self.precision      = 'float64'  # 'float32' to store L, traveltimes and results in single precision
+        self.tuneNodesTol   = 0     # if > 0, number of secondary nodes is tuned for this traveltime tolerance
+        self.bending        = 0     # if 1, rays of the previous curved iteration are refined by bending
+        self.solver         = 'lsqr'  # 'lsqr' or 'lsmr'
+        self.warmStart      = 0     # if 1, the solver starts from the model of the previous iteration
+        self.colScaling     = 0     # if 1, columns of the system are scaled to unit norm (Jacobi preconditioning)
+        self.autoReg        = ''    # 'lcurve' or 'gcv' to select the smoothing weights automatically
+        self.autoRegRange   = (1.e-2, 1.e2)  # range of the factors of alphax, alphay, alphaz tested
+        self.autoRegN       = 12    # number of factors tested
+        self.autoRegWorkers = 0     # number of processes solving for the factors, number of CPUs if 0
+        self.autoRegProbes  = 4     # number of random vectors used to estimate the trace for GCV
+
+
+def invLSQR(params, data, idata, grid, L, app=None, ui=None, cont=None):
     """
     Input:
     params:  Instance of lsqrParams class whose parameters have been
@@ -86,6 +106,9 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
             app is set to none
 
     ui: the InversionUI QWidget
+
+    cont: CellConstraints instance holding the constraints on the cells (see
+          Grid.mapConstraints), used if params.useCont is 1
     """
 
     # First we call a Tomo class instance. It will hold the data we will process along the way.
@@ -94,114 +117,593 @@ def invLSQR(params, data, idata, grid, L, app=None, ui=None):
     if data.shape[1] >= 9:
         tomo.no_trace = data[:, 8]
 
-    if np.all(L == 0):
-        # We get the straights rays for the first iteration
-        L = grid.getForwardStraightRays(idata)
+    # L and traveltimes computed by the grid are stored in the precision of the inversion
+    grid_precision = grid.precision
+    grid.precision = params.precision
+    writer = None
+    nsn_prev = None
+    try:
+        dtype = grid.getDtype()
 
-    tomo.x = 0.5 * (grid.grx[0:-2] + grid.grx[1:-1])
-    tomo.z = 0.5 * (grid.grz[0:-2] + grid.grz[1:-1])
+        if not scipy.sparse.issparse(L) and np.all(L == 0):
+            # We get the straights rays for the first iteration
+            L = grid.getForwardStraightRays(idata)
+        L = L.astype(dtype, copy=False)
 
-    if not np.all(grid.gry == 0):
-        tomo.y = 0.5 * (grid.gry[0:-2] + grid.gry[1:-1])
-    else:
-        tomo.y = np.array([])
+        tomo.x = 0.5 * (grid.grx[0:-2] + grid.grx[1:-1])
+        tomo.z = 0.5 * (grid.grz[0:-2] + grid.grz[1:-1])
+
+        if not np.all(grid.gry == 0):
+            tomo.y = 0.5 * (grid.gry[0:-2] + grid.gry[1:-1])
+        else:
+            tomo.y = np.array([])
+
+        # constraint rows do not change between iterations, only their right-hand side does
+        if cont is not None and len(cont) > 0 and params.useCont == 1:
+            C, d_cont = cont.rows(L.shape[1], params.wCont, dtype)
+        else:
+            C, d_cont = None, None
+
+        # Getting our spatial derivative elements
+        # These will smoothen the subsequent slowness/velocity model
+        Dx, Dy, Dz = grid.derivative(params.order)
+
+        # mean slowness from the picked tts and the lengths of the initial rays
+        lsum = np.asarray(L.sum(axis=1)).ravel()
+        mean_s0 = np.mean(data[:, 6] / lsum)
+
+        alphas = (params.alphax, params.alphay, params.alphaz)
+        if params.autoReg:
+            # the smoothing weights are selected with the straight rays, before iterating
+            dc = d_cont - C * (mean_s0 * np.ones(L.shape[1])) if C is not None else None
+            alphas, tomo.invData.regCurve = selectRegularization(params, L, data[:, 6] - mean_s0 * lsum,
+                                                                 (Dx, Dy, Dz), C, dc)
+            tomo.invData.alphas = np.array(alphas)
+            msg = 'Smoothing weights selected ({0}): {1:g}, {2:g}, {3:g}'.format(params.autoReg, *alphas)
+            if ui is not None:
+                ui.algo_label.setText('LSQR Inversion -')
+                ui.noIter_label.setText(msg)
+            else:
+                print('LSQR Inversion - ' + msg)
+
+        # The regularization operators are scaled once, and the system
+        # [L; alphax*Dx; alphay*Dy; alphaz*Dz; C] is applied block by block at
+        # each iteration (see _stackedOperator), so that it is never assembled.
+        # Dy has no rows for 2D grids.
+        R = [(D * alpha).astype(dtype) for D, alpha in zip((Dx, Dy, Dz), alphas) if D.shape[0] > 0 and alpha != 0]
+        if C is not None:
+            R.append(C)
+        b = np.zeros((L.shape[0] + sum(r.shape[0] for r in R), ), dtype=dtype)
+        if params.solver not in ('lsqr', 'lsmr'):
+            raise ValueError('solver should be lsqr or lsmr')
+        if params.colScaling == 1:
+            # squared norms of the columns of the constant blocks
+            norm2R = sum(np.asarray(r.multiply(r).sum(axis=0)).ravel() for r in R) if R else 0.0
+
+        s_L = None  # slowness models used to compute curved rays in L
+        L_version = None  # index in s_L of the model used for each row of L
+
+        if params.mergeSources == 1:
+            raytrace = grid.raytraceMerged
+        else:
+            raytrace = grid.raytrace
+
+        # the raypaths of each iteration are needed to bend them at the next one
+        bending = params.bending == 1 and hasattr(grid, 'raytraceBending')
+
+        if params.xdmfFile:
+            writer = XdmfWriter(grid, params.xdmfFile, 'slowness')
+
+        for noIter in range(params.numItCurved + params.numItStraight):
+            if ui is not None and app is not None:
+                ui.gv.noIter = noIter
+                app.processEvents()
+
+            if noIter == 0:
+                mean_s = mean_s0
+            else:
+                mean_s = np.mean(tomo.s)
+
+            # Making sur to have a b array whit (m,) shape
+            mta = L.sum(axis=1) * mean_s
+            mta = np.hstack(mta).T
+
+            tmp = mta.flat
+            tmp = list(tmp)
 
-    cont = np.array([])
-    # TODO:  Ajouter les conditions par rapport au contraintes de v�locit� appliqu�es dans grid editor
+            mta = np.asarray(tmp)
 
-    # Getting our spatial derivative elements
-    # These will smoothen the subsequent slowness/velocity model
-    Dx, Dy, Dz = grid.derivative(params.order)
+            dt = data[:, 6] - mta
+            dt = dt.T
+
+            if noIter == 0:
+                s_o = mean_s * np.ones(L.shape[1]).T
+
+            scale = None
+            if params.colScaling == 1:
+                scale = np.sqrt(np.asarray(L.multiply(L).sum(axis=0)).ravel() + norm2R)
+                scale[scale == 0.0] = 1.0
+                scale = 1.0 / scale
+            A = _stackedOperator([L] + R, dtype, scale)
+
+            b[:L.shape[0]] = dt
+            if C is not None:
+                # the unknowns are the deviations from mean_s
+                b[-C.shape[0]:] = d_cont - C * (mean_s * np.ones(L.shape[1]))
+
+            x0 = None
+            if params.warmStart == 1 and noIter > 0:
+                # deviations of the previous model from its mean, in the scaled unknowns
+                x0 = tomo.s - mean_s
+                if scale is not None:
+                    x0 = x0 / scale
+
+            # See https://docs.scipy.org/doc/scipy/reference/generated/scipy.sparse.linalg.lsqr.html
+            # and https://docs.scipy.org/doc/scipy/reference/generated/scipy.sparse.linalg.lsmr.html for documentation
+            if params.solver == 'lsmr':
+                ans = linalg.lsmr(A, b, atol=params.tol, btol=params.tol, maxiter=params.nbreiter, x0=x0)
+            else:
+                ans = linalg.lsqr(A, b, atol=params.tol, btol=params.tol, iter_lim=params.nbreiter, x0=x0)
+            x = ans[0]
+            if scale is not None:
+                x = scale * x
+            tomo.invData.nSolverIt.append(int(ans[2]))
 
-    for noIter in range(params.numItCurved + params.numItStraight):
-        if ui is not None and app is not None:
-            ui.gv.noIter = noIter
-            app.processEvents()
+            if noIter == 0:
+                tomo.res[0] = ans[3]
+            else:
+                np.append(tomo.res, ans[3])
+
+            if max(abs(s_o / (x + mean_s) - 1)) > params.dv_max:
+                fac = min(abs((s_o / (params.dv_max + 1) - mean_s) / x))
+                x = fac * x
+                s_o = x + mean_s
+
+            tomo.s = (x + mean_s).astype(dtype, copy=False)
+            if writer is not None:
+                writer.append(tomo.s, noIter + 1)
+
+            if s_L is None and params.tuneNodesTol > 0:
+                # the number of secondary nodes is tuned with the first model and the survey
+                # geometry, and used for this inversion only (the grid is saved with the model)
+                nsn_prev = {k: getattr(grid, k) for k in ('nsnx', 'nsny', 'nsnz') if hasattr(grid, k)}
+                nsn, _ = grid.tuneSecondaryNodes(tomo.s, data[:, 0:3], data[:, 3:6], params.tuneNodesTol)
+                tomo.invData.nsn = nsn
+                if ui is None:
+                    print('LSQR Inversion - {0:d} secondary nodes selected'.format(nsn))
+
+            # Applying the resulting model to Tx and Rx to get new tt and L, the trajectory
+            # of curved rays is only needed for the last iteration, unless rays are bent
+            lastIter = noIter == params.numItCurved + params.numItStraight - 1
+            updated = False  # True if only some rows of L were traced again
+            if bending and s_L is not None:
+                # rays of the previous iteration are bent, shortest path is used where bending fails
+                tt, L, tomo.rays, ind = grid.raytraceBending(tomo.s, data[:, 0:3], data[:, 3:6], tomo.rays,
+                                                             return_rays=True)
+                nRays = int(np.count_nonzero(ind))
+            elif lastIter or bending:
+                tt, L, tomo.rays = raytrace(tomo.s, data[:, 0:3], data[:, 3:6], return_rays=True)
+                nRays = data.shape[0]
+            elif params.incremental == 1 and s_L is not None:
+                # L holds curved rays computed with s_L, only rays crossing cells modified
+                # since their own model are traced again
+                tt, L, ind = grid.raytraceUpdate(tomo.s, data[:, 0:3], data[:, 3:6], L, s_L, params.incrementalTol,
+                                                 version=L_version)
+                nRays = int(np.count_nonzero(ind))
+                updated = True
+            else:
+                tt, L = raytrace(tomo.s, data[:, 0:3], data[:, 3:6])
+                nRays = data.shape[0]
+            # all rows change when rays are bent, ind then only marks those traced by shortest path
+            if updated and nRays < data.shape[0]:
+                L_version[ind] = len(s_L)
+                s_L.append(tomo.s)
+                # models no longer used by any row are dropped
+                used = np.unique(L_version)
+                s_L = [s_L[v] for v in used]
+                L_version = np.searchsorted(used, L_version)
+            else:
+                s_L = [tomo.s]
+                L_version = np.zeros((data.shape[0], ), dtype=np.int64)
+            tomo.invData.nRaytraced.append(nRays)
+
+            msg = 'Ray Tracing, Iteration {0}, {1} of {2} rays traced'.format(noIter + 1, nRays, data.shape[0])
+            msg += ', {0} {1} iterations'.format(tomo.invData.nSolverIt[-1], params.solver.upper())
+            if params.mergeSources == 1 and grid.lastPlan is not None:
+                msg += ', sources reduced by {0:.2f}'.format(grid.lastPlan.reduction)
+            if ui is not None:
+                ui.algo_label.setText('LSQR Inversion -')
+                ui.noIter_label.setText(msg)
+                ui.gv.invFig.plot_lsqr_inv(tomo.s)
+            else:
+                print('LSQR Inversion - ' + msg)
+
+            if params.saveInvData == 1:
+                tt = L * tomo.s
+                if noIter == 0:
+                    tomo.invData.res = np.array([data[:, 6] - tt], dtype=dtype).T
+                    tomo.invData.s = np.array([tomo.s]).T
+
+                else:
+                    tomo.invData.res = np.concatenate((tomo.invData.res, np.array([data[:, 6] - tt], dtype=dtype).T), axis=1)
+                    tomo.invData.s = np.concatenate((tomo.invData.s, np.array([tomo.s]).T), axis=1)
+
+            tomo.L = L
+
+    #                 Results:
+    #                       tomo.invData.res:
+    #                                       - shape: (m, noIter+1)
+    #                                       - values: residuals from comparison between original tt (i.e. data[:, 6])
+    #                                                 and tt calculated from the slowness model and the L sparse matrix
+    #
+    #                       tomo.invData.res:
+    #                                       - shape: (n, noIter+1)
+    #                                       - values: slowness models from ech iterations
 
-        if noIter == 0:
-            # Calculating the mean slowness from the picked tts and the ray lenghts
-            mean_s = np.mean(data[:, 6] / L.sum(axis=1))
+        if ui is not None:
+            ui.algo_label.setText('LSQR Inversion -')
+            ui.noIter_label.setText('Finished, {} Iterations Done'.format(noIter + 1))
         else:
-            mean_s = np.mean(tomo.s)
+            print('LSQR Inversion - Finished, {} Iterations Done'.format(noIter + 1))
+    finally:
+        # the grid is shared with the caller, it is left as it was given even on errors
+        if writer is not None:
+            writer.close()
+        if hasattr(grid, 'closePool'):
+            grid.closePool()
+        grid.precision = grid_precision
+        if nsn_prev is not None:
+            for k, v in nsn_prev.items():
+                setattr(grid, k, v)
+            grid.cgrid = None
 
-        # Making sur to have a b array whit (m,) shape
-        mta = L.sum(axis=1) * mean_s
-        mta = np.hstack(mta).T
+    return tomo
 
-        tmp = mta.flat
-        tmp = list(tmp)
 
-        mta = np.asarray(tmp)
+class InvGeostatParams(object):
+    def __init__(self):
+        self.tomoAtt        = 0
+        self.selectedMogs   = []
+        self.numItCurved    = 0
+        self.saveInvData    = 1
+        self.useCont        = 0
+        self.computeVar     = 1     # if 1, the variance of the estimated slowness is computed
+        self.blockSize      = 512   # number of cells for which the covariance is computed at once
+        self.dv_max         = 0     # if > 0, maximum relative change of slowness between iterations
+        self.mergeSources   = 0     # if 1, identical sources of all selected MOGs are raytraced once
 
-        dt = data[:, 6] - mta
-        dt = dt.T
 
-        if noIter == 0:
-            s_o = mean_s * np.ones(L.shape[1]).T
+def invGeostat(params, data, idata, grid, cm, L, app=None, ui=None, cont=None):
+    """
+    Geostatistical (kriging) traveltime inversion in the data space
 
-        A = spy.sparse.vstack([L, Dx * params.alphax, Dz * params.alphaz])
+    The slowness is estimated as
 
-        b = np.concatenate((dt, np.zeros(Dx.shape[0]), np.zeros(Dz.shape[0])))
+        s = s0 + Cm L^T (L Cm L^T + C0)^-1 (t - L s0)
 
-        if not np.all(cont == 0) and params.useCont == 1:
-            # TODO: faire les modifications aux matrices A et b avec les contraintes
-            pass
+    where s0 is the mean slowness, Cm the covariance of the slowness given
+    by the covariance model cm, and C0 the covariance of the data.  The
+    data space matrix K = L Cm L^T + C0 (ndata x ndata) is factored once
+    per iteration with Cholesky, and the factor is used for both the
+    estimate and its variance.  Cm is computed by blocks of
+    params.blockSize cells and is never formed as a whole.  After each
+    iteration, rays are traced in the estimated model for the next one.
 
-        ans = linalg.lsqr(A, b, atol=params.tol, btol=params.tol, iter_lim=params.nbreiter)
-        # See http://docs.scipy.org/doc/scipy-0.14.0/reference/generated/scipy.sparse.linalg.lsqr.html for documentation
-        x = ans[0]
+    The change of slowness between iterations is limited to
+    params.dv_max (relative) if it is > 0.  Iterations stop when the rms
+    of the traveltime residuals increases, the previous estimate being
+    kept.  Anisotropic covariance models (cm.use_xi) are not supported.
 
-        if noIter == 0:
-            tomo.res[0] = ans[3]
-        else:
-            np.append(tomo.res, ans[3])
+    Input:
+    params: InvGeostatParams instance
+    data, idata, grid, app, ui: see invLSQR
+    cm: CovarianceModel instance (e.g. Model.tt_covar), covariances of
+        slowness are the sum of the models in cm.covar plus
+        cm.nugget_model, and C0 is cm.nugget_data times identity, or
+        cm.nugget_data times the squared traveltime errors if cm.use_c0
+        is True (as in the covariance fitting of covar_ui)
+    L: ray projection matrix, straight rays are computed if all zeros
+    cont: CellConstraints instance, used if params.useCont is 1; the
+        constraints are added to the data, with their own variances
+    """
+    if getattr(cm, 'use_xi', False) or getattr(cm, 'use_tilt', False):
+        raise ValueError('Anisotropic covariance models are not supported by the geostatistical inversion')
+
+    tomo = Tomo()
+
+    if data.shape[1] >= 9:
+        tomo.no_trace = data[:, 8]
+
+    if not scipy.sparse.issparse(L) and np.all(L == 0):
+        L = grid.getForwardStraightRays(idata)
+    L = scipy.sparse.csr_matrix(L, dtype=np.float64)
+
+    tomo.x = 0.5 * (grid.grx[0:-2] + grid.grx[1:-1])
+    tomo.z = 0.5 * (grid.grz[0:-2] + grid.grz[1:-1])
+    if not np.all(grid.gry == 0):
+        tomo.y = 0.5 * (grid.gry[0:-2] + grid.gry[1:-1])
+    else:
+        tomo.y = np.array([])
+
+    ncell = L.shape[1]
+    xc = grid.getCellCenter()
+
+    # data covariance
+    if cm.use_c0:
+        c0 = cm.nugget_data * data[:, 7]**2
+    else:
+        c0 = cm.nugget_data * np.ones((data.shape[0], ))
+    t = data[:, 6]
+
+    # constraints are data on single cells
+    if cont is not None and len(cont) > 0 and params.useCont == 1:
+        Lc = scipy.sparse.csr_matrix((np.ones((len(cont), )), (np.arange(len(cont)), cont.cells)),
+                                   shape=(len(cont), ncell))
+        c0 = np.concatenate((c0, cont.variance))
+        t = np.concatenate((t, cont.value))
+    else:
+        Lc = None
+
+    if params.mergeSources == 1:
+        raytrace = grid.raytraceMerged
+    else:
+        raytrace = grid.raytrace
+
+    blocks = [np.arange(n, min(n + params.blockSize, ncell)) for n in range(0, ncell, params.blockSize)]
+
+    rms_prev = np.inf
+    try:
+        for noIter in range(params.numItCurved + 1):
+            if ui is not None and app is not None:
+                ui.gv.noIter = noIter
+                app.processEvents()
 
-        if max(abs(s_o / (x + mean_s) - 1)) > params.dv_max:
-            fac = min(abs((s_o / (params.dv_max + 1) - mean_s) / x))
-            x = fac * x
-            s_o = x + mean_s
+            if noIter == 0:
+                mean_s = np.mean(data[:, 6] / np.asarray(L.sum(axis=1)).ravel())
+            else:
+                mean_s = np.mean(tomo.s)
+
+            G = L if Lc is None else scipy.sparse.vstack((L, Lc), format='csr')
+            GT = G.T.tocsr()
+
+            # K = G Cm G^T + C0, accumulated over blocks of columns of Cm
+            K = np.diag(c0)
+            for ind in blocks:
+                K += (G @ _covarianceBlock(cm, xc, ind)) @ GT[ind, :]
+            try:
+                Kc = scipy.linalg.cho_factor(K, lower=True, overwrite_a=True, check_finite=False)
+            except np.linalg.LinAlgError:
+                raise ValueError('Data covariance matrix is not positive definite, the data nugget effect should be increased')
+            del K
+
+            w = scipy.linalg.cho_solve(Kc, t - G @ (mean_s * np.ones((ncell, ))), check_finite=False)
+
+            # estimate and its variance, with Cm G^T recomputed by blocks; the
+            # variance is kept at each iteration as iterations may stop early
+            lastIter = noIter == params.numItCurved
+            s = np.empty((ncell, ))
+            var_s = np.empty((ncell, )) if params.computeVar == 1 else None
+            for ind in blocks:
+                Cm = _covarianceBlock(cm, xc, ind)
+                GCm = G @ Cm
+                s[ind] = mean_s + GCm.T @ w
+                if var_s is not None:
+                    V = scipy.linalg.solve_triangular(Kc[0], GCm, lower=True, check_finite=False)
+                    var_s[ind] = Cm[ind, np.arange(ind.size)] - np.sum(V**2, axis=0)
+            del Kc
+
+            if noIter > 0 and params.dv_max > 0:
+                dv = np.max(np.abs(s / tomo.s - 1))
+                if dv > params.dv_max:
+                    s = tomo.s + (params.dv_max / dv) * (s - tomo.s)
+
+            # curved rays in the estimated model, raypaths are kept at the last iteration
+            if lastIter:
+                tt, L_s, rays = raytrace(s, data[:, 0:3], data[:, 3:6], return_rays=True)
+            else:
+                tt, L_s = raytrace(s, data[:, 0:3], data[:, 3:6])
+            rms = np.sqrt(np.mean((data[:, 6] - tt)**2))
+            if rms > rms_prev:
+                # the previous estimate is kept, with its raypaths
+                msg = 'Iteration {0} of {1}, rms residuals increased ({2:g} > {3:g}), stopping'.format(
+                    noIter + 1, params.numItCurved + 1, rms, rms_prev)
+                if ui is not None:
+                    ui.noIter_label.setText(msg)
+                else:
+                    print('Geostatistical Inversion - ' + msg)
+                _, _, tomo.rays = raytrace(tomo.s, data[:, 0:3], data[:, 3:6], return_rays=True)
+                break
+            rms_prev = rms
+
+            tomo.s = s
+            if var_s is not None:
+                tomo.var_s = var_s
+            if lastIter:
+                tomo.rays = rays
+            L = scipy.sparse.csr_matrix(L_s, dtype=np.float64)
+
+            msg = 'Iteration {0} of {1}'.format(noIter + 1, params.numItCurved + 1)
+            if ui is not None:
+                ui.algo_label.setText('Geostatistical Inversion -')
+                ui.noIter_label.setText(msg)
+                ui.gv.invFig.plot_lsqr_inv(tomo.s)
+            else:
+                print('Geostatistical Inversion - ' + msg)
 
-        tomo.s = x + mean_s
+            if params.saveInvData == 1:
+                res = np.array([data[:, 6] - L * tomo.s]).T
+                if noIter == 0:
+                    tomo.invData.res = res
+                    tomo.invData.s = np.array([tomo.s]).T
+                else:
+                    tomo.invData.res = np.concatenate((tomo.invData.res, res), axis=1)
+                    tomo.invData.s = np.concatenate((tomo.invData.s, np.array([tomo.s]).T), axis=1)
 
-        # Applying the resulting model to Tx and Rx to get new tt and L and the trajectory of curved rays
-        tt, L, tomo.rays = grid.raytrace(tomo.s, data[:, 0:3], data[:, 3:6])
+            tomo.L = L
 
+        nIter = noIter + 1 if rms_prev == rms else noIter
         if ui is not None:
-            ui.algo_label.setText('LSQR Inversion -')
-            ui.noIter_label.setText('Ray Tracing, Iteration {}'.format(noIter + 1))
-            ui.gv.invFig.plot_lsqr_inv(tomo.s)
+            ui.algo_label.setText('Geostatistical Inversion -')
+            ui.noIter_label.setText('Finished, {} Iterations Done'.format(nIter))
         else:
-            print('LSQR Inversion - Ray Tracing, Iteration {}'.format(noIter + 1))
+            print('Geostatistical Inversion - Finished, {} Iterations Done'.format(nIter))
+    finally:
+        if hasattr(grid, 'closePool'):
+            grid.closePool()
 
-        if params.saveInvData == 1:
-            tt = L * tomo.s
-            if noIter == 0:
-                tomo.invData.res = np.array([data[:, 6] - tt]).T
-                tomo.invData.s = np.array([tomo.s]).T
+    return tomo
 
-            else:
-                tomo.invData.res = np.concatenate((tomo.invData.res, np.array([data[:, 6] - tt]).T), axis=1)
-                tomo.invData.s = np.concatenate((tomo.invData.s, np.array([tomo.s]).T), axis=1)
-
-        tomo.L = L
-
-#                 Results:
-#                       tomo.invData.res:
-#                                       - shape: (m, noIter+1)
-#                                       - values: residuals from comparison between original tt (i.e. data[:, 6])
-#                                                 and tt calculated from the slowness model and the L sparse matrix
-#
-#                       tomo.invData.res:
-#                                       - shape: (n, noIter+1)
-#                                       - values: slowness models from ech iterations
-
-    if ui is not None:
-        ui.algo_label.setText('LSQR Inversion -')
-        ui.noIter_label.setText('Finished, {} Iterations Done'.format(noIter + 1))
+
+def _covarianceBlock(cm, x, ind):
+    """
+    Columns ind of the covariance matrix of the slowness at points x, for
+    covariance model cm
+    """
+    C = cm.covar[0].compute(x, x[ind, :])
+    for n in range(1, len(cm.covar)):
+        C += cm.covar[n].compute(x, x[ind, :])
+    if cm.nugget_model != 0:
+        C[ind, np.arange(ind.size)] += cm.nugget_model
+    return C
+
+
+def selectRegularization(params, L, dt, D, C=None, d_cont=None):
+    """
+    Select the smoothing weights of invLSQR for a fixed ray projection matrix
+
+    The weights (alphax, alphay, alphaz) of params, or 1 along each axis
+    if all are null, are multiplied by params.autoRegN factors spaced
+    logarithmically over params.autoRegRange.  The regularized system is
+    solved for each factor in a pool of params.autoRegWorkers processes
+    (the number of CPUs if 0), and the factor is selected with:
+        - 'lcurve': maximum curvature of the L-curve, i.e. of the log of
+          the norm of the residuals vs the log of the norm of the
+          smoothed model;
+        - 'gcv': minimum of generalized cross-validation, the trace of
+          the influence matrix being estimated with params.autoRegProbes
+          random vectors (Hutchinson estimator).
+
+    Input:
+        params: InvLSQRParams instance (autoReg, autoRegRange, autoRegN,
+                autoRegWorkers, autoRegProbes, alphax, alphay, alphaz,
+                tol, nbreiter)
+        L: ray projection matrix
+        dt: traveltime residuals of the mean slowness model
+        D: tuple of derivative operators (Dx, Dy, Dz)
+        C, d_cont: constraint rows and right-hand side, if any
+    Output:
+        alphas: selected (alphax, alphay, alphaz)
+        table: array with one row per factor holding the factor, the norm
+               of the residuals, the norm of the smoothed model, and the
+               curvature or GCV value
+    """
+    if params.autoReg not in ('lcurve', 'gcv'):
+        raise ValueError('autoReg should be lcurve or gcv')
+    alphas = np.array([params.alphax, params.alphay, params.alphaz], dtype=np.float64)
+    if np.all(alphas == 0):
+        alphas = np.array([1.0 if d.shape[0] > 0 else 0.0 for d in D])
+    factors = np.logspace(np.log10(params.autoRegRange[0]), np.log10(params.autoRegRange[1]), params.autoRegN)
+
+    nprobe = params.autoRegProbes if params.autoReg == 'gcv' else 0
+    args = (L, dt, D, alphas, C, d_cont, params.tol, params.nbreiter, nprobe)
+    nworkers = params.autoRegWorkers if params.autoRegWorkers > 0 else multiprocessing.cpu_count()
+    if nworkers > 1 and not multiprocessing.current_process().daemon:
+        # (workers of a pool, e.g. in batch_inversion, cannot start processes)
+        with multiprocessing.Pool(min(nworkers, factors.size), _regInit, args) as pool:
+            out = pool.map(_regSolve, factors, chunksize=1)
+    else:
+        _regInit(*args)
+        out = [_regSolve(f) for f in factors]
+
+    table = np.zeros((factors.size, 4))
+    table[:, 0] = factors
+    table[:, 1:3] = np.array([o[:2] for o in out])
+    if params.autoReg == 'lcurve':
+        # curvature of the parametric curve (log rho, log eta) of the log of
+        # the factor, both axes being scaled to [0, 1]
+        t = np.log(factors)
+        x = np.log(table[:, 1])
+        y = np.log(table[:, 2])
+        x = (x - x.min()) / max(np.ptp(x), np.finfo(float).tiny)
+        y = (y - y.min()) / max(np.ptp(y), np.finfo(float).tiny)
+        dx, dy = np.gradient(x, t), np.gradient(y, t)
+        ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+        speed = np.sqrt(dx**2 + dy**2)
+        table[:, 3] = (dx * ddy - ddx * dy) / np.maximum(speed, np.finfo(float).tiny)**3
+        # on the flat ends of the curve, where points barely move, the curvature is meaningless
+        kappa = np.where(speed > 0.1 * speed.max(), table[:, 3], -np.inf)
+        n = int(np.argmax(kappa))
     else:
-        print('LSQR Inversion - Finished, {} Iterations Done'.format(noIter + 1))
+        ndata = L.shape[0]
+        trH = np.array([o[2] for o in out])
+        table[:, 3] = ndata * table[:, 1]**2 / np.maximum(ndata - trH, 1.0)**2
+        n = int(np.argmin(table[:, 3]))
+
+    return tuple(factors[n] * alphas), table
+
+
+def _regInit(L, dt, D, alphas, C, d_cont, tol, nbreiter, nprobe):
+    # the fixed parts of the systems are sent once to each worker
+    global _reg
+    _reg = (L, dt, D, alphas, C, d_cont, tol, nbreiter, nprobe)
+
+
+def _regSolve(factor):
+    # norm of the residuals, norm of the smoothed model and estimate of the
+    # trace of the influence matrix for the weights factor * alphas
+    L, dt, D, alphas, C, d_cont, tol, nbreiter, nprobe = _reg
+    R = [d * (factor * a) for d, a in zip(D, alphas) if d.shape[0] > 0 and a != 0]
+    blocks = [L] + R + ([C] if C is not None else [])
+    A = _stackedOperator(blocks, L.dtype)
+    b = np.zeros((A.shape[0], ))
+    b[:L.shape[0]] = dt
+    if C is not None:
+        b[-C.shape[0]:] = d_cont
+
+    x = linalg.lsqr(A, b, atol=tol, btol=tol, iter_lim=nbreiter)[0]
+    rho = np.linalg.norm(L @ x - dt)
+    eta = np.sqrt(sum(np.sum((r @ x)**2) for r in R)) / factor
+
+    trH = 0.0
+    if nprobe > 0:
+        rng = np.random.default_rng(0)
+        for n in range(nprobe):
+            z = rng.choice([-1.0, 1.0], L.shape[0])
+            b[:] = 0.0
+            b[:L.shape[0]] = z
+            trH += z @ (L @ linalg.lsqr(A, b, atol=tol, btol=tol, iter_lim=nbreiter)[0])
+        trH /= nprobe
+
+    return rho, eta, trH
+
+
+def _stackedOperator(blocks, dtype, scale=None):
+    """
+    LinearOperator of the vertical stack of the sparse matrices in blocks,
+    applied block by block without copying the matrices, and with columns
+    multiplied by scale if not None
+    """
+    rows = np.cumsum([0] + [B.shape[0] for B in blocks])
 
-    return tomo
+    def matvec(x):
+        x = np.ravel(x)
+        if scale is not None:
+            x = scale * x
+        y = np.empty((rows[-1], ), dtype=np.result_type(dtype, x.dtype))
+        for B, r0, r1 in zip(blocks, rows[:-1], rows[1:]):
+            y[r0:r1] = B @ x
+        return y
+
+    def rmatvec(y):
+        y = np.ravel(y)
+        x = blocks[0].T @ y[:rows[1]]
+        for B, r0, r1 in zip(blocks[1:], rows[1:-1], rows[2:]):
+            x += B.T @ y[r0:r1]
+        if scale is not None:
+            x *= scale
+        return x
+
+    return linalg.LinearOperator((rows[-1], blocks[0].shape[1]), matvec=matvec, rmatvec=rmatvec, dtype=dtype)
 
 
 class Tomo(object):
@@ -216,9 +718,15 @@ class Tomo(object):
         self.s = 0
         self.res = np.array([0])
         self.var_res = np.array([])
+        self.var_s = np.array([])  # variance of the slowness, geostatistical inversion
 
 
 class invData(object):
     def __init__(self):
         self.res = np.array([0])
         self.s = np.array([0])
+        self.nRaytraced = []  # number of rays traced at each iteration
+        self.nSolverIt = []   # number of iterations of the solver at each iteration
+        self.regCurve = np.array([])  # factors, norms and criterion of the selection of smoothing weights
+        self.alphas = np.array([])    # smoothing weights selected (alphax, alphay, alphaz), params is left unchanged
+        self.nsn = 0                  # number of secondary nodes selected if tuned, the grid is left unchanged
@@ -24,14 +24,16 @@ from PyQt5 import QtGui, QtWidgets, QtCore
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 import numpy as np
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 from model import Model
 import scipy as spy
 from scipy.sparse import linalg
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy import interpolate
-from inversion import invLSQR, InvLSQRParams
+from inversion import invLSQR, InvLSQRParams, invGeostat, InvGeostatParams
 from utils import set_tick_arrangement
 from mog import Mog, AirShots
+from grid import StraightRayCache
 # from utils_ui import chooseModel
 
 import database
@@ -44,6 +46,7 @@ class InversionUI(QtWidgets.QFrame):
         super(InversionUI, self).__init__()
         self.setWindowTitle("BhTomoPy/Inversion")
         self.lsqrParams = InvLSQRParams()
+        self.geostatParams = InvGeostatParams()
         self.tomo = None
         self.prev_inv = []
         self.model_ind = ''
@@ -59,6 +62,10 @@ class InversionUI(QtWidgets.QFrame):
             return
         if self.algo_combo.currentText() == 'LSQR Solver':
             cov = '-LSQR'
+            params = self.lsqrParams
+        else:
+            cov = '-GEOSTAT'
+            params = self.geostatParams
         if self.T_and_A_combo.currentText() == 'Traveltime':
             dType = '-vel'
         else:
@@ -68,7 +75,7 @@ class InversionUI(QtWidgets.QFrame):
                                                             'Name of Inversion:',
                                                             text='tomo (insert date) {} {}'.format(dType, cov))
         if ok:
-            inv_res_info = (inversion_name, self.tomo, self.lsqrParams)
+            inv_res_info = (inversion_name, self.tomo, params)
             current_module.session.query(Model).all()[self.model_ind].inv_res.append(inv_res_info)
             print(current_module.session.query(Model).all()[self.model_ind].inv_res)
 
@@ -187,12 +194,32 @@ class InversionUI(QtWidgets.QFrame):
 
         if self.algo_combo.currentText() == 'LSQR Solver':
             self.update_params()
+            model.grid.rayCache = StraightRayCache.sidecar(database.long_url(current_module))
 
-            self.tomo = invLSQR(self.lsqrParams, data, idata, model.grid, L, app, self)
+            cont = None
+            if self.lsqrParams.useCont:
+                kind = 'acont' if self.lsqrParams.tomoAtt == 1 else 'scont'
+                cont = model.grid.mapConstraints(*model.getConstraints(kind))
 
-        if self.algo_combo.currentText() == 'Geostatistical':
-            # TODO: Faire l'inversion géostatistique
-            pass
+            self.tomo = invLSQR(self.lsqrParams, data, idata, model.grid, L, app, self, cont)
+
+        if self.algo_combo.currentText() == 'Geostatistic':
+            if model.tt_covar is None:
+                QtWidgets.QMessageBox.warning(self, 'Warning', "Please define the traveltime covariance model first",
+                                              buttons=QtWidgets.QMessageBox.Ok)
+                return
+            self.update_params()
+            self.geostatParams.selectedMogs = self.lsqrParams.selectedMogs
+            self.geostatParams.numItCurved = self.lsqrParams.numItCurved
+            self.geostatParams.useCont = self.lsqrParams.useCont
+            self.geostatParams.tomoAtt = self.lsqrParams.tomoAtt
+            model.grid.rayCache = StraightRayCache.sidecar(database.long_url(current_module))
+
+            cont = None
+            if self.geostatParams.useCont:
+                cont = model.grid.mapConstraints(*model.getConstraints('scont'))
+
+            self.tomo = invGeostat(self.geostatParams, data, idata, model.grid, model.tt_covar, L, app, self, cont)
 
     def plot_inv(self):
         s = self.tomo.s
@@ -245,11 +272,15 @@ class InversionUI(QtWidgets.QFrame):
         self.tomo = tomo
         if '-LSQR' in name:
             self.lsqrParams = params
-
-        # TODO: Faire une classe contenant les paramètres pour les inversions géostatistiques
+            noIter = params.numItCurved + params.numItStraight
+        elif '-GEOSTAT' in name:
+            self.geostatParams = params
+            noIter = params.numItCurved + 1
+        else:
+            noIter = self.lsqrParams.numItCurved + self.lsqrParams.numItStraight
 
         self.algo_label.setText(results[0])
-        self.noIter_label.setText('|  {} Iterations'.format(self.lsqrParams.numItCurved + self.lsqrParams.numItStraight))
+        self.noIter_label.setText('|  {} Iterations'.format(noIter))
         self.plot_inv()
         self.update_input_params()
 
@@ -1021,16 +1052,19 @@ class RaysFig(FigureCanvasQTAgg):
         c = interpolate.interp1d(np.arange(-100, 101, 100).T, c.T)(np.arange(-100, 101, 2).T)
         m = 200 / (rmax - rmin)
         if not self.ui.entire_coverage_check.isChecked():
-            for n in ind2:
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
-
-        elif self.ui.entire_coverage_check.isChecked():
-            for n in range(len(self.ui.tomo.rays)):
-                p = m * res[n]
-                color = interpolate.interp1d(np.arange(-100, 101, 2), c)(p)
-                self.ax.plot(self.ui.tomo.rays[n][:, 0], self.ui.tomo.rays[n][:, -1], c=color)
+            ind = ind2
+        else:
+            ind = np.arange(len(self.ui.tomo.rays))
+
+        # all rays are drawn at once, colored according to their residual
+        colors = interpolate.interp1d(np.arange(-100, 101, 2), c)(m * res[ind]).T
+        rays = self.ui.tomo.rays
+        if hasattr(rays, 'segments'):
+            segments = rays.segments(ind)
+        else:
+            # results saved before rays were stored in a flat buffer
+            segments = [rays[n][:, [0, -1]] for n in ind]
+        self.ax.add_collection(LineCollection(segments, colors=colors))
 
         for tick in self.ax.xaxis.get_major_ticks():
             tick.label.set_fontsize(8)
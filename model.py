@@ -23,6 +23,7 @@ import numpy as np
 from sqlalchemy import Column, String, Table, ForeignKey, PickleType
 from utils import Base
 from sqlalchemy.orm import relationship
+from borehole import Borehole
 
 
 # Relationship definition
@@ -59,6 +60,46 @@ class Model(Base):
 
         return boreholes
 
+    def getConstraints(self, kind='scont'):
+        """
+        Returns the coordinates (n x 3), values and variances of the
+        constraints of all the boreholes of the model
+
+        The constraints holding their depth along the borehole are projected
+        on the current trajectories, all boreholes in one call to
+        Borehole.projectMany; the coordinates stored in the constraints are
+        used for the others.
+
+        kind: 'scont' for slowness constraints, 'acont' for attenuation constraints
+        """
+        conts = []
+        for borehole in self.boreholes:
+            cont = getattr(borehole, kind)
+            if hasattr(cont, 'valeur') and np.size(cont.valeur) > 0:
+                conts.append((borehole, cont))
+
+        projected = [n for n, (_, cont) in enumerate(conts)
+                     if np.size(getattr(cont, 'depth', [])) == np.size(cont.valeur)]
+        if len(projected) > 0:
+            x, y, z, _, no_bh = Borehole.projectMany([conts[n][0].fdata for n in projected],
+                                                     [conts[n][1].depth for n in projected])
+            xyzp = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+
+        xyz = [np.zeros((0, 3))]
+        value = [np.zeros((0, ))]
+        variance = [np.zeros((0, ))]
+        for n, (_, cont) in enumerate(conts):
+            if n in projected:
+                xyz.append(xyzp[no_bh == projected.index(n), :])
+            else:
+                xyz.append(np.vstack((np.ravel(cont.x), np.ravel(cont.y), np.ravel(cont.z))).T)
+            value.append(np.ravel(cont.valeur))
+            if np.size(cont.variance) == np.size(cont.valeur):
+                variance.append(np.ravel(cont.variance))
+            else:
+                variance.append(np.zeros((np.size(cont.valeur), )))
+        return np.concatenate(xyz), np.concatenate(value), np.concatenate(variance)
+
     def __init__(self, name=''):
         self.name       = name
         self.grid       = None
@@ -499,6 +499,7 @@ class Grid2DUI(QtWidgets.QWidget):
         self.grid.Rx = Grid.transl_rotat(self.data.Rx_p, self.grid.x0, az, dip)
         self.grid.TxCosDir = Grid.transl_rotat(self.data.TxCosDir, np.zeros(3), az, dip)
         self.grid.RxCosDir = Grid.transl_rotat(self.data.RxCosDir, np.zeros(3), az, dip)
+        self.grid.proj = (self.data.x0, self.data.a, az, dip)
 
 #         if not np.isnan(self.data.Tx_Z_water):
 #             self.grid.Tx_Z_water = Grid.transl_rotat(self.data.Tx_Z_water, self.grid.x0, az, dip)